@@ -0,0 +1,111 @@
+import logging
+import random
+import time
+from array import array
+
+from game_engine import CELLS_COUNT, LINE_MASKS, FULL_BOARD_MASK
+
+logger = logging.getLogger(__name__)
+
+# Уровень -> вероятность сделать не лучший ход (если такой есть)
+AI_LEVELS = {"easy": 0.6, "medium": 0.25, "hard": 0.0}
+
+POSITIONS = 3 ** CELLS_COUNT
+NO_MOVE = 255
+
+# Маска клеток -> ее вклад в индекс позиции (сумма 3**cell по битам маски)
+_BASE3 = tuple(sum(3 ** cell for cell in range(CELLS_COUNT) if mask >> cell & 1) for mask in range(FULL_BOARD_MASK + 1))
+
+
+def position_index(mine: int, theirs: int) -> int:
+    """Индекс позиции в таблице: цифра клетки 1 - камень ходящего, 2 - соперника."""
+    return _BASE3[mine] + 2 * _BASE3[theirs]
+
+
+class AiPlayer:
+    """Компьютерный соперник по заранее посчитанной таблице идеальной игры.
+
+    Позиции кодируются в троичной системе относительно ходящего, поэтому одна
+    таблица годится и для X, и для O при любом первом игроке. Для каждого из
+    3**9 индексов хранятся оценка позиции для ходящего (negamax: >0 - выигрыш,
+    чем больше, тем быстрее; 0 - ничья; <0 - проигрыш) и лучший ход; ячейки
+    недостижимых и завершенных позиций не используются. Это два массива по
+    19683 байта, таблица считается один раз при старте (build).
+
+    Ход - чтение одной ячейки; на уровнях ниже "hard" с вероятностью из
+    AI_LEVELS выбирается случайный ход из тех, что хуже лучшего (оценки
+    соседних позиций - еще не больше 9 чтений), так что поиска в event loop нет.
+    """
+
+    def __init__(self):
+        self._values = array("b", bytes(POSITIONS))
+        self._best = bytearray([NO_MOVE]) * POSITIONS
+        self.built = False
+        self.positions = 0
+        self.build_ms = 0.0
+        self.moves = 0
+        self.suboptimal_moves = 0
+
+    def build(self) -> None:
+        if self.built:
+            return
+        started = time.perf_counter()
+        solved = bytearray(POSITIONS)
+
+        def solve(mine: int, theirs: int) -> int:
+            index = position_index(mine, theirs)
+            if solved[index]:
+                return self._values[index]
+            solved[index] = 1
+            self.positions += 1
+            empty = FULL_BOARD_MASK & ~(mine | theirs)
+            # Соперник только что сходил: его линия - проигрыш, быстрый проигрыш хуже
+            if any(theirs & mask == mask for mask in LINE_MASKS):
+                value = -(empty.bit_count() + 1)
+            elif not empty:
+                value = 0
+            else:
+                value, best = -CELLS_COUNT - 1, NO_MOVE
+                for cell in range(CELLS_COUNT):
+                    if empty >> cell & 1:
+                        score = -solve(theirs, mine | 1 << cell)
+                        if score > value:
+                            value, best = score, cell
+                self._best[index] = best
+            self._values[index] = value
+            return value
+
+        solve(0, 0)
+        self.built = True
+        self.build_ms = (time.perf_counter() - started) * 1000
+        logger.info("AI move table built: %s positions in %.1f ms", self.positions, self.build_ms)
+
+    def choose_move(self, x: int, o: int, symbol: str, level: str) -> int:
+        """Клетка для хода `symbol` на поле с масками x, o (игра не завершена)."""
+        if not self.built:
+            self.build()
+        mine, theirs = (x, o) if symbol == "X" else (o, x)
+        best = self._best[position_index(mine, theirs)]
+        self.moves += 1
+        if random.random() >= AI_LEVELS.get(level, 0.0):
+            return best
+        best_score = -self._values[position_index(theirs, mine | 1 << best)]
+        empty = FULL_BOARD_MASK & ~(mine | theirs)
+        worse = [cell for cell in range(CELLS_COUNT)
+                 if empty >> cell & 1 and -self._values[position_index(theirs, mine | 1 << cell)] < best_score]
+        if not worse:
+            return best
+        self.suboptimal_moves += 1
+        return random.choice(worse)
+
+    def stats(self) -> dict:
+        return {
+            "built": self.built,
+            "positions": self.positions,
+            "build_ms": round(self.build_ms, 1),
+            "moves": self.moves,
+            "suboptimal_moves": self.suboptimal_moves,
+        }
+
+
+ai_player = AiPlayer()
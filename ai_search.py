@@ -0,0 +1,185 @@
+import time
+
+from game_engine import BoardGeometry, MAX_BOARD_SIZE, board_geometry, default_win_length
+
+# Поиск хода бота на полях больше 3x3. Функции выполняются в процессах пула
+# (см. ai_service.py), поэтому модуль импортирует только game_engine: процессам
+# пула не нужны ни config, ни Telegram.
+
+WIN_SCORE = 1_000_000
+# Ветвление внутренних узлов: рассматриваются только лучшие по эвристике ходы
+BRANCH_LIMIT = 12
+# Как часто (в узлах) проверяется время
+TIME_CHECK_NODES = 512
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# Таблица транспозиций своя у каждого процесса пула:
+# ключ позиции -> (глубина, оценка, тип оценки, лучший ход)
+_table: dict[int, tuple[int, int, int, int]] = {}
+# Геометрия -> маски соседей каждой клетки (кандидаты в ходы)
+_neighbours: dict[BoardGeometry, tuple[int, ...]] = {}
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def neighbour_masks(geometry: BoardGeometry) -> tuple[int, ...]:
+    masks = _neighbours.get(geometry)
+    if masks is None:
+        size = geometry.size
+        masks = _neighbours[geometry] = tuple(
+            sum(1 << (r * size + c)
+                for r in range(max(0, row - 1), min(size, row + 2))
+                for c in range(max(0, col - 1), min(size, col + 2)))
+            for row in range(size) for col in range(size)
+        )
+    return masks
+
+
+def warm_up() -> int:
+    """Готовит геометрии и соседей для размеров по умолчанию (первая задача процесса пула)."""
+    for size in range(4, MAX_BOARD_SIZE + 1):
+        neighbour_masks(board_geometry(size, default_win_length(size)))
+    return len(_neighbours)
+
+
+def evaluate(geometry: BoardGeometry, mine: int, theirs: int) -> int:
+    """Статическая оценка для ходящего: открытые линии свои минус чужие."""
+    score = 0
+    for mask in geometry.line_masks:
+        a = (mine & mask).bit_count()
+        b = (theirs & mask).bit_count()
+        if a and not b:
+            score += 4 ** a
+        elif b and not a:
+            score -= 4 ** b
+    return score
+
+
+def ordered_moves(geometry: BoardGeometry, mine: int, theirs: int) -> list[int]:
+    """Свободные клетки рядом с камнями, от самых полезных: атака своих линий и защита от чужих.
+
+    Дешево (линии только через клетку), поэтому годится и как ход без поиска.
+    """
+    occupied = mine | theirs
+    if not occupied:
+        center = geometry.size // 2
+        return [center * geometry.size + center]
+    masks = neighbour_masks(geometry)
+    k = geometry.k
+    scored = []
+    for cell in range(geometry.cells):
+        if occupied >> cell & 1 or not masks[cell] & occupied:
+            continue
+        score = 0
+        for line in geometry.cell_lines[cell]:
+            mask = geometry.line_masks[line]
+            a = (mine & mask).bit_count()
+            b = (theirs & mask).bit_count()
+            if not b:
+                score += WIN_SCORE if a == k - 1 else 2 * 4 ** (a + 1)
+            if not a:
+                score += WIN_SCORE // 2 if b == k - 1 else 4 ** (b + 1)
+        scored.append((score, cell))
+    scored.sort(reverse=True)
+    return [cell for _, cell in scored]
+
+
+def _wins(geometry: BoardGeometry, side: int, cell: int) -> bool:
+    line_masks = geometry.line_masks
+    for line in geometry.cell_lines[cell]:
+        mask = line_masks[line]
+        if side & mask == mask:
+            return True
+    return False
+
+
+class _Search:
+    """Альфа-бета (negamax) одной позиции с общим сроком для всех итераций."""
+
+    def __init__(self, geometry: BoardGeometry, deadline: float, table_limit: int):
+        self.geometry = geometry
+        self.deadline = deadline
+        self.table_limit = table_limit
+        self.nodes = 0
+        self.salt = geometry.size << 4 | geometry.k
+
+    def negamax(self, mine: int, theirs: int, depth: int, alpha: int, beta: int, ply: int) -> int:
+        self.nodes += 1
+        if not self.nodes % TIME_CHECK_NODES and time.perf_counter() > self.deadline:
+            raise SearchTimeout
+        geometry = self.geometry
+        if depth == 0:
+            return evaluate(geometry, mine, theirs)
+
+        key = ((theirs << geometry.cells | mine) << 8) | self.salt
+        entry = _table.get(key)
+        tt_move = -1
+        if entry is not None:
+            tt_depth, tt_value, tt_flag, tt_move = entry
+            if tt_depth >= depth:
+                if tt_flag == EXACT:
+                    return tt_value
+                if tt_flag == LOWER and tt_value >= beta:
+                    return tt_value
+                if tt_flag == UPPER and tt_value <= alpha:
+                    return tt_value
+
+        moves = ordered_moves(geometry, mine, theirs)[:BRANCH_LIMIT]
+        if not moves:
+            return 0
+        if tt_move in moves:
+            moves.remove(tt_move)
+            moves.insert(0, tt_move)
+
+        original_alpha = alpha
+        best_value, best_move = -WIN_SCORE - 1, moves[0]
+        full = (mine | theirs).bit_count() + 1 == geometry.cells
+        for cell in moves:
+            played = mine | 1 << cell
+            if _wins(geometry, played, cell):
+                value = WIN_SCORE - ply
+            elif full:
+                value = 0
+            else:
+                value = -self.negamax(theirs, played, depth - 1, -beta, -alpha, ply + 1)
+            if value > best_value:
+                best_value, best_move = value, cell
+            if value > alpha:
+                alpha = value
+            if alpha >= beta:
+                break
+
+        flag = UPPER if best_value <= original_alpha else LOWER if best_value >= beta else EXACT
+        if len(_table) >= self.table_limit:
+            _table.clear()
+        _table[key] = (depth, best_value, flag, best_move)
+        return best_value
+
+
+def search_move(size: int, k: int, x: int, o: int, symbol: str, budget: float,
+                max_depth: int, table_limit: int) -> tuple[int, int, int, int]:
+    """Ход для `symbol` итеративным углублением в пределах `budget` секунд.
+
+    Глубина растет, пока хватает времени, не достигнут max_depth и исход не
+    ясен; результатом считается лучший ход последней завершенной итерации.
+    Возвращает (клетка, достигнутая глубина, узлов, записей в таблице процесса).
+    """
+    geometry = board_geometry(size, k)
+    mine, theirs = (x, o) if symbol == "X" else (o, x)
+    search = _Search(geometry, time.perf_counter() + budget, table_limit)
+    best = ordered_moves(geometry, mine, theirs)[0]
+    empty = geometry.cells - (mine | theirs).bit_count()
+    depth = 0
+    for next_depth in range(1, min(max_depth, empty) + 1):
+        try:
+            value = search.negamax(mine, theirs, next_depth, -WIN_SCORE - 1, WIN_SCORE + 1, 0)
+        except SearchTimeout:
+            break
+        depth = next_depth
+        key = ((theirs << geometry.cells | mine) << 8) | search.salt
+        best = _table[key][3] if key in _table else best
+        if abs(value) >= WIN_SCORE - geometry.cells:
+            break  # выигрыш или проигрыш уже найден, глубже искать нечего
+    return best, depth, search.nodes, len(_table)
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Awaitable, Callable
+
+import ai_search
+from config import (
+    AI_SEARCH_WORKERS,
+    AI_SEARCH_BUDGET_SECONDS,
+    AI_SEARCH_TABLE_SIZE,
+    AI_SEARCH_START_METHOD,
+    AI_SEARCH_LAG_INTERVAL,
+)
+from game_engine import BitBoard
+from metrics import AI_SEARCH_SECONDS, EVENT_LOOP_LAG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Уровень -> (наибольшая глубина, доля AI_SEARCH_BUDGET_SECONDS на ход)
+SEARCH_LEVELS = {"easy": (1, 0.1), "medium": (3, 0.4), "hard": (64, 1.0)}
+# Запас сверх срока поиска на очередь пула и передачу результата
+SEARCH_GRACE_SECONDS = 2.0
+
+
+class AiSearchService:
+    """Ходы бота на полях больше 3x3: поиск в пуле процессов, event loop свободен.
+
+    Альфа-бета с итеративным углублением (ai_search.py) занимает процессор
+    весь срок хода, поэтому выполняется в ProcessPoolExecutor; у каждого
+    процесса пула своя таблица транспозиций, которая живет между ходами.
+    Обработчик только ставит запрос (request) и сразу возвращается, найденный
+    ход передается в `on_move` из отдельной задачи.
+
+    На чат - не больше одного запроса: новый запрос и cancel отменяют прежний
+    (новая игра, сброс, вытеснение игры). Еще не начатый поиск снимается с
+    очереди пула; уже идущий доработает в своем процессе до срока, но его ход
+    выбрасывается. При любом сбое (пул не запустился или сломался, поиск
+    упал, не уложился в срок с запасом) ход выбирается эвристикой без
+    поиска (ai_search.ordered_moves). Пул создается при первом поиске.
+
+    Пока идут поиски, раз в `lag_interval` секунд замеряется задержка event
+    loop (event_loop_lag_seconds): по ней видно, что остальные чаты не ждут.
+    При WEB_WORKERS > 1 у каждого воркера uvicorn свой пул.
+    """
+
+    def __init__(self, workers: int = AI_SEARCH_WORKERS, budget: float = AI_SEARCH_BUDGET_SECONDS,
+                 table_size: int = AI_SEARCH_TABLE_SIZE, start_method: str = AI_SEARCH_START_METHOD,
+                 lag_interval: float = AI_SEARCH_LAG_INTERVAL):
+        self.workers = max(1, workers)
+        self.budget = budget
+        self.table_size = table_size
+        self.start_method = start_method
+        self.lag_interval = lag_interval
+        self._pool: ProcessPoolExecutor | None = None
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._monitor: asyncio.Task | None = None
+
+        self.searches = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.fallbacks = 0
+        self.nodes = 0
+        self.depth_total = 0
+        self.table_entries = 0
+        self.lag_max = 0.0
+        self.lag_samples = 0
+
+    def start(self) -> None:
+        if self._pool is not None:
+            return
+        context = multiprocessing.get_context(self.start_method)
+        if self.start_method == "forkserver":
+            context.set_forkserver_preload(["ai_search"])
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=context)
+        # Процессы запускаются заранее, чтобы первый ход не ждал их старта
+        for _ in range(self.workers):
+            self._pool.submit(ai_search.warm_up)
+        logger.info("AI search pool started: %s workers (%s), %.2fs per move", self.workers, self.start_method, self.budget)
+
+    async def stop(self) -> None:
+        for chat_id in list(self._tasks):
+            self.cancel(chat_id)
+        if self._monitor:
+            self._monitor.cancel()
+            await asyncio.gather(self._monitor, return_exceptions=True)
+            self._monitor = None
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown, wait=True, cancel_futures=True)
+
+    def request(self, chat_id: int, board: BitBoard, symbol: str, level: str,
+                on_move: Callable[[int], Awaitable[None]]) -> None:
+        """Запускает поиск хода `symbol`; по готовности вызывается on_move(клетка)."""
+        self.cancel(chat_id)
+        task = asyncio.create_task(
+            self._run(board.geometry, board.x, board.o, symbol, level, on_move), name=f"ai_search_{chat_id}"
+        )
+        self._tasks[chat_id] = task
+        task.add_done_callback(lambda done: self._forget(chat_id, done))
+        if self._monitor is None or self._monitor.done():
+            self._monitor = asyncio.create_task(self._monitor_lag(), name="ai_search_lag")
+
+    def _forget(self, chat_id: int, task: asyncio.Task) -> None:
+        if self._tasks.get(chat_id) is task:
+            del self._tasks[chat_id]
+
+    def cancel(self, chat_id: int) -> bool:
+        task = self._tasks.pop(chat_id, None)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        self.cancelled += 1
+        logger.debug("Cancelled bot move search in chat %s", chat_id)
+        return True
+
+    async def _run(self, geometry, x: int, o: int, symbol: str, level: str,
+                   on_move: Callable[[int], Awaitable[None]]) -> None:
+        cell = await self.search(geometry, x, o, symbol, level)
+        try:
+            await on_move(cell)
+        except Exception as e:
+            logger.error("Failed to play bot move %s: %s", cell, e, exc_info=True)
+
+    async def search(self, geometry, x: int, o: int, symbol: str, level: str) -> int:
+        """Клетка для хода `symbol`: поиск в пуле, при сбое пула - эвристика."""
+        max_depth, share = SEARCH_LEVELS.get(level, SEARCH_LEVELS["hard"])
+        budget = self.budget * share
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        self.searches += 1
+        pool = None
+        try:
+            self.start()
+            pool = self._pool
+            future = loop.run_in_executor(
+                pool, ai_search.search_move,
+                geometry.size, geometry.k, x, o, symbol, budget, max_depth, self.table_size,
+            )
+            cell, depth, nodes, self.table_entries = await asyncio.wait_for(future, budget + SEARCH_GRACE_SECONDS)
+        except Exception as e:
+            # Любой сбой пула (не запустился, упал процесс, исключение в поиске, срок) -
+            # ход все равно делается, иначе игрок ждал бы бота до вытеснения игры
+            outcome = "fallback"
+            self.fallbacks += 1
+            logger.error("Bot move search failed (%s: %s), playing heuristic move", type(e).__name__, e)
+            if isinstance(e, BrokenProcessPool) and pool is not None and self._pool is pool:
+                # Процесс пула упал: пул пересоздается для следующих запросов. Пул,
+                # уже пересозданный другим упавшим поиском, не трогаем
+                pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+                self.start()
+            mine, theirs = (x, o) if symbol == "X" else (o, x)
+            cell = ai_search.ordered_moves(geometry, mine, theirs)[0]
+        else:
+            outcome = "ok"
+            self.completed += 1
+            self.nodes += nodes
+            self.depth_total += depth
+            logger.debug("Bot move search: cell %s, depth %s, %s nodes", cell, depth, nodes)
+        AI_SEARCH_SECONDS.observe(time.perf_counter() - started, outcome)
+        return cell
+
+    async def _monitor_lag(self) -> None:
+        """Задержка event loop, пока есть запросы: насколько позже заказанного просыпается sleep."""
+        loop = asyncio.get_running_loop()
+        while self._tasks:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, loop.time() - expected)
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+            self.lag_samples += 1
+            if lag > self.lag_max:
+                self.lag_max = lag
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": self._pool is not None,
+            "in_flight": len(self._tasks),
+            "searches": self.searches,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "fallbacks": self.fallbacks,
+            "avg_depth": round(self.depth_total / self.completed, 1) if self.completed else 0.0,
+            "nodes": self.nodes,
+            "table_entries": self.table_entries,
+            "loop_lag_samples": self.lag_samples,
+            "loop_lag_max_ms": round(self.lag_max * 1000, 1),
+        }
+
+
+ai_service = AiSearchService()
@@ -0,0 +1,98 @@
+"""Задержка event loop, пока бот ищет ходы на больших полях: пул процессов против поиска в loop.
+
+--games игр с ботом одновременно запрашивают ходы подряд (поле --size, уровень
+hard, срок хода --budget). Параллельно проба раз в 10 мс
+засыпает на asyncio.sleep и меряет, насколько позже она проснулась, - столько
+же ждали бы обновления остальных чатов.
+
+  pool   - ходы через ai_service (ProcessPoolExecutor, как в боте);
+  inline - тот же ai_search.search_move прямо в event loop.
+
+Запуск: python benchmarks/bench_ai_search.py [--games 8] [--size 7] [--seconds 5] [--budget 0.3]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ai_search
+from ai_service import AiSearchService
+from game_engine import board_geometry
+from load_test import percentile
+
+PROBE_INTERVAL = 0.01
+
+
+async def probe(lags: list[float], stop: asyncio.Event) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + PROBE_INTERVAL
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def play(mode: str, service: AiSearchService, size: int, seconds: float, budget: float, seed: int) -> int:
+    """Одна игра: бот ходит за X, "человек" за O случайно; возвращает число ходов бота."""
+    rng = random.Random(seed)
+    geometry = board_geometry(size)
+    deadline = time.perf_counter() + seconds
+    moves = 0
+    x = o = 0
+    while time.perf_counter() < deadline:
+        if mode == "pool":
+            cell = await service.search(geometry, x, o, "X", "hard")
+        else:
+            cell = ai_search.search_move(size, geometry.k, x, o, "X", budget, 64, service.table_size)[0]
+            await asyncio.sleep(0)
+        moves += 1
+        x |= 1 << cell
+        free = [c for c in range(geometry.cells) if not (x | o) >> c & 1]
+        if len(free) < 2:
+            x = o = 0
+            continue
+        o |= 1 << rng.choice(free)
+    return moves
+
+
+async def run(mode: str, args) -> None:
+    service = AiSearchService(workers=args.workers, budget=args.budget)
+    if mode == "pool":
+        service.start()
+        await service.search(board_geometry(args.size), 0, 0, "X", "easy")  # процессы уже запущены
+    lags: list[float] = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    started = time.perf_counter()
+    moves = await asyncio.gather(*(
+        play(mode, service, args.size, args.seconds, args.budget, seed) for seed in range(args.games)
+    ))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe_task
+    await service.stop()
+    print(f"{mode:<7} bot moves {sum(moves):5d} in {elapsed:5.1f} s   probes {len(lags):5d}   loop lag p50 {percentile(lags, 0.5) * 1000:7.1f} ms"
+          f"   p99 {percentile(lags, 0.99) * 1000:7.1f} ms   max {max(lags, default=0.0) * 1000:7.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=8, help="concurrent games with the bot")
+    parser.add_argument("--size", type=int, default=7, help="board size (K is the default for the size)")
+    parser.add_argument("--seconds", type=float, default=5.0, help="duration of each mode")
+    parser.add_argument("--budget", type=float, default=0.3, help="search time per move, seconds")
+    parser.add_argument("--workers", type=int, default=2, help="pool processes")
+    parser.add_argument("--mode", choices=("pool", "inline", "both"), default="both")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    for mode in ("pool", "inline") if args.mode == "both" else (args.mode,):
+        asyncio.run(run(mode, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Бенчмарк выбора обработчика инлайн-кнопки: цепочка regex-хендлеров против callback_router.
+
+  chain  - пять CallbackQueryHandler с regex-паттернами, как было в bot.py:
+           PTB проверяет их по очереди, обработчик тем снова делает split;
+  router - один CallbackQueryHandler(callback_router.dispatch): parse один раз
+           и поиск обработчика в словаре.
+
+Обработчики пустые, поэтому замеряется только накладной расход на выбор.
+Два замера на каждый вид кнопки:
+
+  select  - только выбор (check_update по цепочке / parse + словарь);
+  process - Application.process_update целиком (контекст, группы хендлеров).
+
+Запуск: python benchmarks/bench_callback_router.py [--updates 20000]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TOKEN", "123456:benchmark")
+
+from telegram import Update
+from telegram.ext import Application, CallbackQueryHandler
+
+import callback_router as routes
+from bench_webhook_fast_path import _OfflineRequest
+from callback_sign import callback_signer
+
+KINDS = {
+    "noop": "noop",
+    "move": callback_signer.encode(1, "game1", 3, 4),
+    "new_game": "new_game",
+    "change_theme_prompt": "change_theme_prompt",
+    "theme_select_ingame": "theme_select_ingame_animals",
+    "cancel_theme_change": "cancel_theme_change",
+    "theme_select": "theme_select_food",
+}
+
+
+async def _noop(update, context, theme_key=None) -> None:
+    pass
+
+
+async def _split_ingame(update, context) -> None:
+    update.callback_query.data.split("theme_select_ingame_")[-1]
+
+
+async def _split_select(update, context) -> None:
+    update.callback_query.data.split("theme_select_")[-1]
+
+
+def chain_handlers() -> list[CallbackQueryHandler]:
+    return [
+        CallbackQueryHandler(_noop, pattern=r"^(noop|[0-8]|new_game|m:.+)$"),
+        CallbackQueryHandler(_noop, pattern=r"^change_theme_prompt$"),
+        CallbackQueryHandler(_split_ingame, pattern=r"^theme_select_ingame_"),
+        CallbackQueryHandler(_noop, pattern=r"^cancel_theme_change$"),
+        CallbackQueryHandler(_split_select, pattern=r"^theme_select_"),
+    ]
+
+
+def router_handlers() -> list[CallbackQueryHandler]:
+    router = routes.CallbackRouter()
+    for route in (routes.BOARD, routes.CHANGE_THEME_PROMPT, routes.THEME_SELECT_INGAME,
+                  routes.CANCEL_THEME_CHANGE, routes.THEME_SELECT):
+        router.add(route, _noop)
+    return [CallbackQueryHandler(router.dispatch)]
+
+
+def make_update(n: int, data: str) -> Update:
+    return Update.de_json({
+        "update_id": n,
+        "callback_query": {
+            "id": str(n),
+            "from": {"id": 10, "is_bot": False, "first_name": "player"},
+            "chat_instance": "1",
+            "data": data,
+            "message": {
+                "message_id": 1000, "date": 0, "chat": {"id": 1, "type": "group", "title": "bench"},
+                "from": {"id": 123456, "is_bot": True, "first_name": "bench"}, "text": "🎲",
+            },
+        },
+    }, None)
+
+
+def select_chain(handlers: list[CallbackQueryHandler], update: Update) -> None:
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            if handler.callback is _split_ingame:
+                update.callback_query.data.split("theme_select_ingame_")[-1]
+            elif handler.callback is _split_select:
+                update.callback_query.data.split("theme_select_")[-1]
+            return
+
+
+def select_router(routes_table: dict, update: Update) -> None:
+    action = routes.parse(update.callback_query.data)
+    routes_table.get(action.route)
+
+
+async def run(updates: int) -> dict[str, dict[str, float]]:
+    results = {}
+    for name, handlers in (("chain", chain_handlers()), ("router", router_handlers())):
+        application = (
+            Application.builder()
+            .token(os.environ["TOKEN"])
+            .request(_OfflineRequest())
+            .get_updates_request(_OfflineRequest())
+            .job_queue(None)
+            .build()
+        )
+        application.add_handlers(handlers)
+        await application.initialize()
+        routes_table = {route: _noop for route in (routes.BOARD, routes.CHANGE_THEME_PROMPT, routes.THEME_SELECT_INGAME,
+                                                   routes.CANCEL_THEME_CHANGE, routes.THEME_SELECT)}
+
+        for kind, data in KINDS.items():
+            batch = [make_update(n, data) for n in range(updates)]
+            for update in batch:
+                update.set_bot(application.bot)
+
+            started = time.perf_counter()
+            if name == "chain":
+                for update in batch:
+                    select_chain(handlers, update)
+            else:
+                for update in batch:
+                    select_router(routes_table, update)
+            select = (time.perf_counter() - started) / updates
+
+            started = time.perf_counter()
+            for update in batch:
+                await application.process_update(update)
+            process = (time.perf_counter() - started) / updates
+            results.setdefault(kind, {})[f"{name}_select"] = select
+            results[kind][f"{name}_process"] = process
+
+        await application.shutdown()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--updates", type=int, default=20_000)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    results = asyncio.run(run(args.updates))
+    print(f"{'button':<22}{'select chain':>14}{'router':>10}{'process chain':>16}{'router':>10}  (us/update)")
+    for kind, r in results.items():
+        print(f"{kind:<22}{r['chain_select'] * 1e6:14.2f}{r['router_select'] * 1e6:10.2f}"
+              f"{r['chain_process'] * 1e6:16.2f}{r['router_process'] * 1e6:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
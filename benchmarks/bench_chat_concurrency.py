@@ -0,0 +1,200 @@
+"""Нагрузочный тест обработки обновлений: последовательно против параллельно по чатам.
+
+N чатов присылают по K нажатий кнопок. Обработчик имитирует типичный путь
+button_click: читает состояние игры, ждет ответа Bot API (--latency
+секунд, как await outbound.answer / RetryAfter), затем записывает
+состояние. Обновления идут через UpdateQueue и настоящий PTB Application:
+
+  sequential - 1 обработчик, как было раньше;
+  per-chat   - --workers обработчиков и PerChatUpdateProcessor;
+
+  queue only - --workers обработчиков без блокировок чата: порядок держат
+               только ящики чатов в UpdateQueue.
+
+Кроме пропускной способности проверяется корректность: нажатия одного
+чата должны обработаться по порядку и без потерянных записей (гонка
+чтение-await-запись без очереди по чатам теряет ходы).
+
+Горячий чат (hot chat): --hot-updates нажатий одного чата, каждое
+обрабатывается --hot-latency секунд, а за ними одно нажатие другого чата.
+Оно не должно ждать горячий чат: задержка до начала обработки - около нуля,
+а не сумма обработки горячего чата на число обработчиков.
+
+Запуск: python benchmarks/bench_chat_concurrency.py [--chats 200] [--clicks 10] [--workers 32]
+        [--hot-updates 20] [--hot-latency 0.5]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import Application, CallbackQueryHandler, SimpleUpdateProcessor
+from telegram.request import BaseRequest
+
+from chat_locks import PerChatUpdateProcessor
+from update_queue import UpdateQueue
+
+
+class _OfflineRequest(BaseRequest):
+    """Bot API без сети: на любой запрос (нужен только getMe при initialize) отвечает профилем бота."""
+
+    _ME = json.dumps({"ok": True, "result": {
+        "id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+    }}).encode()
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        return 200, self._ME
+
+
+def make_update(bot, update_id: int, chat_id: int, seq: int) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "player"},
+            "chat_instance": str(chat_id),
+            "data": str(seq),
+            "message": {"message_id": 1, "date": 0, "chat": {"id": -chat_id, "type": "group"}},
+        },
+    }, bot)
+
+
+async def make_application(processor) -> Application:
+    application = (
+        Application.builder()
+        .token("123456:benchmark")
+        .request(_OfflineRequest())
+        .get_updates_request(_OfflineRequest())
+        .job_queue(None)
+        .concurrent_updates(processor)
+        .build()
+    )
+    await application.initialize()
+    return application
+
+
+async def run(processor, workers: int, chats: int, clicks: int, latency: float) -> dict:
+    application = await make_application(processor)
+    moves: dict[int, int] = {}
+    order_violations = 0
+    done = asyncio.Event()
+    total = chats * clicks
+    processed = 0
+
+    async def on_click(update: Update, context) -> None:
+        nonlocal order_violations, processed
+        chat_id = update.effective_chat.id
+        seq = int(update.callback_query.data)
+        current = moves.get(chat_id, 0)  # чтение состояния
+        if seq != current:
+            order_violations += 1
+        await asyncio.sleep(latency)  # ответ Bot API
+        moves[chat_id] = current + 1  # запись состояния
+        processed += 1
+        if processed == total:
+            done.set()
+
+    application.add_handler(CallbackQueryHandler(on_click))
+    queue = UpdateQueue(application, maxsize=total + 1, workers=workers)
+    # Чаты перемешаны случайно (порядок внутри чата сохраняется), поэтому
+    # нажатия одного чата нередко стоят в очереди рядом, как двойной клик
+    rng = random.Random(1)
+    remaining = {chat: 0 for chat in range(1, chats + 1)}
+    updates = []
+    while remaining:
+        chat = rng.choice(list(remaining))
+        updates.append(make_update(application.bot, len(updates) + 1, chat, remaining[chat]))
+        remaining[chat] += 1
+        if remaining[chat] == clicks:
+            del remaining[chat]
+
+    queue.start()
+    started = time.perf_counter()
+    for update in updates:
+        queue.submit(update)
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    await queue.stop()
+    await application.shutdown()
+
+    lost = total - sum(moves.values())
+    return {"updates_per_s": total / elapsed, "elapsed": elapsed, "order_violations": order_violations, "lost_moves": lost}
+
+
+async def run_hot_chat(workers: int, hot_updates: int, hot_latency: float) -> dict:
+    """Сколько ждет нажатие другого чата, поставленное за нажатиями горячего чата."""
+    application = await make_application(PerChatUpdateProcessor(workers))
+    hot_chat, other_chat = 1, 2
+    submitted: dict[int, float] = {}
+    other_wait = None
+    other_done = asyncio.Event()
+
+    async def on_click(update: Update, context) -> None:
+        nonlocal other_wait
+        if update.effective_chat.id == -other_chat:
+            other_wait = time.perf_counter() - submitted[update.update_id]
+            other_done.set()
+            return
+        await asyncio.sleep(hot_latency)
+
+    application.add_handler(CallbackQueryHandler(on_click))
+    queue = UpdateQueue(application, maxsize=hot_updates + 2, workers=workers)
+    queue.start()
+    for seq in range(hot_updates):
+        queue.submit(make_update(application.bot, seq + 1, hot_chat, seq))
+    await asyncio.sleep(0)  # обработчики уже разобрали очередь
+    submitted[hot_updates + 1] = time.perf_counter()
+    queue.submit(make_update(application.bot, hot_updates + 1, other_chat, 0))
+    await other_done.wait()
+    await queue.stop(drain_timeout=0)
+    await application.shutdown()
+    return {"other_wait": other_wait}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--clicks", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--hot-updates", type=int, default=20)
+    parser.add_argument("--hot-latency", type=float, default=0.5)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    sequential = asyncio.run(run(SimpleUpdateProcessor(1), 1, args.chats, args.clicks, args.latency))
+    per_chat = asyncio.run(run(PerChatUpdateProcessor(args.workers), args.workers, args.chats, args.clicks, args.latency))
+    unlocked = asyncio.run(run(SimpleUpdateProcessor(args.workers), args.workers, args.chats, args.clicks, args.latency))
+
+    for name, result in (("sequential", sequential), (f"per-chat x{args.workers}", per_chat),
+                         (f"queue only x{args.workers}", unlocked)):
+        print(f"{name:<16} {result['updates_per_s']:8.0f} updates/s  ({result['elapsed']:.2f} s), "
+              f"out of order: {result['order_violations']}, lost moves: {result['lost_moves']}")
+    print(f"speedup per-chat vs sequential: {per_chat['updates_per_s'] / sequential['updates_per_s']:.1f}x")
+
+    hot = asyncio.run(run_hot_chat(args.workers, args.hot_updates, args.hot_latency))
+    verdict = "ok" if hot["other_wait"] < args.hot_latency else "BLOCKED by hot chat"
+    print(f"hot chat ({args.hot_updates} x {args.hot_latency}s): other chat waited "
+          f"{hot['other_wait'] * 1000:.1f} ms - {verdict}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Микробенчмарк: проверка результата хода старым check_winner против BitBoard.play.
+
+Запуск: python benchmarks/bench_engine.py [--games N]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_engine import BitBoard, DRAW
+
+
+def legacy_check_winner(board):
+    """Копия check_winner до перехода на битовые маски (эталон для сравнения)."""
+    win_combinations = [
+        [0, 1, 2], [3, 4, 5], [6, 7, 8],
+        [0, 3, 6], [1, 4, 7], [2, 5, 8],
+        [0, 4, 8], [2, 4, 6]
+    ]
+    for combo in win_combinations:
+        if board[combo[0]] == board[combo[1]] == board[combo[2]] and not isinstance(board[combo[0]], int):
+            return board[combo[0]], combo
+    if not any(isinstance(cell, int) for cell in board):
+        return "Ничья", None
+    return None, None
+
+
+def random_games(count: int, seed: int = 42) -> list[list[int]]:
+    rng = random.Random(seed)
+    games = []
+    for _ in range(count):
+        cells = list(range(9))
+        rng.shuffle(cells)
+        games.append(cells)
+    return games
+
+
+def run_legacy(games) -> int:
+    moves = 0
+    for order in games:
+        board = list(range(1, 10))
+        symbol = "X"
+        for cell in order:
+            board[cell] = symbol
+            moves += 1
+            winner, _ = legacy_check_winner(board)
+            if winner:
+                break
+            symbol = "O" if symbol == "X" else "X"
+    return moves
+
+
+def run_bitboard(games) -> int:
+    moves = 0
+    for order in games:
+        board = BitBoard()
+        symbol = "X"
+        for cell in order:
+            moves += 1
+            winner, _ = board.play(cell, symbol)
+            if winner:
+                break
+            symbol = "O" if symbol == "X" else "X"
+    return moves
+
+
+def verify(games) -> None:
+    """Оба движка должны давать одинаковый результат на каждом ходу."""
+    for order in games:
+        board = list(range(1, 10))
+        bitboard = BitBoard()
+        symbol = "X"
+        for cell in order:
+            board[cell] = symbol
+            expected = legacy_check_winner(board)
+            actual = bitboard.play(cell, symbol)
+            assert expected[0] == actual[0], (order, expected, actual)
+            if expected[0] and expected[0] != DRAW:
+                assert board[expected[1][0]] == board[actual[1][0]] == symbol
+            if expected[0]:
+                break
+            symbol = "O" if symbol == "X" else "X"
+
+
+def measure(func, games, repeat: int) -> tuple[float, int]:
+    best = float("inf")
+    moves = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        moves = func(games)
+        best = min(best, time.perf_counter() - started)
+    return best, moves
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--games", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    games = random_games(args.games)
+    verify(games)
+
+    legacy_time, moves = measure(run_legacy, games, args.repeat)
+    bitboard_time, _ = measure(run_bitboard, games, args.repeat)
+    legacy_ns = legacy_time / moves * 1e9
+    bitboard_ns = bitboard_time / moves * 1e9
+    print(f"moves: {moves}")
+    print(f"check_winner (list):  {legacy_ns:8.1f} ns/move")
+    print(f"BitBoard.play:        {bitboard_ns:8.1f} ns/move")
+    print(f"speedup:              {legacy_ns / bitboard_ns:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Бенчмарк памяти на одну игру: словарь со вложенными словарями против GameState.
+
+Моделируются N одновременных игр в середине партии (оба игрока в игре,
+сделано несколько ходов). Старая запись - словарь с доской-списком из 9
+клеток, словарями `players`/`user_symbols`/`usernames`, ссылкой на словарь
+темы и объектом задачи таймаута. Память считается через tracemalloc.
+
+Запуск: python benchmarks/bench_game_state.py [--games 100000 1000000]
+"""
+import argparse
+import gc
+import logging
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import THEMES, DEFAULT_THEME_KEY
+from game_state import GameState
+
+MOVES = ((4, "X"), (0, "O"), (8, "X"))
+
+
+class _FakeJob:
+    """Заменитель telegram.ext.Job: у настоящего объекта еще и задача APScheduler."""
+
+    def __init__(self, name: str, data: dict):
+        self.name = name
+        self.data = data
+        self.enabled = True
+        self.removed = False
+
+
+def _username(user_id: int) -> str:
+    # Имена приходят из каждого апдейта заново, как отдельные строки
+    return "".join(("player_", str(user_id)))
+
+
+def make_legacy(n: int) -> dict:
+    x_id, o_id = 100_000_000 + n, 200_000_000 + n
+    board = list(range(1, 10))
+    for cell, symbol in MOVES:
+        board[cell] = symbol
+    return {
+        "board": board,
+        "current_player": "O",
+        "game_over": False,
+        "players": {"X": x_id, "O": o_id},
+        "user_symbols": {x_id: "X", o_id: "O"},
+        "usernames": {x_id: _username(x_id), o_id: _username(o_id)},
+        "message_id": 1000 + n,
+        "theme_emojis": THEMES[DEFAULT_THEME_KEY],
+        "timeout_job": _FakeJob(f"game_timeout_{n}", {"chat_id": n, "message_id": 1000 + n}),
+    }
+
+
+def make_slotted(n: int) -> GameState:
+    x_id, o_id = 100_000_000 + n, 200_000_000 + n
+    game = GameState("X", x_id, _username(x_id), DEFAULT_THEME_KEY)
+    game.join("O", o_id, _username(o_id))
+    for cell, symbol in MOVES:
+        game.board.play(cell, symbol)
+    game.current_player = "O"
+    game.message_id = 1000 + n
+    return game
+
+
+def measure(factory, count: int) -> float:
+    """Байт на игру (вместе с записью в словаре games)."""
+    gc.collect()
+    tracemalloc.start()
+    games = {chat_id: factory(chat_id) for chat_id in range(-count, 0)}
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del games
+    gc.collect()
+    return used / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--games", type=int, nargs="+", default=[100_000, 1_000_000])
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    for count in args.games:
+        legacy = measure(make_legacy, count)
+        slotted = measure(make_slotted, count)
+        print(f"{count} games: dict {legacy:.0f} B/game ({legacy * count / 2**20:.1f} MiB), "
+              f"GameState {slotted:.0f} B/game ({slotted * count / 2**20:.1f} MiB), "
+              f"reduction {legacy / slotted:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
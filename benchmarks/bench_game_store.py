@@ -0,0 +1,94 @@
+"""Бенчмарк хранилищ игр: ходов в секунду для памяти и SQLite (WAL).
+
+Сценарий: N чатов играют одновременно, ходы идут по кругу по всем чатам,
+каждая партия после окончания начинается заново. Ход - это чтение игры из
+хранилища, BitBoard.play и mark_dirty, как в обработчике кнопки.
+
+Для SQLite интервал сброса моделируется по реальному времени: раз в
+--flush-interval секунд вызывается flush(), плюс внеплановые сбросы по
+порогу грязных записей. Для сравнения есть режим записи на каждый ход
+(--write-through), т.е. по транзакции на ход.
+
+Запуск: python benchmarks/bench_game_store.py [--chats 10000] [--moves 200000]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_state import GameState
+from game_store import GameStore, MemoryGameStore, SQLiteGameStore
+
+# Порядок ходов одной партии (X выигрывает седьмым ходом)
+SCRIPT = (4, 0, 8, 2, 1, 6, 7)
+
+
+def new_game(chat_id: int) -> GameState:
+    game = GameState("X", chat_id, f"player_{chat_id}")
+    game.join("O", -chat_id, f"player_{-chat_id}")
+    game.message_id = chat_id
+    return game
+
+
+def run(store: GameStore, chats: int, moves: int, flush_interval: float | None) -> float:
+    for chat_id in range(1, chats + 1):
+        store[chat_id] = new_game(chat_id)
+    if isinstance(store, SQLiteGameStore):
+        store.flush()
+    steps = [0] * (chats + 1)
+
+    started = time.perf_counter()
+    next_flush = started + flush_interval if flush_interval else None
+    for n in range(moves):
+        chat_id = n % chats + 1
+        game = store[chat_id]
+        winner, _ = game.board.play(SCRIPT[steps[chat_id]], game.current_player)
+        steps[chat_id] += 1
+        if winner:
+            store[chat_id] = new_game(chat_id)
+            steps[chat_id] = 0
+        else:
+            game.current_player = game.waiting_player
+            store.mark_dirty(chat_id)
+        if next_flush is not None and n % 256 == 0 and time.perf_counter() >= next_flush:
+            store.flush()
+            next_flush = time.perf_counter() + flush_interval
+    if isinstance(store, SQLiteGameStore):
+        store.flush()
+    return moves / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=10_000)
+    parser.add_argument("--moves", type=int, default=200_000)
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+    parser.add_argument("--flush-threshold", type=int, default=200)
+    parser.add_argument("--write-through", action="store_true", help="также замерить SQLite с транзакцией на каждый ход")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    memory = run(MemoryGameStore(), args.chats, args.moves, None)
+    print(f"memory:                  {memory:,.0f} moves/s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteGameStore(os.path.join(tmp, "batched.db"), args.flush_interval, args.flush_threshold)
+        batched = run(store, args.chats, args.moves, args.flush_interval)
+        print(f"sqlite write-behind:     {batched:,.0f} moves/s "
+              f"({store.flushes} flushes, {store.rows_written} rows, last flush {store.last_flush_ms:.1f} ms)")
+        asyncio.run(store.stop())
+
+        if args.write_through:
+            store = SQLiteGameStore(os.path.join(tmp, "through.db"), args.flush_interval, 1)
+            through = run(store, args.chats, min(args.moves, 20_000), None)
+            print(f"sqlite write-through:    {through:,.0f} moves/s ({store.flushes} flushes)")
+            asyncio.run(store.stop())
+
+
+if __name__ == "__main__":
+    main()
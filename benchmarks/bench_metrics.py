@@ -0,0 +1,83 @@
+"""Бенчмарк накладных расходов метрик (metrics.py).
+
+  observe    - Histogram.observe с меткой (то, что делается на каждое обновление,
+               обработчик и запрос к Bot API);
+  inc        - Counter.inc с меткой;
+  middleware - вызов пустого ASGI-приложения с MetricsMiddleware и без него;
+  render     - выгрузка /metrics с заданным числом рядов гистограммы.
+
+Запуск: python benchmarks/bench_metrics.py [--iterations 200000] [--series 50]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Counter, Histogram, MetricsMiddleware, MetricsRegistry
+
+
+async def _empty_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def _send(message):
+    pass
+
+
+async def asgi_cost(app, iterations: int) -> float:
+    scope = {"type": "http", "path": "/webhook", "method": "POST"}
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await app(scope, _receive, _send)
+    return (time.perf_counter() - started) / iterations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200_000)
+    parser.add_argument("--series", type=int, default=50)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    n = args.iterations
+
+    histogram = Histogram("bench_seconds", "bench", ("route",))
+    values = [(i % 1000) / 10000 for i in range(n)]
+    started = time.perf_counter()
+    for value in values:
+        histogram.observe(value, "board")
+    observe = (time.perf_counter() - started) / n
+
+    counter = Counter("bench_total", "bench", ("outcome",))
+    started = time.perf_counter()
+    for _ in range(n):
+        counter.inc("fast_path")
+    inc = (time.perf_counter() - started) / n
+
+    bare = asyncio.run(asgi_cost(_empty_app, n // 4))
+    wrapped = asyncio.run(asgi_cost(MetricsMiddleware(_empty_app, paths=("/webhook",)), n // 4))
+
+    registry = MetricsRegistry()
+    wide = registry.histogram("bench_route_seconds", "bench", ("route",))
+    for series in range(args.series):
+        wide.observe(0.01, f"route{series}")
+    started = time.perf_counter()
+    text = registry.render()
+    render = time.perf_counter() - started
+
+    print(f"observe:    {observe * 1e9:8.0f} ns")
+    print(f"inc:        {inc * 1e9:8.0f} ns")
+    print(f"middleware: {(wrapped - bare) * 1e6:8.2f} us per request ({bare * 1e6:.2f} -> {wrapped * 1e6:.2f} us)")
+    print(f"render:     {render * 1e3:8.2f} ms for {args.series} series ({len(text)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Масштабирование по воркерам: общая таблица игр в shared memory.
+
+Каждый воркер - отдельный процесс, как воркер uvicorn. Он разбирает JSON
+нажатия кнопки (как вебхук), берет полосу чата через games.exclusive,
+читает игру из SharedMemoryGameStore, делает BitBoard.play и mark_dirty.
+Чаты поделены между воркерами не по модулю, а вперемешку: любой воркер
+может получить любой чат, поэтому блокировки и перечитывание версий
+работают так же, как в бою.
+
+Печатается суммарное число ходов в секунду для 1..--max-workers процессов
+и проверка, что ни один ход не потерян: каждый ход увеличивает счетчик в
+message_id игры, в конце сумма счетчиков должна совпасть с числом ходов.
+
+Запуск: python benchmarks/bench_shared_workers.py [--chats 2000] [--moves 100000] [--max-workers 4]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_state import GameState
+from shared_store import SharedMemoryGameStore
+
+PAYLOAD = json.dumps({
+    "update_id": 1,
+    "callback_query": {
+        "id": "1", "from": {"id": 1, "is_bot": False, "first_name": "player"}, "chat_instance": "1",
+        "data": "4", "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "group"}},
+    },
+}).encode()
+
+
+def new_game(chat_id: int, moves: int = 0) -> GameState:
+    game = GameState("X", chat_id, f"player_{chat_id}")
+    game.join("O", -chat_id, f"player_{-chat_id}")
+    game.message_id = moves + 1  # счетчик ходов чата + 1 (0 в таблице означает "нет сообщения")
+    return game
+
+
+def play(store: SharedMemoryGameStore, chat_id: int) -> None:
+    """Один ход: первая свободная клетка, после конца партии - новая партия."""
+    game = store.get(chat_id)
+    cell = next(cell for cell in range(9) if game.board.is_free(cell))
+    winner, _ = game.board.play(cell, game.current_player)
+    if winner:
+        store[chat_id] = new_game(chat_id, game.message_id)
+        return
+    game.message_id += 1
+    game.current_player = game.waiting_player
+    store.mark_dirty(chat_id)
+
+
+async def worker_loop(store: SharedMemoryGameStore, chats: int, moves: int, seed: int) -> None:
+    chat_id = seed
+    for _ in range(moves):
+        update = json.loads(PAYLOAD)
+        chat_id = (chat_id * 1103515245 + 12345 + update["update_id"]) % chats + 1
+        async with store.exclusive(chat_id):
+            play(store, chat_id)
+
+
+def worker(name: str, slots: int, chats: int, moves: int, seed: int, start, results) -> None:
+    logging.disable(logging.INFO)
+    store = SharedMemoryGameStore(name, slots)
+    start.wait()
+    started = time.perf_counter()
+    asyncio.run(worker_loop(store, chats, moves, seed))
+    results.put((time.perf_counter() - started, store.lock_waits, store.reloads))
+    asyncio.run(store.stop())
+
+
+def run(workers: int, chats: int, moves: int) -> dict:
+    name = f"bench_games_{uuid.uuid4().hex[:8]}"
+    slots = max(1024, chats * 2)
+    store = SharedMemoryGameStore(name, slots)
+    for chat_id in range(1, chats + 1):
+        store[chat_id] = new_game(chat_id)
+
+    context = multiprocessing.get_context("fork" if sys.platform != "win32" else "spawn")
+    start = context.Event()
+    results = context.Queue()
+    per_worker = moves // workers
+    processes = [
+        context.Process(target=worker, args=(name, slots, chats, per_worker, n * 7919 + 1, start, results))
+        for n in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    started = time.perf_counter()
+    start.set()
+    stats = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+
+    lost = per_worker * workers - sum(store.get(chat_id).message_id - 1 for chat_id in range(1, chats + 1))
+    asyncio.run(store.stop())
+    store.unlink()
+    return {
+        "moves_per_s": per_worker * workers / elapsed,
+        "lost_moves": lost,
+        "lock_waits": sum(s[1] for s in stats),
+        "reloads": sum(s[2] for s in stats),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--moves", type=int, default=100_000)
+    parser.add_argument("--max-workers", type=int, default=min(4, os.cpu_count() or 1))
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    base = None
+    for workers in range(1, args.max_workers + 1):
+        result = run(workers, args.chats, args.moves)
+        base = base or result["moves_per_s"]
+        print(f"{workers} worker(s): {result['moves_per_s']:10,.0f} moves/s  "
+              f"(x{result['moves_per_s'] / base:.2f}, lock waits {result['lock_waits']}, "
+              f"reloads {result['reloads']}, lost moves {result['lost_moves']})")
+
+
+if __name__ == "__main__":
+    main()
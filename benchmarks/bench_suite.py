@@ -0,0 +1,331 @@
+"""Набор бенчмарков горячих путей игры с записью в bench_output.txt.
+
+Случаи:
+  check_winner[...]     - game_logic.check_winner на позиции середины и конца игры;
+  bitboard_play         - ход с проверкой результата (BitBoard.play);
+  get_keyboard[...]     - клавиатура игры из кэша с подписью кнопок (bot.get_keyboard)
+                          и построение без кэша (render_cache.build_keyboard);
+  get_symbol_emoji      - эмодзи символа по теме;
+  ai_choose_move[...]   - ход компьютерного соперника по таблице (ai_player.py);
+  game_turn_text        - Markdown-текст сообщения после хода (bot.game_turn_text);
+  de_json[callback]     - json.loads + Update.de_json нажатия с клавиатурой в сообщении
+                          ([callback_parsed] - только Update.de_json);
+  full_game             - вся игра через обработчики PTB (/newgame, присоединение,
+                          ходы до конца) с офлайн-ботом (fake_bot_api.OfflineBotApiRequest),
+                          включая исходящие запросы планировщика.
+
+Каждый случай калибруется до --min-time секунд на повтор, делается прогрев и
+--repeats повторов с выключенным GC. В файл пишется по строке на случай:
+имя, медиана, минимум (нс на операцию), разброс в % и число итераций -
+колонки фиксированы, строки отсортированы по имени.
+
+  python benchmarks/bench_suite.py                       # bench_output.txt в корне репозитория
+  python benchmarks/bench_suite.py --compare old.txt     # сравнение с прошлым прогоном
+
+С --compare выводится отношение медиан, и код выхода 1, если какой-то случай
+стал медленнее больше чем на --threshold процентов (для проверки перед деплоем).
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("TOKEN", "123456:benchmark")
+# Полная игра меряет бота, а не лимиты Telegram
+os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "1000000")
+os.environ.setdefault("OUTBOUND_GROUP_RATE_PER_MINUTE", "1000000")
+os.environ.setdefault("UPDATE_DEDUPE_PATH", "")
+os.environ.setdefault("GAME_STORE", "memory")
+
+import telegram
+from telegram import Update
+
+import bot
+from ai_player import ai_player
+from callback_sign import callback_signer
+from fake_bot_api import FakeBotApi, OfflineBotApiRequest, BOT_USER
+from game_engine import BitBoard
+from game_logic import check_winner, get_symbol_emoji
+from game_state import GameState
+from game_store import games
+from outbound import outbound
+from render_cache import build_keyboard, keyboard_cache
+
+CHAT_ID = -100123
+GAME_CHAT_ID = -100456  # чат полной игры, отдельно от игры микробенчмарков
+PLAYER_X, PLAYER_O = 1001, 1002
+
+
+def timed_loop(fn, loops: int) -> float:
+    started = time.perf_counter_ns()
+    for _ in range(loops):
+        fn()
+    return time.perf_counter_ns() - started
+
+
+def run_case(fn, min_time: float, repeats: int) -> tuple[list[float], int]:
+    """Наносекунды на операцию для каждого повтора и число операций в повторе."""
+    loops = 1
+    while True:
+        elapsed = timed_loop(fn, loops)
+        if elapsed >= min_time * 1e9 or loops >= 1 << 24:
+            break
+        loops *= 2 if elapsed < min_time * 1e8 else max(2, int(min_time * 1e9 / max(elapsed, 1)) + 1)
+    timed_loop(fn, loops)  # прогрев
+    samples = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            samples.append(timed_loop(fn, loops) / loops)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return samples, loops
+
+
+# --- Позиции и данные ---
+
+def mid_game_board() -> BitBoard:
+    board = BitBoard()
+    for cell, symbol in ((4, "X"), (0, "O"), (8, "X"), (2, "O")):
+        board.play(cell, symbol)
+    return board
+
+
+def won_board() -> BitBoard:
+    board = BitBoard()
+    for cell, symbol in ((0, "X"), (3, "O"), (1, "X"), (4, "O"), (2, "X")):
+        board.play(cell, symbol)
+    return board
+
+
+def make_game() -> GameState:
+    game = GameState("X", PLAYER_X, "alice_player", "classic")
+    game.join("O", PLAYER_O, "bob_player")
+    game.message_id = 77
+    for cell, symbol in ((4, "X"), (0, "O")):
+        game.board.play(cell, symbol)
+    return game
+
+
+def callback_payload() -> bytes:
+    """Нажатие на подписанную кнопку: в message - текст с разметкой и вся клавиатура игры."""
+    game = games[CHAT_ID]
+    markup = bot.get_keyboard(CHAT_ID)
+    return json.dumps({
+        "update_id": 500000001,
+        "callback_query": {
+            "id": "4382000000000000001",
+            "from": {"id": PLAYER_X, "is_bot": False, "first_name": "Alice", "username": "alice_player",
+                     "language_code": "ru"},
+            "chat_instance": "-5000000000000000001",
+            "data": callback_signer.encode(CHAT_ID, game.game_id, game.board.moves, 8),
+            "message": {
+                "message_id": game.message_id, "date": 1760000000,
+                "chat": {"id": CHAT_ID, "type": "supergroup", "title": "Крестики-нолики"},
+                "from": BOT_USER,
+                "text": bot.game_turn_text(game),
+                "entities": [{"type": "bold", "offset": 3, "length": 10}],
+                "reply_markup": markup.to_dict(),
+            },
+        },
+    }).encode()
+
+
+# --- Полная игра через обработчики ---
+
+class GameSimulation:
+    """Одна игра через Application.process_update: /newgame, присоединение и ходы.
+
+    Клетки берутся по кругу из фиксированного набора партий (победа первого,
+    победа второго и ничья), ходит тот, чья очередь; после каждого обновления
+    ждем, пока планировщик отправит все запросы.
+    """
+
+    ORDERS = ((0, 3, 1, 4, 2), (0, 4, 1, 2, 8, 6), (4, 0, 8, 2, 1, 7, 6, 3, 5))
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.api = FakeBotApi()
+        self.application = bot.build_application(OfflineBotApiRequest(self.api))
+        loop.run_until_complete(self.application.initialize())
+        self.update_id = 0
+        self.played = 0
+
+    def _update(self, payload: dict) -> Update:
+        self.update_id += 1
+        return Update.de_json({"update_id": self.update_id, **payload}, self.application.bot)
+
+    def _command(self, user_id: int, text: str) -> Update:
+        return self._update({"message": {
+            "message_id": self.update_id + 1, "date": 1760000000,
+            "chat": {"id": GAME_CHAT_ID, "type": "supergroup", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"p{user_id}", "username": f"player_{user_id}"},
+            "text": text, "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        }})
+
+    def _click(self, user_id: int, cell: int) -> Update:
+        game = games[GAME_CHAT_ID]
+        return self._update({"callback_query": {
+            "id": str(self.update_id + 1),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"p{user_id}", "username": f"player_{user_id}"},
+            "chat_instance": "1",
+            "data": callback_signer.encode(GAME_CHAT_ID, game.game_id, game.board.moves, cell),
+            "message": {"message_id": game.message_id, "date": 1760000000,
+                        "chat": {"id": GAME_CHAT_ID, "type": "supergroup", "title": "bench"},
+                        "from": BOT_USER, "text": "🎲"},
+        }})
+
+    async def _process(self, update: Update) -> None:
+        await self.application.process_update(update)
+        while True:
+            stats = outbound.stats()
+            if not stats["pending"] and not stats["in_flight"]:
+                break
+            await asyncio.sleep(0)
+
+    async def _play(self) -> None:
+        order = self.ORDERS[self.played % len(self.ORDERS)]
+        self.played += 1
+        await self._process(self._command(PLAYER_X, "/newgame"))
+        await self._process(self._click(PLAYER_O, order[0]))  # присоединение
+        for cell in order:
+            game = games[GAME_CHAT_ID]
+            if game.game_over:
+                break
+            await self._process(self._click(game.player(game.current_player), cell))
+        if not games[GAME_CHAT_ID].game_over:
+            raise RuntimeError("simulated game did not finish")
+
+    def play(self) -> None:
+        self.loop.run_until_complete(self._play())
+
+    def close(self) -> None:
+        self.loop.run_until_complete(outbound.stop())
+        self.loop.run_until_complete(self.application.shutdown())
+
+
+def build_cases(loop: asyncio.AbstractEventLoop) -> tuple[dict, GameSimulation]:
+    mid, won = mid_game_board(), won_board()
+    legacy_mid = mid.to_list()
+    ai_player.build()
+    games[CHAT_ID] = make_game()
+    game = games[CHAT_ID]
+    theme = game.theme
+    keyboard_cache.clear()
+    bot.get_keyboard(CHAT_ID)  # кэш прогрет: в игре клавиатура берется из него
+    payload = callback_payload()
+    parsed = json.loads(payload)
+    telegram_bot = telegram.Bot(os.environ["TOKEN"])
+    simulation = GameSimulation(loop)
+
+    cases = {
+        "check_winner[mid_game]": lambda: check_winner(mid),
+        "check_winner[won]": lambda: check_winner(won),
+        "check_winner[legacy_list]": lambda: check_winner(legacy_mid),
+        "bitboard_play": lambda: BitBoard(0b000010001, 0b100000100).play(1, "X"),
+        "get_keyboard[cached_signed]": lambda: bot.get_keyboard(CHAT_ID),
+        "get_keyboard[uncached]": lambda: build_keyboard(game.board, theme, False),
+        "get_symbol_emoji": lambda: (get_symbol_emoji("X", theme), get_symbol_emoji(3, theme)),
+        "ai_choose_move[hard]": lambda: ai_player.choose_move(mid.x, mid.o, "X", "hard"),
+        "ai_choose_move[easy]": lambda: ai_player.choose_move(mid.x, mid.o, "X", "easy"),
+        "game_turn_text": lambda: bot.game_turn_text(game),
+        "de_json[callback]": lambda: Update.de_json(json.loads(payload), telegram_bot),
+        "de_json[callback_parsed]": lambda: Update.de_json(parsed, telegram_bot),
+        "full_game": simulation.play,
+    }
+    return cases, simulation
+
+
+# --- Результаты ---
+
+def format_results(results: dict[str, tuple[list[float], int]]) -> list[str]:
+    lines = [
+        f"# python {platform.python_version()} ({platform.python_implementation()}), "
+        f"python-telegram-bot {telegram.__version__}, {platform.platform()}",
+        f"# {'name':<30}{'median_ns':>14}{'min_ns':>14}{'stdev%':>8}{'loops':>10}",
+    ]
+    for name in sorted(results):
+        samples, loops = results[name]
+        median = statistics.median(samples)
+        spread = statistics.stdev(samples) / median * 100 if len(samples) > 1 and median else 0.0
+        lines.append(f"{name:<32}{median:>14.1f}{min(samples):>14.1f}{spread:>8.1f}{loops:>10d}")
+    return lines
+
+
+def read_results(path: str) -> dict[str, float]:
+    """Медианы из прошлого bench_output.txt: {имя: нс на операцию}."""
+    medians = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            name, median = line.split()[:2]
+            medians[name] = float(median)
+    return medians
+
+
+def compare(old: dict[str, float], new: dict[str, float], threshold: float) -> bool:
+    """Печатает отношение медиан; True, если есть регрессия больше threshold процентов."""
+    regressed = False
+    for name in sorted(new):
+        if name not in old:
+            print(f"{name:<32}{'new':>10}")
+            continue
+        ratio = new[name] / old[name]
+        mark = ""
+        if ratio > 1 + threshold / 100:
+            mark, regressed = "  REGRESSION", True
+        print(f"{name:<32}{old[name]:>14.1f} -> {new[name]:>14.1f} ns  x{ratio:.3f}{mark}")
+    return regressed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat")
+    parser.add_argument("--repeats", type=int, default=7)
+    parser.add_argument("--filter", default="", help="run only cases whose name contains this")
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench_output.txt"))
+    parser.add_argument("--compare", metavar="OLD", help="previous bench_output.txt to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown, percent")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    random.seed(0)  # первый игрок в /newgame выбирается случайно
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    cases, simulation = build_cases(loop)
+    results = {}
+    try:
+        for name, fn in cases.items():
+            if args.filter in name:
+                results[name] = run_case(fn, args.min_time, args.repeats)
+                print(f"{name:<32}{statistics.median(results[name][0]):>14.1f} ns")
+    finally:
+        simulation.close()
+        loop.close()
+
+    lines = format_results(results)
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"written to {args.output}")
+
+    if args.compare:
+        new = {name: statistics.median(samples) for name, (samples, _) in results.items()}
+        if compare(read_results(args.compare), new, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
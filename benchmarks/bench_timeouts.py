@@ -0,0 +1,113 @@
+"""Бенчмарк таймеров игр: колесо таймеров против задачи JobQueue на каждую игру.
+
+Сценарий повторяет жизнь игр: N таймаутов по GAME_TIMEOUT_SECONDS, затем
+большая часть отменяется (второй игрок присоединился), остальные истекают.
+
+Запуск: python benchmarks/bench_timeouts.py [--timeouts 100000] [--cancel-ratio 0.9]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import GAME_TIMEOUT_SECONDS
+from timeouts import TimeoutWheel
+
+
+async def _noop(*args) -> None:
+    pass
+
+
+def bench_wheel(count: int, cancel_ratio: float) -> dict:
+    wheel = TimeoutWheel()
+    to_cancel = int(count * cancel_ratio)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    for chat_id in range(count):
+        wheel.schedule(chat_id, GAME_TIMEOUT_SECONDS, _noop, chat_id)
+    scheduled_at = time.perf_counter()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for chat_id in range(to_cancel):
+        wheel.cancel(chat_id)
+    cancelled_at = time.perf_counter()
+
+    # Прокручиваем колесо до истечения всех оставшихся таймеров
+    fired = 0
+    ticks = 0
+    while len(wheel):
+        fired += len(wheel.advance())
+        ticks += 1
+    expired_at = time.perf_counter()
+
+    return {
+        "schedule_us": (scheduled_at - started) / count * 1e6,
+        "cancel_us": (cancelled_at - scheduled_at) / max(1, to_cancel) * 1e6,
+        "expire_total_ms": (expired_at - cancelled_at) * 1e3,
+        "fired": fired,
+        "ticks": ticks,
+        "memory_mb": memory / 2**20,
+    }
+
+
+async def bench_job_queue(count: int, cancel_ratio: float) -> dict:
+    from telegram.ext import Application
+
+    application = Application.builder().token("123456:benchmark").build()
+    job_queue = application.job_queue
+    await job_queue.start()
+    to_cancel = int(count * cancel_ratio)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    jobs = [
+        job_queue.run_once(_noop, when=GAME_TIMEOUT_SECONDS, data={"chat_id": chat_id}, name=f"game_timeout_{chat_id}")
+        for chat_id in range(count)
+    ]
+    scheduled_at = time.perf_counter()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for job in jobs[:to_cancel]:
+        job.schedule_removal()
+    cancelled_at = time.perf_counter()
+
+    await job_queue.stop(wait=False)
+    return {
+        "schedule_us": (scheduled_at - started) / count * 1e6,
+        "cancel_us": (cancelled_at - scheduled_at) / max(1, to_cancel) * 1e6,
+        "memory_mb": memory / 2**20,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--timeouts", type=int, default=100_000)
+    parser.add_argument("--cancel-ratio", type=float, default=0.9)
+    parser.add_argument("--skip-job-queue", action="store_true", help="не запускать JobQueue (нужен APScheduler)")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    wheel = bench_wheel(args.timeouts, args.cancel_ratio)
+    print(f"pending timeouts: {args.timeouts}, cancelled: {int(args.timeouts * args.cancel_ratio)}")
+    print(f"TimeoutWheel: schedule {wheel['schedule_us']:.2f} us, cancel {wheel['cancel_us']:.2f} us, "
+          f"memory {wheel['memory_mb']:.1f} MiB, expire {wheel['fired']} in {wheel['ticks']} ticks "
+          f"({wheel['expire_total_ms']:.1f} ms total)")
+
+    if not args.skip_job_queue:
+        job_queue = asyncio.run(bench_job_queue(args.timeouts, args.cancel_ratio))
+        print(f"JobQueue:     schedule {job_queue['schedule_us']:.2f} us, cancel {job_queue['cancel_us']:.2f} us, "
+              f"memory {job_queue['memory_mb']:.1f} MiB")
+        print(f"schedule speedup: {job_queue['schedule_us'] / wheel['schedule_us']:.1f}x, "
+              f"cancel speedup: {job_queue['cancel_us'] / wheel['cancel_us']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
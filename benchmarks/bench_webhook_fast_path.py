@@ -0,0 +1,156 @@
+"""Бенчмарк быстрого пути вебхука: CPU на одно пустое нажатие кнопки.
+
+Смесь нажатий, типичная для загруженной группы: `noop` по занятым клеткам,
+"не ваш ход", нажатия в законченной игре, по клавиатуре старой игры и
+двойные клики (кнопки хода подписаны, см. callback_sign.py).
+
+  ptb       - как раньше: json -> Update.de_json -> process_update -> button_click;
+  fast path - json -> fast_path.try_answer (поля из сырого JSON) -> тело ответа вебхука.
+
+В режиме ptb ответ на callback query уходит через офлайн-Bot API, в режиме
+fast path он сериализуется в тело HTTP-ответа. Замеряется процессорное
+время (time.process_time) на запрос.
+
+Запуск: python benchmarks/bench_webhook_fast_path.py [--requests 20000] [--chats 100]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TOKEN", "123456:benchmark")
+
+from telegram import Update
+from telegram.ext import Application, CallbackQueryHandler
+from telegram.request import BaseRequest
+
+import bot
+from callback_sign import callback_signer
+from fast_path import fast_path
+from game_state import GameState
+from game_store import games
+from outbound import outbound
+from update_queue import UpdateQueue
+
+
+class _OfflineRequest(BaseRequest):
+    """Bot API без сети: getMe - профиль бота, остальные методы - успех."""
+
+    _ME = json.dumps({"ok": True, "result": {
+        "id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+    }}).encode()
+    _OK = json.dumps({"ok": True, "result": True}).encode()
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        return 200, self._ME if url.endswith("/getMe") else self._OK
+
+
+def setup_games(chats: int) -> None:
+    """Нечетные чаты - идущая игра (X ходит, клетка 4 занята), четные - законченная."""
+    for chat_id in range(1, chats + 1):
+        game = GameState("X", chat_id * 10, f"player_{chat_id * 10}")
+        game.join("O", chat_id * 10 + 1, f"player_{chat_id * 10 + 1}")
+        game.board.play(4, "O")
+        game.message_id = 1000
+        game.game_over = chat_id % 2 == 0
+        game.game_id = f"game{chat_id}"
+        games[chat_id] = game
+
+
+def make_bodies(requests: int, chats: int) -> list[bytes]:
+    """Сырые тела вебхука: по кругу noop, "не ваш ход", занятая клетка, старая игра, двойной клик."""
+    bodies = []
+    for n in range(requests):
+        chat_id = n % chats + 1
+        kind = n % 5
+        move = callback_signer.encode
+        data, user_id, message_id = {
+            0: ("noop", chat_id * 10, 1000),
+            1: (move(chat_id, f"game{chat_id}", 1, 0), chat_id * 10 + 1, 1000),  # O нажимает, а ходит X
+            2: (move(chat_id, f"game{chat_id}", 1, 4), chat_id * 10, 1000),  # занято (или игра закончена)
+            3: (move(chat_id, "oldgame", 5, 0), chat_id * 10, 999),  # клавиатура старой игры
+            4: (move(chat_id, f"game{chat_id}", 0, 4), chat_id * 10, 1000),  # двойной клик на сделанный ход
+        }[kind]
+        bodies.append(json.dumps({
+            "update_id": n + 1,
+            "callback_query": {
+                "id": str(n + 1),
+                "from": {"id": user_id, "is_bot": False, "first_name": "player", "username": f"player_{user_id}"},
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id, "date": 0, "chat": {"id": chat_id, "type": "group", "title": "bench"},
+                    "from": {"id": 123456, "is_bot": True, "first_name": "bench"}, "text": "🎲",
+                },
+            },
+        }).encode())
+    return bodies
+
+
+async def run(requests: int, chats: int) -> tuple[float, float]:
+    application = (
+        Application.builder()
+        .token(os.environ["TOKEN"])
+        .request(_OfflineRequest())
+        .get_updates_request(_OfflineRequest())
+        .job_queue(None)
+        .build()
+    )
+    application.add_handler(CallbackQueryHandler(bot.button_click, pattern=r"^(noop|[0-8]|new_game|m:.+)$"))
+    await application.initialize()
+    queue = UpdateQueue(application)  # только для pending(): обработчики не запускаются
+    bodies = make_bodies(requests, chats)
+
+    setup_games(chats)
+    started = time.process_time()
+    for body in bodies:
+        update = Update.de_json(json.loads(body), application.bot)
+        await application.process_update(update)
+    await outbound.stop()
+    ptb = (time.process_time() - started) / requests
+
+    setup_games(chats)
+    started = time.process_time()
+    for n, body in enumerate(bodies):
+        reply = fast_path.try_answer(application.bot, json.loads(body), queue, bot.banned_users)
+        if reply is None:
+            raise RuntimeError(f"request {n} was not answered by the fast path")
+        json.dumps(reply).encode()
+    await outbound.stop()
+    fast = (time.process_time() - started) / requests
+
+    await application.shutdown()
+    return ptb, fast
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--chats", type=int, default=100)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    ptb, fast = asyncio.run(run(args.requests, args.chats))
+    print(f"ptb:       {ptb * 1e6:8.1f} us CPU/request")
+    print(f"fast path: {fast * 1e6:8.1f} us CPU/request")
+    print(f"speedup:   {ptb / fast:8.1f}x  ({fast_path.answered} answered, "
+          f"{fast_path.stale_keyboards} old keyboards)")
+
+
+if __name__ == "__main__":
+    main()
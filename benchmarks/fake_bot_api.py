@@ -0,0 +1,163 @@
+"""Локальная замена Bot API для нагрузочного теста (см. load_test.py).
+
+Отвечает на getMe, setWebhook, setMyCommands, sendMessage, editMessageText,
+editMessageReplyMarkup и answerCallbackQuery так, как это делает Telegram,
+но без сети и лимитов. Умеет добавлять задержку к каждому вызову и
+отвечать 429 (RetryAfter) на заданную долю отправок и правок.
+
+Бот направляется сюда переменной BOT_API_BASE_URL=http://127.0.0.1:<port>/bot.
+
+Отдельный запуск: python benchmarks/fake_bot_api.py [--port 8081] [--latency-ms 30]
+    [--jitter-ms 10] [--retry-after-rate 0.01] [--retry-after 1]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+# Методы, которые в Telegram ограничены по частоте: только на них приходит 429
+LIMITED_METHODS = frozenset({"sendMessage", "editMessageText", "editMessageReplyMarkup"})
+
+
+class FakeBotApi:
+    """Состояние заглушки: счетчики вызовов, сообщения чатов и ожидания драйвера.
+
+    Драйвер перед нажатием вызывает expect_markup(chat_id) и получает future,
+    который завершится, когда бот пришлет в этот чат сообщение или правку с
+    клавиатурой. Так замеряется полная задержка: от POST в вебхук до вызова
+    Bot API с новым полем.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, retry_after_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls: Counter[str] = Counter()
+        self.retry_afters = 0
+        self._message_ids: Counter[int] = Counter()
+        self._waiters: dict[int, asyncio.Future] = {}
+        self.app = FastAPI()
+        self.app.add_api_route("/bot{token}/{method}", self.handle, methods=["POST"])
+
+    def expect_markup(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = future
+        return future
+
+    def reset_counters(self) -> None:
+        self.calls.clear()
+        self.retry_afters = 0
+
+    async def handle(self, token: str, method: str, request: Request):
+        params = await self._params(request)
+        self.calls[method] += 1
+        delay = self.latency + (self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if method in LIMITED_METHODS and self.random.random() < self.retry_after_rate:
+            self.retry_afters += 1
+            return JSONResponse({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status_code=429)
+        return JSONResponse({"ok": True, "result": self._result(method, params)})
+
+    @staticmethod
+    async def _params(request: Request) -> dict:
+        body = await request.body()
+        if not body:
+            return {}
+        if request.headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body)
+        # PTB шлет form-urlencoded, сложные значения (reply_markup) - строками JSON
+        return decode_params({key: values[-1] for key, values in parse_qs(body.decode(), keep_blank_values=True).items()})
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method not in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            return True
+        chat_id = int(params["chat_id"])
+        if method == "sendMessage":
+            self._message_ids[chat_id] += 1
+            message_id = self._message_ids[chat_id]
+        else:
+            message_id = int(params["message_id"])
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private", "title": "loadtest"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+        markup = params.get("reply_markup")
+        if markup:
+            message["reply_markup"] = markup
+            waiter = self._waiters.pop(chat_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result((message_id, markup))
+        return message
+
+
+def decode_params(raw: dict[str, str]) -> dict:
+    params = {}
+    for key, value in raw.items():
+        try:
+            params[key] = json.loads(value) if value[:1] in "{[" else value
+        except ValueError:
+            params[key] = value
+    return params
+
+
+class OfflineBotApiRequest(BaseRequest):
+    """Транспорт PTB, который отвечает из FakeBotApi без HTTP и uvicorn (для бенчмарков)."""
+
+    def __init__(self, api: FakeBotApi):
+        self.api = api
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        params = decode_params(request_data.json_parameters) if request_data else {}
+        self.api.calls[api_method] += 1
+        return 200, json.dumps({"ok": True, "result": self.api._result(api_method, params)}).encode()
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    api = FakeBotApi(args.latency_ms / 1000, args.jitter_ms / 1000, args.retry_after_rate, args.retry_after)
+    uvicorn.run(api.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
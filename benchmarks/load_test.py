@@ -0,0 +1,287 @@
+"""Нагрузочный тест вебхука против локальной заглушки Bot API (fake_bot_api.py).
+
+Драйвер моделирует N групповых чатов. В каждом первый игрок пишет /newgame,
+второй присоединяется нажатием на поле, дальше они по очереди нажимают
+случайные свободные клетки, пока игра не закончится, и так `--games` раз.
+С вероятностью `--noise` вместе с ходом по полю нажимает и тот, чей ход не
+сейчас ("не ваш ход" - такие нажатия обычно отвечает быстрый путь вебхука).
+
+Обновления идут POST-запросами в /webhook бота. Задержка хода - от POST
+до вызова Bot API с новым полем (editMessageText/editMessageReplyMarkup,
+для /newgame - sendMessage), то есть полный путь: вебхук, очередь, обработчик,
+планировщик исходящих запросов.
+
+По умолчанию бот запускается в этом же процессе (uvicorn на --bot-port) и
+направляется на заглушку через BOT_API_BASE_URL. Чтобы гонять отдельно
+запущенный бот, укажите --bot-url и запустите бот с
+BOT_API_BASE_URL=http://127.0.0.1:<--api-port>/bot и RENDER_EXTERNAL_URL,
+указывающим на него самого. В общем процессе бот, заглушка и драйвер делят
+один CPU, и при насыщении задержка растет как (число чатов) / (ходов в секунду).
+
+Лимиты исходящих запросов бота (OUTBOUND_GROUP_RATE_PER_MINUTE и др.)
+действуют как в проде: в группе не больше 20 правок в минуту. --unthrottled
+снимает их для бота в этом процессе, чтобы мерить сам бот, а не лимиты.
+
+Запуск: python benchmarks/load_test.py [--chats 50] [--games 2] [--latency-ms 30]
+    [--retry-after-rate 0.01] [--noise 0.2] [--unthrottled]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+import uvicorn
+
+from fake_bot_api import FakeBotApi, BOT_USER
+
+TOKEN = "123456:loadtest"
+
+
+@dataclass
+class Results:
+    move_latencies: list[float] = field(default_factory=list)
+    new_game_latencies: list[float] = field(default_factory=list)
+    updates: int = 0
+    moves: int = 0
+    games: int = 0
+    inline_replies: int = 0
+    http_errors: int = 0
+    stalled_chats: int = 0
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Driver:
+    def __init__(self, api: FakeBotApi, client: httpx.AsyncClient, results: Results, timeout: float, noise: float,
+                 seed: int):
+        self.api = api
+        self.client = client
+        self.results = results
+        self.timeout = timeout
+        self.noise = noise
+        self.random = random.Random(seed)
+        self._update_id = 0
+
+    def _next_update_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    async def _post(self, body: dict) -> None:
+        self.results.updates += 1
+        try:
+            response = await self.client.post("/webhook", content=json.dumps(body).encode(),
+                                              headers={"content-type": "application/json"})
+        except httpx.HTTPError:
+            self.results.http_errors += 1
+            return
+        if response.status_code != 200:
+            self.results.http_errors += 1
+        elif response.content and json.loads(response.content).get("method") == "answerCallbackQuery":
+            self.results.inline_replies += 1
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"p{user_id}", "username": f"player_{user_id}"}
+
+    async def command(self, chat_id: int, user_id: int, text: str) -> None:
+        await self._post({
+            "update_id": self._next_update_id(),
+            "message": {
+                "message_id": self.random.randrange(1, 2**31), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group", "title": "loadtest"},
+                "from": self._user(user_id), "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+            },
+        })
+
+    async def click(self, chat_id: int, user_id: int, message_id: int, data: str) -> None:
+        update_id = self._next_update_id()
+        await self._post({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id), "from": self._user(user_id), "chat_instance": str(chat_id), "data": data,
+                "message": {
+                    "message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "group", "title": "loadtest"},
+                    "from": BOT_USER, "text": "🎲",
+                },
+            },
+        })
+
+    async def _until_markup(self, action) -> tuple[float, tuple[int, dict] | None]:
+        """Выполняет action и ждет клавиатуру от бота в этом чате: (задержка, (message_id, markup))."""
+        chat_id, coroutine = action
+        waiter = self.api.expect_markup(chat_id)
+        started = time.perf_counter()
+        await coroutine
+        try:
+            result = await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            return time.perf_counter() - started, None
+        return time.perf_counter() - started, result
+
+    async def play_chat(self, chat_id: int, games: int) -> None:
+        first, second = chat_id * -10, chat_id * -10 + 1
+        for _ in range(games):
+            latency, shown = await self._until_markup((chat_id, self.command(chat_id, first, "/newgame")))
+            if shown is None:
+                self.results.stalled_chats += 1
+                return
+            self.results.new_game_latencies.append(latency)
+            # Второй игрок присоединяется нажатием, затем первый ходит первым
+            players = [second, first, second]
+            turn = 0
+            while True:
+                message_id, markup = shown
+                cells = [button["callback_data"] for row in markup["inline_keyboard"] for button in row
+                         if button.get("callback_data", "").startswith("m:")
+                         or button.get("callback_data", "").isdigit()]
+                if not cells or any(button.get("callback_data") == "new_game"
+                                    for row in markup["inline_keyboard"] for button in row):
+                    break
+                player = players[turn] if turn < len(players) else players[1 + (turn - 1) % 2]
+                if turn > 0 and self.random.random() < self.noise:
+                    other = first if player == second else second
+                    await self.click(chat_id, other, message_id, self.random.choice(cells))
+                latency, shown = await self._until_markup(
+                    (chat_id, self.click(chat_id, player, message_id, self.random.choice(cells))))
+                if shown is None:
+                    self.results.stalled_chats += 1
+                    return
+                self.results.move_latencies.append(latency)
+                self.results.moves += 1
+                turn += 1
+            self.results.games += 1
+
+
+async def serve(app, port: int) -> tuple[uvicorn.Server, asyncio.Task]:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning",
+                                           access_log=False, lifespan="off"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+@dataclass
+class LocalBot:
+    module: object
+    application: object
+    server: uvicorn.Server
+    task: asyncio.Task
+    url: str
+
+
+async def start_local_bot(api_port: int, bot_port: int, unthrottled: bool) -> LocalBot:
+    """Запускает бот в этом процессе (uvicorn на bot_port), направив его на заглушку на api_port."""
+    bot_url = f"http://127.0.0.1:{bot_port}"
+    os.environ.update({
+        "TOKEN": TOKEN,
+        "BOT_API_BASE_URL": f"http://127.0.0.1:{api_port}/bot",
+        "RENDER_EXTERNAL_URL": bot_url,
+        "UPDATE_DEDUPE_PATH": "",
+        "GAME_STORE": "memory",
+        "LOG_LEVEL": "WARNING",
+    })
+    if unthrottled:
+        os.environ.update({
+            "OUTBOUND_GLOBAL_RATE": "1000000",
+            "OUTBOUND_GROUP_RATE_PER_MINUTE": "1000000",
+            "OUTBOUND_PRIVATE_RATE": "1000000",
+        })
+    import bot as bot_module  # после настройки окружения: config читает его при импорте
+
+    application = await bot_module.setup_application()
+    await bot_module.start_application(application)
+    server, task = await serve(bot_module.fastapi_app, bot_port)
+    return LocalBot(bot_module, application, server, task, bot_url)
+
+
+async def stop_local_bot(local: LocalBot) -> None:
+    local.server.should_exit = True
+    await local.task
+    await local.module.stop_application(local.application)
+    await local.application.shutdown()
+
+
+async def run(args) -> None:
+    api = FakeBotApi(args.latency_ms / 1000, args.jitter_ms / 1000, args.retry_after_rate, args.retry_after, args.seed)
+    api_server, api_task = await serve(api.app, args.api_port)
+
+    local = None
+    bot_url = args.bot_url
+    if not bot_url:
+        local = await start_local_bot(args.api_port, args.bot_port, args.unthrottled)
+        bot_url = local.url
+    api.reset_counters()  # getMe/setWebhook/setMyCommands при старте не считаются
+
+    results = Results()
+    limits = httpx.Limits(max_connections=args.chats, max_keepalive_connections=args.chats)
+    async with httpx.AsyncClient(base_url=bot_url, limits=limits, timeout=args.timeout) as client:
+        driver = Driver(api, client, results, args.timeout, args.noise, args.seed)
+        started = time.perf_counter()
+        await asyncio.gather(*(driver.play_chat(-1000 - n, args.games) for n in range(args.chats)))
+        elapsed = time.perf_counter() - started
+
+    if local is not None:
+        await stop_local_bot(local)
+    api_server.should_exit = True
+    await api_task
+
+    outbound_calls = sum(api.calls.values())
+    print(f"chats={args.chats} games/chat={args.games} api latency={args.latency_ms}±{args.jitter_ms} ms "
+          f"retry_after_rate={args.retry_after_rate} noise={args.noise}"
+          f"{' unthrottled' if args.unthrottled else ''}")
+    print(f"elapsed:          {elapsed:8.2f} s")
+    print(f"games finished:   {results.games:8d}   stalled chats: {results.stalled_chats}   "
+          f"http errors: {results.http_errors}")
+    print(f"updates:          {results.updates:8d}   {results.updates / elapsed:8.1f} updates/s")
+    print(f"moves:            {results.moves:8d}   {results.moves / elapsed:8.1f} moves/s")
+    print(f"move latency:     p50 {percentile(results.move_latencies, 0.5) * 1000:8.1f} ms   "
+          f"p99 {percentile(results.move_latencies, 0.99) * 1000:8.1f} ms")
+    print(f"/newgame latency: p50 {percentile(results.new_game_latencies, 0.5) * 1000:8.1f} ms   "
+          f"p99 {percentile(results.new_game_latencies, 0.99) * 1000:8.1f} ms")
+    print(f"outbound calls:   {outbound_calls:8d}   {outbound_calls / max(1, results.moves):8.2f} per move   "
+          f"(+{results.inline_replies} answers inline in webhook replies, {api.retry_afters} RetryAfter injected)")
+    for method, count in sorted(api.calls.items(), key=lambda item: -item[1]):
+        print(f"  {method:<24}{count:8d}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--games", type=int, default=2, help="games per chat")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="fake Bot API latency")
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of sends/edits answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in injected 429s")
+    parser.add_argument("--noise", type=float, default=0.2, help="chance of an extra out-of-turn click per move")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for the board update")
+    parser.add_argument("--unthrottled", action="store_true", help="lift the bot's outbound rate limits")
+    parser.add_argument("--bot-url", help="drive an already running bot instead of starting one here")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--bot-port", type=int, default=8082)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
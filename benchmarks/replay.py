@@ -0,0 +1,198 @@
+"""Воспроизведение записанного трафика вебхука (traffic_recorder.py) против локального бота.
+
+Запись включается в проде переменной WEBHOOK_RECORD_PATH=webhook.jsonl.gz; каждая
+строка файла - {"t": время прихода, "update": тело обновления}. Этот скрипт
+POST-ит обновления в /webhook бота с исходными интервалами (--speed 1),
+ускоренно в N раз (--speed N) или подряд без пауз (--speed 0). Бот по
+умолчанию запускается в этом же процессе и направляется на заглушку Bot API
+(fake_bot_api.py), как в load_test.py; --bot-url - гонять уже запущенный бот.
+
+Задержка считается от момента, когда обновление должно было уйти по записи,
+до HTTP-ответа вебхука, так что ожидание свободного соединения (как у
+Telegram, по умолчанию не больше 40) входит в нее. Ошибки - ответы не 200 и
+приросты счетчиков /metrics бота за время прогона: handler_errors_total
+(исключения обработчиков), webhook_updates_total{outcome="error"} и
+outbound_failures_total.
+
+Ходы записанных игр подписаны секретом прода и ссылаются на его игры, поэтому
+локальный бот отвечает на них как на кнопки старых игр; нагрузка и порядок
+обновлений при этом те же, что в записи. Для честного сравнения сборок
+запускайте обе с одним CALLBACK_SECRET и одной записью.
+
+Запуск: python benchmarks/replay.py webhook.jsonl.gz [more.jsonl.gz ...] [--speed 10]
+    [--limit 10000] [--latency-ms 30] [--unthrottled] [--bot-url http://127.0.0.1:8080]
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+
+from fake_bot_api import FakeBotApi
+from load_test import percentile, serve, start_local_bot, stop_local_bot
+
+# Счетчики /metrics, прирост которых за прогон считается ошибками
+ERROR_METRICS = ("handler_errors_total", "webhook_updates_total", "outbound_failures_total")
+
+
+def read_recording(paths: list[str], limit: int | None = None) -> list[tuple[float, bytes]]:
+    """Обновления из файлов записи, упорядоченные по времени прихода: [(t, тело)]."""
+    entries = []
+    for path in paths:
+        with gzip.open(path, "rb") as f:
+            try:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # недописанная строка в конце файла упавшего процесса
+                    entries.append((float(entry["t"]), json.dumps(entry["update"]).encode()))
+            except (EOFError, gzip.BadGzipFile) as e:
+                # Файл упавшего процесса: gzip без завершающего блока. Все, что
+                # сброшено до падения, уже прочитано
+                print(f"{path}: truncated recording ({e}), using records read so far", file=sys.stderr)
+    entries.sort(key=lambda entry: entry[0])
+    return entries[:limit] if limit else entries
+
+
+def update_kind(body: bytes) -> str:
+    """Вид обновления по сырому телу, как metrics.update_kind по Update."""
+    update = json.loads(body)
+    if "callback_query" in update:
+        return "callback_query"
+    message = update.get("message")
+    if message is not None:
+        return "command" if (message.get("text") or "").startswith("/") else "message"
+    return "other"
+
+
+async def scrape(client: httpx.AsyncClient) -> Counter:
+    """Значения счетчиков ERROR_METRICS из /metrics бота ({строка ряда: значение})."""
+    values = Counter()
+    try:
+        response = await client.get("/metrics")
+    except httpx.HTTPError:
+        return values
+    if response.status_code != 200:
+        return values
+    for line in response.text.splitlines():
+        if line.startswith(ERROR_METRICS):
+            series, _, value = line.rpartition(" ")
+            values[series] = float(value)
+    return values
+
+
+async def replay(client: httpx.AsyncClient, entries: list[tuple[float, bytes]], speed: float):
+    """Отправляет обновления по расписанию записи; возвращает задержки по видам, статусы и время прогона."""
+    latencies: dict[str, list[float]] = {}
+    statuses = Counter()
+
+    async def post(scheduled: float, body: bytes) -> None:
+        try:
+            response = await client.post("/webhook", content=body, headers={"content-type": "application/json"})
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        latencies.setdefault(update_kind(body), []).append(time.perf_counter() - scheduled)
+        statuses[status] += 1
+
+    tasks = []
+    first = entries[0][0]
+    started = time.perf_counter()
+    for t, body in entries:
+        scheduled = started + (t - first) / speed if speed > 0 else time.perf_counter()
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(post(scheduled, body)))
+        if speed <= 0:
+            await asyncio.sleep(0)  # дать отправиться, не копя тысячи задач
+    await asyncio.gather(*tasks)
+    return latencies, statuses, time.perf_counter() - started
+
+
+async def run(args) -> None:
+    entries = read_recording(args.recordings, args.limit)
+    if not entries:
+        sys.exit("no updates in the recording")
+    span = entries[-1][0] - entries[0][0]
+
+    api = api_server = api_task = local = None
+    bot_url = args.bot_url
+    if not bot_url:
+        api = FakeBotApi(args.latency_ms / 1000, args.jitter_ms / 1000, seed=args.seed)
+        api_server, api_task = await serve(api.app, args.api_port)
+        local = await start_local_bot(args.api_port, args.bot_port, args.unthrottled)
+        bot_url = local.url
+        api.reset_counters()
+
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    async with httpx.AsyncClient(base_url=bot_url, limits=limits, timeout=args.timeout) as client:
+        before = await scrape(client)
+        latencies, statuses, elapsed = await replay(client, entries, args.speed)
+        await asyncio.sleep(args.settle)  # обработчики и исходящие запросы после последнего ответа
+        after = await scrape(client)
+
+    if local is not None:
+        await stop_local_bot(local)
+        api_server.should_exit = True
+        await api_task
+
+    total = sum(statuses.values())
+    pace = "as fast as possible" if args.speed <= 0 else f"{args.speed:g}x"
+    print(f"updates: {total} recorded over {span:.1f} s, replayed {pace} in {elapsed:.1f} s "
+          f"({total / elapsed:.1f} updates/s)")
+    print("statuses:  " + "  ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+    every = [value for values in latencies.values() for value in values]
+    for kind, values in [("all", every)] + sorted(latencies.items()):
+        print(f"  {kind:<16}{len(values):8d}   p50 {percentile(values, 0.5) * 1000:8.1f} ms   "
+              f"p90 {percentile(values, 0.9) * 1000:8.1f} ms   p99 {percentile(values, 0.99) * 1000:8.1f} ms   "
+              f"max {max(values) * 1000:8.1f} ms")
+    if not after:
+        print("errors: /metrics unavailable (METRICS_ENABLED=0?), only HTTP statuses above")
+    else:
+        grown = {series: after[series] - before.get(series, 0) for series in after
+                 if after[series] > before.get(series, 0)
+                 and (not series.startswith("webhook_updates_total") or 'outcome="error"' in series)}
+        print("errors:" + ("  none" if not grown else ""))
+        for series, delta in sorted(grown.items()):
+            print(f"  {series:<56}{delta:8.0f}")
+    if api is not None:
+        print(f"outbound calls: {sum(api.calls.values())}")
+        for method, count in sorted(api.calls.items(), key=lambda item: -item[1]):
+            print(f"  {method:<24}{count:8d}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="+", help=".jsonl.gz files written by traffic_recorder.py")
+    parser.add_argument("--speed", type=float, default=1.0, help="time acceleration, 0 - no pauses")
+    parser.add_argument("--limit", type=int, help="replay only the first N updates")
+    parser.add_argument("--max-connections", type=int, default=40, help="like Telegram's webhook max_connections")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to wait before reading error counters")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="fake Bot API latency")
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--unthrottled", action="store_true", help="lift the bot's outbound rate limits")
+    parser.add_argument("--bot-url", help="replay into an already running bot instead of starting one here")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--bot-port", type=int, default=8082)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,48 @@
 import logging
+import functools
 import random
 import os # Добавлено для переменных окружения
 import asyncio # Добавлено для асинхронности вебхука
 import uvicorn # Добавлено для запуска веб-сервера
 from fastapi import FastAPI, Request, Response # Добавлен FastAPI для вебхука
+from fastapi.responses import JSONResponse
 from http import HTTPStatus
 import time # Keep existing time import if needed elsewhere
-from datetime import datetime, timedelta # Added for job queue scheduling
 import sys # Для проверки наличия токена
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, Message, BotCommand
 # Убедимся, что используется правильный Application
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, JobQueue
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
 from telegram.helpers import escape_markdown
+from telegram.request import BaseRequest
 import telegram # Added for error types
 
-# Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.DEBUG
+from game_engine import DRAW, CLASSIC, MAX_BOARD_SIZE
+from ai_player import ai_player
+from ai_service import ai_service
+from render_cache import keyboard_cache
+from callback_sign import callback_signer, MOVE_PREFIX
+from config import KEYBOARD_CACHE_WARMUP, GAME_TIMEOUT_SECONDS, WEB_WORKERS, WEBHOOK_FAST_PATH, METRICS_ENABLED, BOT_API_BASE_URL
+from update_queue import UpdateQueue
+from outbound import outbound
+from timeouts import timeouts
+from chat_locks import chat_locks, PerChatUpdateProcessor
+from game_state import GameState
+from game_logic import parse_new_game_args
+from game_store import games
+from game_sweeper import game_sweeper
+from fast_path import fast_path
+from webhook_reply import webhook_replies
+from update_dedupe import update_deduper
+from traffic_recorder import traffic_recorder
+from log_pipeline import log_pipeline
+from metrics import metrics, update_kind, MetricsMiddleware, WEBHOOK_UPDATES, CALLBACK_ROUTE_SECONDS, HANDLER_ERRORS
+from callback_router import (
+    callback_router, BOARD, CHANGE_THEME_PROMPT, CANCEL_THEME_CHANGE, THEME_SELECT, THEME_SELECT_INGAME,
+    THEME_SELECT_PREFIX, THEME_SELECT_INGAME_PREFIX,
 )
+
+# Логирование настраивает config.py (log_pipeline.py)
 logger = logging.getLogger(__name__)
 
 # --- Константы и темы ---
@@ -73,9 +97,6 @@ PORT = int(os.getenv("PORT", "8080"))
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_ENDPOINT_URL = f"{WEBHOOK_URL}{WEBHOOK_PATH}"
 
-# Словарь для хранения состояния игр {chat_id: game_data}
-games: dict[int, dict] = {} 
-
 # --- FastAPI приложение (глобальное) ---
 fastapi_app = FastAPI()
 
@@ -83,30 +104,106 @@ banned_users = set()
 
 chat_stats = {}
 
+# Очередь входящих обновлений (создается в main после инициализации PTB)
+update_queue: UpdateQueue | None = None
+
 @fastapi_app.get("/")
 async def health_check():
-    return {"status": "Али чемпион! Бот работает!"}
+    status = {
+        "status": "Али чемпион! Бот работает!",
+        "games": game_sweeper.stats(),
+        "game_store": games.stats(),
+        "outbound": outbound.stats(),
+        "timeouts": timeouts.stats(),
+        "chat_locks": chat_locks.stats(),
+        "fast_path": fast_path.stats(),
+        "webhook_replies": webhook_replies.stats(),
+        "update_dedupe": update_deduper.stats(),
+        "callback_sign": callback_signer.stats(),
+        "callback_router": callback_router.stats(),
+        "logging": log_pipeline.stats(),
+        "ai_player": ai_player.stats(),
+        "ai_search": ai_service.stats(),
+        "traffic_recorder": traffic_recorder.stats(),
+    }
+    if update_queue:
+        status["update_queue"] = update_queue.stats()
+    return status
+
+async def metrics_endpoint():
+    """Метрики процесса в текстовом формате Prometheus."""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+if METRICS_ENABLED:
+    fastapi_app.add_api_route("/metrics", metrics_endpoint, methods=["GET"])
+    fastapi_app.add_middleware(MetricsMiddleware, paths=("/", "/metrics", WEBHOOK_PATH))
 
 # --- Глобальный обработчик вебхука (принимает application) ---
-async def handle_telegram_update(request: Request, application: Application):
-     """Принимает обновления от Telegram и передает их PTB."""
+async def handle_telegram_update(request: Request, application: Application, queue: UpdateQueue):
+     """Принимает обновления от Telegram, ставит их в очередь и отвечает 200.
+
+     Обработка идет в фоновых задачах очереди, поэтому медленный edit_message_text
+     или ожидание RetryAfter не держат HTTP-запрос открытым. Пустые и устаревшие
+     нажатия кнопок отвечаются сразу, без разбора Update (fast_path.py).
+
+     На нажатие кнопки вебхук до WEBHOOK_REPLY_TIMEOUT ждет ответа обработчика
+     и возвращает answerCallbackQuery в теле ответа (webhook_reply.py).
+
+     Повторно доставленные обновления (тот же update_id) отбрасываются до разбора.
+     При WEBHOOK_RECORD_PATH тело каждого обновления записывается (traffic_recorder.py).
+     """
+     update_id = None
      try:
-         body = await request.json()
+         try:
+             body = await request.json()
+         except ValueError:
+             body = None
+         if not isinstance(body, dict):
+             # Не обновление: 200, чтобы отправитель не повторял запрос
+             logger.warning("Dropping webhook body that is not a JSON object (%s)", type(body).__name__)
+             WEBHOOK_UPDATES.inc("invalid")
+             return Response(status_code=HTTPStatus.OK)
+         if traffic_recorder.enabled:
+             traffic_recorder.record(await request.body()) # Тело уже прочитано, повторного чтения нет
+         update_id = body.get("update_id")
+         if isinstance(update_id, int) and update_deduper.seen(update_id):
+             logger.info("Dropping redelivered update %s", update_id)
+             WEBHOOK_UPDATES.inc("duplicate")
+             return Response(status_code=HTTPStatus.OK)
+         if WEBHOOK_FAST_PATH:
+             reply = fast_path.try_answer(application.bot, body, queue, banned_users)
+             if reply:
+                 WEBHOOK_UPDATES.inc("fast_path")
+                 return JSONResponse(reply)
          update = Update.de_json(body, application.bot)
-         logger.debug(f"Получено обновление: {update}")
-         await application.process_update(update)
+         logger.debug("Получено обновление: %s", update)
+         query = update.callback_query
+         if query:
+             webhook_replies.expect(query.id)
+         outcome = "queued" if queue.submit(update) else "rejected"
+         if query:
+             reply = await webhook_replies.wait(query.id)
+             if reply:
+                 WEBHOOK_UPDATES.inc("inline_reply" if outcome == "queued" else outcome)
+                 return JSONResponse(reply)
+         WEBHOOK_UPDATES.inc(outcome)
          return Response(status_code=HTTPStatus.OK)
      except Exception as e:
-         logger.error(f"Ошибка обработки входящего вебхука: {e}", exc_info=True)
+         logger.error("Ошибка обработки входящего вебхука: %s", e, exc_info=True)
+         WEBHOOK_UPDATES.inc("error")
+         if isinstance(update_id, int):
+             update_deduper.forget(update_id) # Telegram пришлет его снова - его нужно принять
          return Response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
 
-# --- Функции бота (start, new_game, get_symbol_emoji, get_keyboard, check_winner, button_click) --- 
+# --- Функции бота (start, new_game, get_symbol_emoji, get_keyboard, button_click) --- 
 # Они остаются без изменений по сравнению с предыдущей версией
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
     await update.message.reply_text(
         "Али чемпион! 🎲 Для начала игры используйте команду /newgame\n"
+        "🤖 Игра с ботом: /newgame bot [easy|medium|hard] [размер поля]\n"
+        f"🔢 Большое поле: /newgame 5x5 4 (до {MAX_BOARD_SIZE}x{MAX_BOARD_SIZE}, второе число - сколько в ряд)\n"
         "🎨 Сменить символы игры: /themes" # Добавили информацию о темах
     )
 
@@ -121,14 +218,21 @@ async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     # --- Проверка: не бот ли инициатор ---
     if hasattr(context, 'bot') and getattr(context.bot, 'id', None) == user_id:
-        logger.warning(f"Bot attempted to start a new game in chat {user_id}. Ignoring.")
+        logger.warning("Bot attempted to start a new game in chat %s. Ignoring.", user_id)
         if hasattr(update, 'message') and update.message:
             await update.message.reply_text("Бот не может быть игроком! Ожидайте действий от настоящих пользователей.")
         return
 
+    # --- Параметры игры: /newgame [bot [уровень]] [NxN [K]] ---
+    try:
+        geometry, ai_level = parse_new_game_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+
     # --- Проверка на активную игру ---
-    if chat_id in games and not games[chat_id].get('game_over', True):
-         game_message_id = games[chat_id].get('message_id')
+    if chat_id in games and not games[chat_id].game_over:
+         game_message_id = games[chat_id].message_id
          warning_text = "⏳ В этом чате уже идет игра! Дождитесь ее завершения или отмены."
          try:
              await update.message.reply_text(
@@ -137,30 +241,26 @@ async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
              )
          except telegram.error.BadRequest as e:
              if "Message to be replied not found" in str(e):
-                 logger.warning(f"Original game message {game_message_id} not found in chat {chat_id}. Sending new message.")
+                 logger.warning("Original game message %s not found in chat %s. Sending new message.", game_message_id, chat_id)
                  await update.message.reply_text(warning_text) # Send as a new message
              else:
-                 logger.error(f"BadRequest when trying to reply in new_game: {e}")
+                 logger.error("BadRequest when trying to reply in new_game: %s", e)
                  # Можно отправить сообщение об ошибке пользователю или просто проигнорировать
                  await update.message.reply_text("Произошла ошибка при попытке начать новую игру.")
          except Exception as e:
-             logger.error(f"Unexpected error when trying to reply in new_game: {e}")
+             logger.error("Unexpected error when trying to reply in new_game: %s", e)
              await update.message.reply_text("Произошла непредвиденная ошибка.")
 
-         logger.warning(f"User {username} ({user_id}) tried to start a new game in chat {chat_id} while another is active.")
+         logger.warning("User %s (%s) tried to start a new game in chat %s while another is active.", username, user_id, chat_id)
          return
 
     # --- Отмена старого таймера и удаление старой игры ---
     if chat_id in games: # Используем chat_id вместо user_id
-        old_job = games[chat_id].get('timeout_job')
-        if old_job:
-            try:
-                old_job.schedule_removal()
-                logger.info(f"Removed previous timeout job for chat {chat_id} before starting new game.")
-            except Exception as e: # Ловим любые ошибки, включая JobLookupError
-                logger.warning(f"Could not remove previous timeout job for chat {chat_id} (maybe already removed or finished?): {e}")
+        if timeouts.cancel(chat_id):
+            logger.info("Removed previous timeout for chat %s before starting new game.", chat_id)
+        ai_service.cancel(chat_id) # Ход бота в старой игре больше не нужен
         del games[chat_id] # Удаляем данные старой игры (теперь безопасно)
-        logger.info(f"Removed old game data for chat {chat_id} before starting new game.")
+        logger.info("Removed old game data for chat %s before starting new game.", chat_id)
 
     # Определяем тему для игры на основе выбора первого игрока
     initiator_theme_key = context.user_data.get('chosen_theme', DEFAULT_THEME_KEY)
@@ -168,63 +268,62 @@ async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Инициализация новой игры
     first_player = random.choice(["X", "O"])
-    second_player = "O" if first_player == "X" else "X"
     
-    game_data = {
-        "board": list(range(1, 10)),
-        "current_player": first_player,
-        "game_over": False,
-        "players": {
-            first_player: user_id,
-            second_player: None
-        },
-        "user_symbols": {
-            user_id: first_player
-        },
-        "usernames": {
-            user_id: username
-        },
-        "message_id": None, # Добавлено для хранения ID сообщения игры
-        "timeout_job": None, # Добавлено для хранения задачи тайм-аута
-        "theme_emojis": game_theme_emojis # Добавлено для хранения эмодзи текущей игры
-    }
-    games[chat_id] = game_data
+    game = GameState(first_player, user_id, username, initiator_theme_key, geometry)
+    if ai_level:
+        # Бот сразу занимает место второго игрока; первым всегда ходит человек
+        game.join(game.waiting_player, context.bot.id, context.bot.username or "bot")
+        game.ai_level = ai_level
+    games[chat_id] = game
 
     # Отправляем сообщение с игровым полем
     try:
         # Используем эмодзи из выбранной темы
         first_player_emoji = get_symbol_emoji(first_player, game_theme_emojis)
         
-        sent_message = await update.message.reply_text(
-            f"🎲 *Новая игра началась!* 🎲\n\n"
-            f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
-            f"👤 {escape_markdown(username, version=1)} играет за {first_player_emoji}\n"
-            f"⏳ Ожидаем второго игрока...\n\n"
-            f"*Первым ходит*: {first_player_emoji}\n\n"
-            f"⏱️ *Время на игру*: 90 секунд", # Добавили инфо о времени
-            reply_markup=get_keyboard(chat_id),
-            parse_mode="Markdown"
-        )
-        game_data['message_id'] = sent_message.message_id
-        logger.info(f"New game started by {username} ({user_id}) in chat {chat_id}. Message ID: {sent_message.message_id}")
-
-        # --- Запускаем таймер ---
-        job_context = {'chat_id': chat_id, 'message_id': sent_message.message_id}
-        timeout_job = context.job_queue.run_once(
-            game_timeout,
-            when=timedelta(seconds=90),
-            data=job_context,
-            name=f"game_timeout_{chat_id}"
+        if ai_level:
+            new_game_text = (
+                f"🤖 *Игра с ботом!* 🤖\n\n"
+                f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
+                f"👤 {escape_markdown(username, version=1)} играет за {first_player_emoji}\n"
+                f"🤖 Бот ({ai_level}) играет за {get_symbol_emoji(game.waiting_player, game_theme_emojis)}\n\n"
+                + (f"🔢 Поле: *{geometry.label}*\n\n" if geometry is not CLASSIC else "")
+                + f"*Первым ходит*: {first_player_emoji}"
+            )
+        else:
+            new_game_text = (
+                f"🎲 *Новая игра началась!* 🎲\n\n"
+                f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
+                f"👤 {escape_markdown(username, version=1)} играет за {first_player_emoji}\n"
+                f"⏳ Ожидаем второго игрока...\n\n"
+                + (f"🔢 Поле: *{geometry.label}*\n\n" if geometry is not CLASSIC else "")
+                + f"*Первым ходит*: {first_player_emoji}\n\n"
+                f"⏱️ *Время на игру*: {GAME_TIMEOUT_SECONDS} секунд" # Добавили инфо о времени
+            )
+        keyboard = get_keyboard(chat_id)
+        # Нужен message_id, поэтому дожидаемся ответа планировщика
+        sent_message = await outbound.call(
+            chat_id,
+            lambda: update.message.reply_text(new_game_text, reply_markup=keyboard, parse_mode="Markdown"),
+            f"new_game message ({chat_id})"
         )
-        game_data['timeout_job'] = timeout_job
-        logger.info(f"Scheduled timeout job for game in chat {chat_id}")
+        game.message_id = sent_message.message_id
+        games.mark_dirty(chat_id)
+        outbound.remember_sent(game, new_game_text, keyboard)
+        logger.info("New game started by %s (%s) in chat %s. Message ID: %s", username, user_id, chat_id, sent_message.message_id)
+
+        # --- Запускаем таймер (общее колесо таймеров, ключ - chat_id) ---
+        # В игре с ботом второй игрок уже есть, ждать некого
+        if not ai_level:
+            timeouts.schedule(chat_id, GAME_TIMEOUT_SECONDS, game_timeout, context.bot, chat_id, sent_message.message_id)
+            logger.info("Scheduled %ss timeout for game in chat %s", GAME_TIMEOUT_SECONDS, chat_id)
 
     except telegram.error.BadRequest as e:
-         logger.error(f"Failed to send new game message in chat {chat_id}: {e}")
+         logger.error("Failed to send new game message in chat %s: %s", chat_id, e)
          # Если не удалось отправить сообщение, удаляем игру
          del games[chat_id]
     except Exception as e:
-        logger.error(f"Unexpected error starting game in chat {chat_id}: {e}", exc_info=True)
+        logger.error("Unexpected error starting game in chat %s: %s", chat_id, e, exc_info=True)
         if chat_id in games:
             del games[chat_id]
 
@@ -238,88 +337,36 @@ def get_symbol_emoji(symbol, game_theme_emojis: dict):
         return game_theme_emojis.get(EMPTY_CELL_SYMBOL, "⬜") # Фоллбэк
     return str(symbol) # На случай, если передано что-то другое
 
+def game_turn_text(game: GameState) -> str:
+    """Текст игрового сообщения после хода: тема, игроки и кто ходит следующим."""
+    game_theme_emojis = game.theme
+    p1_emoji = get_symbol_emoji("X", game_theme_emojis)
+    p2_emoji = get_symbol_emoji("O", game_theme_emojis)
+    next_player_emoji = get_symbol_emoji(game.current_player, game_theme_emojis)
+    return (
+         f"🎲 *Игра идет!* 🎲\n\n"
+         f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
+         f"👤 {escape_markdown(game.username('X'), version=1)} ({p1_emoji}) vs {escape_markdown(game.username('O'), version=1)} ({p2_emoji})\n\n"
+         f"*Ходит*: {escape_markdown(game.username(game.current_player), version=1)} ({next_player_emoji})"
+    )
+
 def get_keyboard(chat_id, winning_indices: list | None = None):
-    """Создаёт клавиатуру с игровым полем.
+    """Возвращает клавиатуру с игровым полем (готовые клавиатуры берутся из LRU-кэша).
        Неактивные кнопки (занятые клетки или конец игры) имеют callback_data='noop'.
        Подсвечивает выигрышную комбинацию, если переданы winning_indices.
     """
     if chat_id not in games: # Проверка на случай, если игра не найдена
-        logger.warning(f"get_keyboard called for non-existent game in chat {chat_id}")
+        logger.warning("get_keyboard called for non-existent game in chat %s", chat_id)
         return None
 
-    game_data = games[chat_id]
-    board = game_data["board"]
-    is_game_over = game_data["game_over"]
-    # Получаем эмодзи для текущей игры
-    theme_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY]) # Фоллбэк на дефолтную тему
-    keyboard = []
-    logger.debug(f"[get_keyboard chat={chat_id}] Board: {board}, Theme: {theme_emojis.get('name', 'Unknown')}, Winning: {winning_indices}")
-
-    # Создаём строки по 3 кнопки
-    for i in range(0, 9, 3):
-        row = []
-        for j in range(3):
-            cell_index = i + j
-            cell = board[cell_index]
-            cell_text = ""
-            callback_data = "noop" # По умолчанию кнопка неактивна
-
-            # Определяем текст кнопки (с подсветкой или без)
-            if isinstance(cell, int):
-                cell_text = get_symbol_emoji(cell, theme_emojis)
-                if not is_game_over: # Сделать кликабельной, только если игра идет
-                    callback_data = str(cell_index)
-            else:
-                # Если игра завершена победой и эта клетка в выигрышной линии
-                if is_game_over and winning_indices and cell_index in winning_indices:
-                    win_symbol_key = f"{cell}_win"
-                    cell_text = theme_emojis.get(win_symbol_key, get_symbol_emoji(cell, theme_emojis)) # Фоллбэк на обычный символ
-                else:
-                    cell_text = get_symbol_emoji(cell, theme_emojis)
-                # callback_data остается "noop"
-
-            # Логируем значение ячейки и результат
-            logger.debug(f"[get_keyboard chat={chat_id}] Cell[{cell_index}]: {repr(cell)} -> Emoji: {repr(cell_text)}, Callback: {callback_data}")
-
-            row.append(InlineKeyboardButton(cell_text, callback_data=callback_data))
-        keyboard.append(row)
-
-    # Добавляем кнопки управления игрой
-    control_row = []
-    if is_game_over:
-        control_row.append(InlineKeyboardButton("🔄 Новая игра", callback_data="new_game"))
-    else:
-        # Добавляем кнопку смены темы только во время активной игры
-        control_row.append(InlineKeyboardButton("🎨 Сменить тему", callback_data="change_theme_prompt"))
-        # Можно добавить кнопку отмены/сдачи, если нужно
-        # control_row.append(InlineKeyboardButton("❌ Отмена", callback_data="cancel_game"))
-
-    if control_row: # Добавляем строку управления, если она не пустая
-        keyboard.append(control_row)
-
-    return InlineKeyboardMarkup(keyboard)
-
-def check_winner(board):
-    """Проверяет, есть ли победитель или ничья.
-    Возвращает: (winner_symbol, winning_indices) или ("Ничья", None) или (None, None)
-    """
-    # Выигрышные комбинации: горизонтали, вертикали и диагонали
-    win_combinations = [
-        [0, 1, 2], [3, 4, 5], [6, 7, 8],  # горизонтали
-        [0, 3, 6], [1, 4, 7], [2, 5, 8],  # вертикали
-        [0, 4, 8], [2, 4, 6]              # диагонали
-    ]
-
-    # Проверка на победу
-    for combo in win_combinations:
-        if board[combo[0]] == board[combo[1]] == board[combo[2]] and not isinstance(board[combo[0]], int):
-            return board[combo[0]], combo  # Возвращаем символ победителя и комбинацию
-
-    # Проверка на ничью (если все клетки заняты)
-    if not any(isinstance(cell, int) for cell in board):
-        return "Ничья", None # Возвращаем "Ничья" и None для комбинации
-
-    return None, None  # Игра продолжается
+    game = games[chat_id]
+    markup = keyboard_cache.get_keyboard(
+        game.board, game.theme_key, game.theme, game.game_over, winning_indices
+    )
+    if game.game_id and not game.game_over:
+        # Кнопки свободных клеток подписываются для этой игры и хода (callback_sign.py)
+        markup = callback_signer.game_keyboard(markup, chat_id, game)
+    return markup
 
 async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик нажатия на кнопки игрового поля или 'Новая игра'"""
@@ -328,368 +375,346 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     user_id = user.id
     username = user.username or f"player_{user_id}"
     if str(user_id) in banned_users or (user.username and user.username in banned_users):
-        try:
-            await query.answer("⛔ Вы забанены и не можете играть.", show_alert=True)
-        except Exception:
-            pass
+        await outbound.answer(query, "⛔ Вы забанены и не можете играть.", show_alert=True)
         return
-    # Отвечаем на запрос сразу, чтобы убрать "часики", но ловим ошибку, если он устарел
-    try:
-        await query.answer()
-    except telegram.error.BadRequest as e:
-        # Если запрос слишком старый, просто логируем и продолжаем
-        # Остальные проверки ниже должны обработать устаревшее состояние игры
-        logger.warning(f"Failed to answer callback query (likely too old): {e}")
-        # Не выходим, так как нужно проверить состояние игры дальше
+    # На запрос отвечаем один раз: текстом в ветках ниже, а если обработчик не ответил,
+    # пустой ответ отправит UpdateQueue по завершении (по возможности в ответе вебхука)
 
     data = query.data
     chat_id = update.effective_chat.id
     # Получаем ID сообщения только если оно есть (может отсутствовать в старых апдейтах)
     message_id = query.message.message_id if query.message else None
 
+    # --- Подписанная кнопка хода (callback_sign.py) ---
+    # Подделка или испорченные данные отклоняются до обращения к хранилищу
+    move = None
+    if data.startswith(MOVE_PREFIX):
+        move = callback_signer.decode(chat_id, data)
+        if move is None:
+            logger.warning("Rejected forged move button from user %s in chat %s: %r", user_id, chat_id, data)
+            await outbound.answer(query, "Недействительная кнопка.", show_alert=False)
+            return
+
+    # --- Кнопка "Новая игра" ('new_game') ---
+    # Обрабатывается до проверки существования игры: старая игра могла быть уже вытеснена sweeper'ом
+    if data == "new_game":
+        logger.info("User %s (%s) initiating new game via button in chat %s.", username, user_id, chat_id)
+
+        # --- Создаем новую игру (вызываем async new_game) ---
+        # new_game сама обработает удаление старой игры и отмену таймера.
+        fake_message = query.message # Используем сообщение, к которому прикреплена кнопка
+        if not fake_message:
+             await outbound.answer(query, "Не удалось получить информацию для старта новой игры.", show_alert=True)
+             logger.error("Could not get message object from callback query to start new game in chat %s", chat_id)
+             return
+        # Отправка нового сообщения может ждать лимитов: "часики" убираем заранее
+        await outbound.answer(query)
+
+        fake_update = Update(
+            update_id=update.update_id,
+            message=fake_message
+        )
+        await new_game(fake_update, context)
+        return # Выходим, new_game сделала всё необходимое
+
     # --- Проверка: Существует ли игра для этого чата? ---
     if chat_id not in games:
-        logger.warning(f"Button click received for potentially non-existent or starting game in chat {chat_id}. Data: {data}")
+        logger.warning("Button click received for potentially non-existent or starting game in chat %s. Data: %s", chat_id, data)
         # НЕ удаляем клавиатуру здесь, так как игра может быть в процессе создания
         # Только сообщаем пользователю
-        await query.answer("🤔 Эта игра уже не существует или находится в процессе создания.", show_alert=True)
+        await outbound.answer(query, "🤔 Эта игра уже не существует или находится в процессе создания.", show_alert=True)
         return
 
-    game_data = games[chat_id]
+    game = games[chat_id]
+    game.touch()
     # Получаем ID сообщения ИЗ СОХРАНЕННЫХ ДАННЫХ ИГРЫ
-    game_message_id = game_data.get('message_id')
+    game_message_id = game.message_id
+
+    # --- Проверка подписанной кнопки: та же игра и тот же ход? ---
+    if move is not None:
+        move_game_id, move_seq, move_cell = move
+        if move_game_id != game.game_id:
+            await outbound.answer(query, "Эта клавиатура от старой игры. Начните новую!", show_alert=True)
+            return
+        if move_seq != game.board.moves:
+            # Повторное нажатие на уже сделанный ход (двойной клик) - ничего не делаем
+            logger.debug("Ignoring click built for move %s in chat %s, game is at move %s", move_seq, chat_id, game.board.moves)
+            return
+        data = str(move_cell)
+    elif data.isdigit() and game.game_id:
+        # У игры подписанные кнопки: голая клетка - кнопка старой игры или подделка
+        await outbound.answer(query, "Эта клавиатура от старой игры. Начните новую!", show_alert=True)
+        return
+    if data.isdigit() and int(data) >= game.board.geometry.cells:
+        # Клетка за пределами поля этой игры - кнопка игры другого размера
+        await outbound.answer(query, "Эта клавиатура от старой игры. Начните новую!", show_alert=True)
+        return
 
     # --- Проверка: Актуально ли сообщение? ---
     # Сравниваем ID сообщения из коллбэка с ID, сохраненным при старте игры
     # Это предотвращает взаимодействие со старыми сообщениями от предыдущих игр
     if message_id and game_message_id and message_id != game_message_id:
-        logger.warning(f"Button click received on an OLD game message ({message_id}, expected {game_message_id}) in chat {chat_id}. Data: {data}. User: {user_id}")
-        await query.answer("Эта клавиатура от старой игры. Начните новую!", show_alert=True)
-        # Попытка удалить кнопки со старого сообщения
-        try:
-             await context.bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
-        except Exception as e:
-             logger.warning(f"Could not remove keyboard from old message {message_id} in chat {chat_id}: {e}")
+        logger.warning("Button click received on an OLD game message (%s, expected %s) in chat %s. Data: %s. User: %s", message_id, game_message_id, chat_id, data, user_id)
+        await outbound.answer(query, "Эта клавиатура от старой игры. Начните новую!", show_alert=True)
+        # Попытка удалить кнопки со старого сообщения (ошибку залогирует планировщик)
+        outbound.edit_message_reply_markup(context.bot, chat_id, message_id, reply_markup=None)
         return
 
     # Получаем тему текущей игры
-    game_theme_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY])
+    game_theme_emojis = game.theme
 
     # 1. Обработка неактивных кнопок ('noop')
     if data == "noop":
-        if game_data["game_over"]:
+        if game.game_over:
             # Можно отправить тихое уведомление, если пользователь кликает после конца игры
-            await query.answer("🏁 Игра уже завершена. Начните новую игру!", show_alert=False)
+            await outbound.answer(query, "🏁 Игра уже завершена. Начните новую игру!", show_alert=False)
         # Иначе (клик на занятую клетку во время игры) - ничего не делаем
         return
 
-    # 2. Обработка кнопки "Новая игра" ('new_game')
-    if data == "new_game":
-        logger.info(f"User {username} ({user_id}) initiating new game via button in chat {chat_id}.")
-
-        # --- Создаем новую игру (вызываем async new_game) ---
-        # new_game сама обработает удаление старой игры и отмену таймера.
-        fake_message = query.message # Используем сообщение, к которому прикреплена кнопка
-        if not fake_message:
-             await query.answer("Не удалось получить информацию для старта новой игры.", show_alert=True)
-             logger.error(f"Could not get message object from callback query to start new game in chat {chat_id}")
-             return
-
-        fake_update = Update(
-            update_id=update.update_id,
-            message=fake_message
-        )
-        await new_game(fake_update, context)
-        return # Выходим, new_game сделала всё необходимое
-
-    # 3. Обработка хода игрока (нажатие на клетку поля)
+    # 2. Обработка хода игрока (нажатие на клетку поля)
     if data.isdigit():
         cell_index = int(data)
         username = update.effective_user.username or f"player_{user_id}" # Получаем имя пользователя
 
         # --- Различные проверки перед ходом ---
-        if game_data["game_over"]:
-            await query.answer("🏁 Игра завершена! Начните новую.", show_alert=True)
-            logger.warning(f"User {username} ({user_id}) tried to make a move in finished game in chat {chat_id}.")
+        if game.game_over:
+            await outbound.answer(query, "🏁 Игра завершена! Начните новую.", show_alert=True)
+            logger.warning("User %s (%s) tried to make a move in finished game in chat %s.", username, user_id, chat_id)
             return
 
-        current_player_symbol = game_data["current_player"]
-        current_player_id = game_data["players"].get(current_player_symbol)
+        current_player_symbol = game.current_player
+        current_player_id = game.player(current_player_symbol)
 
         # -- Проверка: Второй игрок присоединился? --
-        second_player_symbol = "O" if current_player_symbol == "X" else "X"
-        second_player_id = game_data["players"].get(second_player_symbol)
+        second_player_symbol = game.waiting_player
+        second_player_id = game.player(second_player_symbol)
 
         if not second_player_id:
-            logger.debug(f"[button_click chat={chat_id}] No second player yet. "
-                         f"Clicker user_id={user_id}, Current player symbol={current_player_symbol}, "
-                         f"Current player_id={current_player_id}. Comparing user_id != current_player_id.")
+            logger.debug("[button_click chat=%s] No second player yet. "
+                         "Clicker user_id=%s, Current player symbol=%s, "
+                         "Current player_id=%s. Comparing user_id != current_player_id.",
+                         chat_id, user_id, current_player_symbol, current_player_id)
             # Если нажавший НЕ является первым игроком (который сейчас ходит)
             if user_id != current_player_id:
                 # Проверяем, не является ли пользователь ботом
                 if context.bot.id == user_id:
                     # Если это бот, отклоняем его присоединение к игре
-                    logger.warning(f"[button_click chat={chat_id}] Bot attempted to join game as P2. Rejecting.")
-                    await query.answer("Бот не может присоединиться к игре как игрок!", show_alert=True)
+                    logger.warning("[button_click chat=%s] Bot attempted to join game as P2. Rejecting.", chat_id)
+                    await outbound.answer(query, "Бот не может присоединиться к игре как игрок!", show_alert=True)
                     return
                 
                 # !!! ДОБАВЛЕНО ДИАГНОСТИЧЕСКОЕ ЛОГИРОВАНИЕ !!!
-                logger.warning(f"[button_click chat={chat_id}] *** UNEXPECTED JOIN *** "
-                             f"Joining user {user_id} ({username}) as P2. "
-                             f"Current player was {current_player_id}. "
-                             f"This block should NOT execute if user_id == current_player_id.")
+                logger.warning("[button_click chat=%s] *** UNEXPECTED JOIN *** "
+                               "Joining user %s (%s) as P2. "
+                               "Current player was %s. "
+                               "This block should NOT execute if user_id == current_player_id.",
+                               chat_id, user_id, username, current_player_id)
                 # Присоединяем нажавшего как второго игрока
-                game_data["players"][second_player_symbol] = user_id
-                game_data["user_symbols"][user_id] = second_player_symbol
-                game_data["usernames"][user_id] = username
+                game.join(second_player_symbol, user_id, username)
+                games.mark_dirty(chat_id)
                 second_player_id = user_id # Обновляем для дальнейших проверок
-                logger.info(f"Player 2 ({username}, {user_id}) joined the game in chat {chat_id} playing as {second_player_symbol}.")
+                logger.info("Player 2 (%s, %s) joined the game in chat %s playing as %s.", username, user_id, chat_id, second_player_symbol)
 
                 # Убираем таймер, так как второй игрок присоединился
-                timeout_job = game_data.get('timeout_job')
-                if timeout_job:
-                    timeout_job.schedule_removal()
-                    game_data['timeout_job'] = None # Убираем ссылку на задачу
-                    logger.info(f"Removed timeout job for chat {chat_id} as second player joined.")
+                if timeouts.cancel(chat_id):
+                    logger.info("Removed timeout for chat %s as second player joined.", chat_id)
 
                  # Отправляем обновленное сообщение с информацией о втором игроке
-                initiator_id = game_data["players"][current_player_symbol] # ID первого игрока
-                initiator_username = game_data["usernames"].get(initiator_id, f"player_{initiator_id}")
+                initiator_username = game.username(current_player_symbol) # Первый игрок
                 escaped_initiator = escape_markdown(initiator_username, version=1)
                 escaped_second = escape_markdown(username, version=1)
                 # Используем эмодзи из темы
                 p1_emoji = get_symbol_emoji(current_player_symbol, game_theme_emojis)
                 p2_emoji = get_symbol_emoji(second_player_symbol, game_theme_emojis)
-                current_player_emoji = get_symbol_emoji(game_data["current_player"], game_theme_emojis) # Текущий ходящий
-
-                try:
-                    await query.edit_message_text(
-                        f"🎲 *Игра началась!* 🎲\n\n"
-                        f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
-                        f"👤 {escaped_initiator} играет за {p1_emoji}\n"
-                        f"👤 {escaped_second} играет за {p2_emoji}\n\n"
-                        f"*Ходит*: {current_player_emoji}", # Показываем, кто ходит
-                        reply_markup=get_keyboard(chat_id), # Обновляем поле
-                        parse_mode="Markdown"
-                    )
-                except telegram.error.RetryAfter as e:
-                     logger.warning(f"Flood control exceeded trying to update message after player 2 joined: {e}")
-                     await asyncio.sleep(e.retry_after)
-                     try: # Повторная попытка
-                        await query.edit_message_text(
-                             f"🎲 *Игра началась!* 🎲\n\n"
-                             f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
-                             f"👤 {escaped_initiator} играет за {p1_emoji}\n"
-                             f"👤 {escaped_second} играет за {p2_emoji}\n\n"
-                             f"*Ходит*: {current_player_emoji}",
-                             reply_markup=get_keyboard(chat_id),
-                             parse_mode="Markdown"
-                         )
-                     except Exception as inner_e:
-                         logger.error(f"Failed to edit message even after retry: {inner_e}")
-                except telegram.error.BadRequest as e:
-                     logger.error(f"Failed to edit message after player 2 joined (maybe deleted?): {e}")
-                except Exception as e:
-                     logger.error(f"Unexpected error editing message after player 2 joined: {e}", exc_info=True)
+                current_player_emoji = get_symbol_emoji(game.current_player, game_theme_emojis) # Текущий ходящий
+
+                # Правка уходит через общий планировщик: он сам соблюдает лимиты
+                # и повторяет запрос после RetryAfter, обработчик не ждет
+                outbound.edit_game_message(
+                    context.bot, game, chat_id, message_id,
+                    f"🎲 *Игра началась!* 🎲\n\n"
+                    f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
+                    f"👤 {escaped_initiator} играет за {p1_emoji}\n"
+                    f"👤 {escaped_second} играет за {p2_emoji}\n\n"
+                    f"*Ходит*: {current_player_emoji}", # Показываем, кто ходит
+                    reply_markup=get_keyboard(chat_id), # Обновляем поле
+                    parse_mode="Markdown"
+                )
 
                 # После присоединения второго игрока выходим, ход будет сделан следующим нажатием
                 return
 
             # Если нажавший ЯВЛЯЕТСЯ первым игроком
             else:
-                 logger.debug(f"[button_click chat={chat_id}] First player clicked before second joined. User ID {user_id}. Sending wait message.")
-                 await query.answer("⏳ Дождитесь второго игрока!", show_alert=False)
+                 logger.debug("[button_click chat=%s] First player clicked before second joined. User ID %s. Sending wait message.", chat_id, user_id)
+                 await outbound.answer(query, "⏳ Дождитесь второго игрока!", show_alert=False)
                  return # <-- Важно: выходим, не даем ходить
         # -- Конец проверки второго игрока --
 
         # -- Проверка: Ход текущего игрока? --
         if user_id != current_player_id:
-            current_player_username = game_data["usernames"].get(current_player_id, f"player_{current_player_id}")
-            await query.answer(f"⏱️ Не ваш ход! Сейчас ходит {current_player_username}", show_alert=False)
+            current_player_username = game.username(current_player_symbol)
+            await outbound.answer(query, f"⏱️ Не ваш ход! Сейчас ходит {current_player_username}", show_alert=False)
             return
 
         # -- Проверка: Клетка свободна? --
-        board = game_data["board"]
-        if not isinstance(board[cell_index], int):
-            await query.answer("Эта клетка уже занята!", show_alert=True)
+        board = game.board
+        if not board.is_free(cell_index):
+            await outbound.answer(query, "Эта клетка уже занята!", show_alert=True)
             return
 
-        # --- Выполнение хода ---
-        board[cell_index] = current_player_symbol
-        logger.info(f"Player {username} ({user_id}) marked cell {cell_index} with {current_player_symbol} in chat {chat_id}.")
-
-        # --- Проверка победителя ---
-        winner, winning_indices = check_winner(board)
-        if winner:
-            game_data["game_over"] = True
-            # Отменяем таймер, если он был активен (хотя он должен был отмениться при входе второго игрока)
-            timeout_job = game_data.get('timeout_job')
-            if timeout_job:
-                timeout_job.schedule_removal()
-                game_data['timeout_job'] = None
-                logger.info(f"Removed timeout job for chat {chat_id} as game ended with a winner.")
-
-            keyboard_to_show = None # Инициализация переменной для клавиатуры
-            if winner == "Ничья":
-                message_text = f"🏁 *Ничья!* 🏁\n\nИгра завершена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*"
-                logger.info(f"Game in chat {chat_id} ended in a draw.")
-                keyboard_to_show = get_keyboard(chat_id) # Обычная клавиатура для ничьей
-            else: # Есть победитель
-                 winner_id = game_data["players"][winner]
-                 winner_username = game_data["usernames"].get(winner_id, f"player_{winner_id}")
-                 escaped_winner = escape_markdown(winner_username, version=1)
-                 winner_emoji = get_symbol_emoji(winner, game_theme_emojis) # Эмодзи победителя
-                 message_text = f"🏆 *Победитель - {escaped_winner} ({winner_emoji})!* 🏆\n\nИгра завершена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*"
-                 logger.info(f"Game in chat {chat_id} won by {winner_username} ({winner_id}) playing as {winner}.")
-                 # Передаем winning_indices в get_keyboard для подсветки
-                 keyboard_to_show = get_keyboard(chat_id, winning_indices=winning_indices)
-
-            # Обновляем сообщение с результатом и кнопкой "Новая игра"
-            try:
-                await query.edit_message_text(
-                    message_text,
-                    reply_markup=keyboard_to_show, # Используем подготовленную клавиатуру
-                    parse_mode="Markdown"
-                )
-            except telegram.error.RetryAfter as e:
-                 logger.warning(f"Flood control exceeded trying to update message on game end: {e}")
-                 await asyncio.sleep(e.retry_after)
-                 try: # Повторная попытка
-                     await query.edit_message_text(message_text, reply_markup=keyboard_to_show, parse_mode="Markdown")
-                 except Exception as inner_e:
-                     logger.error(f"Failed to edit message on game end even after retry: {inner_e}")
-            except telegram.error.BadRequest as e:
-                logger.error(f"Failed to edit message on game end (maybe deleted?): {e}")
-            except Exception as e:
-                logger.error(f"Unexpected error editing message on game end: {e}", exc_info=True)
-
-            chat_id = update.effective_chat.id
-            stats = chat_stats.setdefault(chat_id, {"games": 0, "wins": 0, "draws": 0, "top_players": {}})
-            stats["games"] += 1
-            if winner == "Ничья":
-                stats["draws"] += 1
-            else:
-                stats["wins"] += 1
-                winner_id = game_data["players"][winner]
-                winner_name = game_data["usernames"].get(winner_id, str(winner_id))
-                stats["top_players"][winner_name] = stats["top_players"].get(winner_name, 0) + 1
-
-        else:
-            # --- Передача хода ---
-            game_data["current_player"] = second_player_symbol
-            next_player_id = game_data["players"][second_player_symbol]
-            next_player_username = game_data["usernames"].get(next_player_id, f"player_{next_player_id}")
-            escaped_next_player = escape_markdown(next_player_username, version=1)
-
-            # Обновляем сообщение с новым полем и информацией о следующем ходе
-            # Используем эмодзи из темы
-            p1_id = game_data["players"]["X"]
-            p2_id = game_data["players"]["O"]
-            p1_username = game_data["usernames"].get(p1_id, f"player_{p1_id}")
-            p2_username = game_data["usernames"].get(p2_id, f"player_{p2_id}")
-            p1_emoji = get_symbol_emoji("X", game_theme_emojis)
-            p2_emoji = get_symbol_emoji("O", game_theme_emojis)
-            next_player_emoji = get_symbol_emoji(game_data["current_player"], game_theme_emojis)
-
-            message_text = (
-                 f"🎲 *Игра идет!* 🎲\n\n"
-                 f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
-                 f"👤 {escape_markdown(p1_username, version=1)} ({p1_emoji}) vs {escape_markdown(p2_username, version=1)} ({p2_emoji})\n\n"
-                 f"*Ходит*: {escaped_next_player} ({next_player_emoji})"
+        # --- Выполнение хода и проверка победителя (только линии через эту клетку) ---
+        winner, winning_indices = board.play(cell_index, current_player_symbol)
+        logger.info("Player %s (%s) marked cell %s with %s in chat %s.", username, user_id, cell_index, current_player_symbol, chat_id)
+        if not winner and not game.ai_level:
+            game.current_player = second_player_symbol # Передача хода
+        elif not winner and board.geometry is CLASSIC:
+            # Бот отвечает в том же обновлении: одна правка сообщения на оба хода
+            bot_cell = ai_player.choose_move(board.x, board.o, second_player_symbol, game.ai_level)
+            winner, winning_indices = board.play(bot_cell, second_player_symbol)
+            logger.info("Bot (%s) marked cell %s with %s in chat %s.", game.ai_level, bot_cell, second_player_symbol, chat_id)
+        elif not winner:
+            # На большом поле ход бота ищется в пуле процессов (ai_service.py), event loop
+            # не ждет: сейчас показываем ход игрока, ответ бота придет отдельной правкой
+            game.current_player = second_player_symbol
+            ai_service.request(
+                chat_id, board, second_player_symbol, game.ai_level,
+                functools.partial(play_bot_move, context.bot, chat_id, message_id, game.game_id, board.moves),
             )
-            try:
-                await query.edit_message_text(
-                    message_text,
-                    reply_markup=get_keyboard(chat_id),
-                    parse_mode="Markdown"
-                )
-            except telegram.error.RetryAfter as e:
-                 logger.warning(f"Flood control exceeded trying to update message on turn change: {e}")
-                 await asyncio.sleep(e.retry_after)
-                 try: # Повторная попытка
-                     await query.edit_message_text(message_text, reply_markup=get_keyboard(chat_id), parse_mode="Markdown")
-                 except Exception as inner_e:
-                     logger.error(f"Failed to edit message on turn change even after retry: {inner_e}")
-            except telegram.error.BadRequest as e:
-                 # Частая ошибка - сообщение не изменилось. Игнорируем ее.
-                 if "Message is not modified" not in str(e):
-                      logger.error(f"Failed to edit message on turn change (maybe deleted or unmodified?): {e}")
-            except Exception as e:
-                 logger.error(f"Unexpected error editing message on turn change: {e}", exc_info=True)
+        show_move_result(context.bot, chat_id, message_id, game, winner, winning_indices)
 
     return # Ход обработан
 
-# --- Новая функция для обработки тайм-аута ---
-async def game_timeout(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Функция, вызываемая по таймеру, если второй игрок не присоединился."""
-    job_context = context.job.data
-    chat_id = job_context['chat_id']
-    message_id = job_context.get('message_id') # Получаем message_id из контекста задачи
+def show_move_result(bot: telegram.Bot, chat_id: int, message_id: int | None, game: GameState,
+                     winner: str | None, winning_indices: list | None) -> None:
+    """Сохраняет игру после хода и правит игровое сообщение: итог игры или кто ходит следующим."""
+    game_theme_emojis = game.theme
+    if winner:
+        game.game_over = True
+        games.mark_dirty(chat_id)
+        # Отменяем таймер, если он был активен (хотя он должен был отмениться при входе второго игрока)
+        if timeouts.cancel(chat_id):
+            logger.info("Removed timeout for chat %s as game ended with a winner.", chat_id)
+
+        keyboard_to_show = None # Инициализация переменной для клавиатуры
+        if winner == DRAW:
+            message_text = f"🏁 *Ничья!* 🏁\n\nИгра завершена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*"
+            logger.info("Game in chat %s ended in a draw.", chat_id)
+            keyboard_to_show = get_keyboard(chat_id) # Обычная клавиатура для ничьей
+        else: # Есть победитель
+             winner_id = game.player(winner)
+             winner_username = game.username(winner)
+             escaped_winner = escape_markdown(winner_username, version=1)
+             winner_emoji = get_symbol_emoji(winner, game_theme_emojis) # Эмодзи победителя
+             message_text = f"🏆 *Победитель - {escaped_winner} ({winner_emoji})!* 🏆\n\nИгра завершена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*"
+             logger.info("Game in chat %s won by %s (%s) playing as %s.", chat_id, winner_username, winner_id, winner)
+             # Передаем winning_indices в get_keyboard для подсветки
+             keyboard_to_show = get_keyboard(chat_id, winning_indices=winning_indices)
+
+        # Обновляем сообщение с результатом и кнопкой "Новая игра"
+        outbound.edit_game_message(
+            bot, game, chat_id, message_id,
+            message_text,
+            reply_markup=keyboard_to_show, # Используем подготовленную клавиатуру
+            parse_mode="Markdown"
+        )
 
-    if chat_id in games:
-        game_data = games[chat_id]
-        # Проверяем, действительно ли игра еще ожидает второго игрока и не завершена
-        if not game_data.get('game_over') and not game_data['players'].get(game_data.get('current_player', 'X') if game_data.get('current_player', 'X') == 'O' else 'O'): # Проверка наличия второго игрока
-            game_data['game_over'] = True
-            game_theme_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY]) # Получаем тему
-            logger.info(f"Game in chat {chat_id} timed out waiting for the second player.")
-
-            # Пытаемся отредактировать исходное сообщение
+        stats = chat_stats.setdefault(chat_id, {"games": 0, "wins": 0, "draws": 0, "top_players": {}})
+        stats["games"] += 1
+        if winner == DRAW:
+            stats["draws"] += 1
+        else:
+            stats["wins"] += 1
+            winner_name = game.username(winner)
+            stats["top_players"][winner_name] = stats["top_players"].get(winner_name, 0) + 1
+
+    else:
+        games.mark_dirty(chat_id)
+
+        # Обновляем сообщение с новым полем и информацией о следующем ходе
+        message_text = game_turn_text(game)
+        # Неизменившееся сообщение не отправляется; если изменилась только
+        # клавиатура, уходит edit_message_reply_markup
+        outbound.edit_game_message(
+            bot, game, chat_id, message_id,
+            message_text,
+            reply_markup=get_keyboard(chat_id),
+            parse_mode="Markdown"
+        )
+
+async def play_bot_move(bot: telegram.Bot, chat_id: int, message_id: int | None, game_id: str, moves: int, cell: int) -> None:
+    """Ход бота, найденный в пуле процессов (ai_service.py).
+
+    Делается под блокировкой чата и только если за время поиска игра не
+    сменилась и в ней не было других ходов.
+    """
+    async with chat_locks.lock(chat_id), games.exclusive(chat_id):
+        game = games.get(chat_id)
+        if game is None or game.game_over or game.game_id != game_id or game.board.moves != moves:
+            logger.info("Dropped bot move in chat %s: the game changed during the search.", chat_id)
+            return
+        game.touch()
+        symbol = game.current_player
+        winner, winning_indices = game.board.play(cell, symbol)
+        logger.info("Bot (%s) marked cell %s with %s in chat %s.", game.ai_level, cell, symbol, chat_id)
+        if not winner:
+            game.current_player = game.waiting_player
+        show_move_result(bot, chat_id, message_id, game, winner, winning_indices)
+
+# --- Новая функция для обработки тайм-аута ---
+async def game_timeout(bot: telegram.Bot, chat_id: int, message_id: int | None) -> None:
+    """Функция, вызываемая колесом таймеров, если второй игрок не присоединился."""
+
+    # Проверка и game_over = True - под блокировкой чата, в этом процессе и между воркерами
+    # (обработчик мог как раз присоединить второго игрока)
+    async with chat_locks.lock(chat_id), games.exclusive(chat_id):
+        game = games.get(chat_id)
+        timed_out = game is not None and not game.game_over and not game.player(game.waiting_player)
+        if timed_out:
+            game.game_over = True
+            games.mark_dirty(chat_id)
+
+    if game is not None:
+        # Игра действительно ждала второго игрока - сообщаем об отмене
+        if timed_out:
+            game_theme_emojis = game.theme # Получаем тему
+            logger.info("Game in chat %s timed out waiting for the second player.", chat_id)
+
+            timeout_text = f"⌛ *Время вышло!* ⌛\n\nВторой игрок не присоединился. Игра отменена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*"
+            new_game_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")]]) # Добавляем кнопку "Новая игра"
+
+            # Пытаемся отредактировать исходное сообщение (RetryAfter повторяет планировщик)
             if message_id:
                 try:
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text=f"⌛ *Время вышло!* ⌛\n\nВторой игрок не присоединился. Игра отменена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")]]), # Добавляем кнопку "Новая игра"
-                        parse_mode="Markdown"
+                    await outbound.edit_game_message(
+                        bot, game, chat_id, message_id, timeout_text,
+                        reply_markup=new_game_markup, parse_mode="Markdown"
                     )
-                    logger.info(f"Edited game message {message_id} in chat {chat_id} to show timeout.")
-                    game_data['timeout_job'] = None # Очищаем ссылку на выполненную задачу
+                    logger.info("Edited game message %s in chat %s to show timeout.", message_id, chat_id)
+                    return
                 except telegram.error.BadRequest as e:
-                    logger.error(f"Failed to edit message {message_id} on timeout (maybe deleted?): {e}")
-                    # Даже если не удалось отредактировать, задача выполнена
-                    game_data['timeout_job'] = None
-                    # Если редактирование не удалось, отправляем новое сообщение
-                    try:
-                        await context.bot.send_message(
-                            chat_id=chat_id,
-                            text=f"⌛ *Время вышло!* ⌛\n\nВторой игрок не присоединился. Игра отменена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*",
-                             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")]]),
-                             parse_mode="Markdown"
-                        )
-                        game_data['timeout_job'] = None # Очищаем ссылку на выполненную задачу
-                    except Exception as send_e:
-                         logger.error(f"Failed to send timeout message in chat {chat_id}: {send_e}")
-                         # Все равно очищаем, т.к. таймер сработал
-                         game_data['timeout_job'] = None
-
+                    logger.error("Failed to edit message %s on timeout (maybe deleted?): %s", message_id, e)
                 except Exception as e:
-                     logger.error(f"Unexpected error editing message on timeout in chat {chat_id}: {e}", exc_info=True)
-                     game_data['timeout_job'] = None # Очищаем ссылку на всякий случай
+                    logger.error("Unexpected error editing message on timeout in chat %s: %s", chat_id, e, exc_info=True)
+                    return
             else:
-                logger.warning(f"Message ID not found for timed out game in chat {chat_id}, cannot edit original message.")
-                # Отправляем новое сообщение, т.к. старое редактировать не можем
-                try:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                         text=f"⌛ *Время вышло!* ⌛\n\nВторой игрок не присоединился. Игра отменена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*",
-                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")]]),
-                         parse_mode="Markdown"
-                    )
-                    game_data['timeout_job'] = None # Очищаем ссылку на выполненную задачу
-                except Exception as send_e:
-                     logger.error(f"Failed to send timeout message in chat {chat_id}: {send_e}")
-                     game_data['timeout_job'] = None # Очищаем ссылку на всякий случай
+                logger.warning("Message ID not found for timed out game in chat %s, cannot edit original message.", chat_id)
 
-        elif game_data.get('timeout_job'):
+            # Если редактирование невозможно или не удалось, отправляем новое сообщение
+            try:
+                await outbound.send_message(
+                    bot, chat_id, timeout_text,
+                    reply_markup=new_game_markup, parse_mode="Markdown"
+                )
+            except Exception as send_e:
+                logger.error("Failed to send timeout message in chat %s: %s", chat_id, send_e)
+
+        else:
              # Если таймер сработал, но игра уже началась или завершилась, просто логируем
-             logger.info(f"Timeout job executed for chat {chat_id}, but the game state was already active or finished. No action taken.")
-             # Убираем ссылку на задачу на всякий случай
-             game_data['timeout_job'] = None
+             logger.info("Timeout fired for chat %s, but the game state was already active or finished. No action taken.", chat_id)
 
     else:
-        logger.warning(f"Timeout job executed for chat {chat_id}, but no game data found.")
+        logger.warning("Timeout job executed for chat %s, but no game data found.", chat_id)
 
 # --- Новые функции для тем ---
 async def themes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -715,18 +740,19 @@ async def themes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         parse_mode="Markdown"
     )
 
-async def select_theme_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик нажатия кнопки выбора темы."""
+async def select_theme_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, theme_key: str | None = None) -> None:
+    """Обработчик нажатия кнопки выбора темы. theme_key уже разобран callback_router."""
     query = update.callback_query
-    await query.answer() # Убираем часики
+    await outbound.answer(query) # Убираем часики
 
-    theme_key = query.data.split("theme_select_")[-1]
+    if theme_key is None:
+        theme_key = query.data.removeprefix(THEME_SELECT_PREFIX)
     user_id = update.effective_user.id
 
     if theme_key in THEMES:
         context.user_data['chosen_theme'] = theme_key
         chosen_theme = THEMES[theme_key]
-        logger.info(f"User {update.effective_user.username} ({user_id}) selected theme: {theme_key}")
+        logger.info("User %s (%s) selected theme: %s", update.effective_user.username, user_id, theme_key)
 
         # Обновляем сообщение с кнопками, чтобы показать выбор
         buttons = []
@@ -738,8 +764,10 @@ async def select_theme_callback(update: Update, context: ContextTypes.DEFAULT_TY
             buttons.append([InlineKeyboardButton(button_text, callback_data=f"theme_select_{key}")])
         keyboard = InlineKeyboardMarkup(buttons)
 
+        chat_id = update.effective_chat.id
         try:
-            await query.edit_message_text(
+            await outbound.edit_message_text(
+                context.bot, chat_id, query.message.message_id,
                 f"🎨 *Выбор темы игры* 🎨\n\n"
                 f"✅ Тема выбрана: *{chosen_theme['name']} {chosen_theme['X']}/{chosen_theme['O']}*\n\n"
                 f"Выберите другую тему или начните игру:",
@@ -748,15 +776,16 @@ async def select_theme_callback(update: Update, context: ContextTypes.DEFAULT_TY
             )
         except telegram.error.BadRequest as e:
              # Сообщение могло быть удалено или слишком старое
-             logger.warning(f"Failed to edit themes message: {e}")
-             await update.effective_chat.send_message(
+             logger.warning("Failed to edit themes message: %s", e)
+             outbound.send_message(
+                 context.bot, chat_id,
                  f"✅ Тема изменена на: *{chosen_theme['name']} {chosen_theme['X']}/{chosen_theme['O']}*",
                  parse_mode="Markdown"
              )
 
     else:
-        logger.warning(f"Invalid theme key received: {theme_key}")
-        await query.answer("Некорректная тема!", show_alert=True)
+        logger.warning("Invalid theme key received: %s", theme_key)
+        await outbound.answer(query, "Некорректная тема!", show_alert=True)
 
 # --- Новые функции для смены темы во время игры ---
 
@@ -767,34 +796,27 @@ async def change_theme_prompt_callback(update: Update, context: ContextTypes.DEF
     chat_id = update.effective_chat.id
 
     if chat_id not in games:
-        await query.answer("Игра не найдена.", show_alert=True)
+        await outbound.answer(query, "Игра не найдена.", show_alert=True)
         return
 
-    game_data = games[chat_id]
+    game = games[chat_id]
+    game.touch()
 
     # Проверка, что игра не завершена
-    if game_data.get('game_over', True):
-        await query.answer("Игра уже завершена.", show_alert=True)
+    if game.game_over:
+        await outbound.answer(query, "Игра уже завершена.", show_alert=True)
         return
 
     # Проверка, является ли пользователь игроком
-    player_symbols = [sym for sym, pid in game_data["players"].items() if pid == user_id]
-    if not player_symbols:
-        await query.answer("Только игроки могут менять тему.", show_alert=True)
+    if not game.is_player(user_id):
+        await outbound.answer(query, "Только игроки могут менять тему.", show_alert=True)
         return
         
-    await query.answer() # Убираем часики
+    await outbound.answer(query) # Убираем часики
 
     # Показываем кнопки выбора темы вместо игрового поля
     buttons = []
-    current_game_theme_key = None
-    # Найдем ключ текущей темы игры для отметки
-    current_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY])
-    for key, theme in THEMES.items():
-        if theme == current_emojis:
-            current_game_theme_key = key
-            break
-            
+    current_game_theme_key = game.theme_key
     for key, theme in THEMES.items():
         button_text = f"{theme['name']} {theme['X']}/{theme['O']}"
         # Отмечаем текущую тему игры
@@ -808,61 +830,62 @@ async def change_theme_prompt_callback(update: Update, context: ContextTypes.DEF
     keyboard = InlineKeyboardMarkup(buttons)
     
     try:
-        await query.edit_message_text(
+        await outbound.edit_game_message(
+            context.bot, game, chat_id, query.message.message_id,
             f"🎨 *Смена темы во время игры* 🎨\n\n"
             f"Выберите новую тему для текущей игры. Это также обновит вашу тему по умолчанию для будущих игр.",
             reply_markup=keyboard,
             parse_mode="Markdown"
         )
-        logger.info(f"User {user_id} initiated theme change prompt in game in chat {chat_id}")
+        logger.info("User %s initiated theme change prompt in game in chat %s", user_id, chat_id)
     except telegram.error.BadRequest as e:
-        logger.error(f"Failed to show theme selection prompt in chat {chat_id}: {e}")
-        await query.answer("Не удалось отобразить выбор темы.", show_alert=True)
+        logger.error("Failed to show theme selection prompt in chat %s: %s", chat_id, e)
+        await outbound.answer(query, "Не удалось отобразить выбор темы.", show_alert=True)
 
-async def select_theme_ingame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик выбора темы во время игры."""
+async def select_theme_ingame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, theme_key: str | None = None) -> None:
+    """Обработчик выбора темы во время игры. theme_key уже разобран callback_router."""
     query = update.callback_query
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    theme_key = query.data.split("theme_select_ingame_")[-1]
+    if theme_key is None:
+        theme_key = query.data.removeprefix(THEME_SELECT_INGAME_PREFIX)
 
     if chat_id not in games:
-        await query.answer("Игра не найдена.", show_alert=True)
+        await outbound.answer(query, "Игра не найдена.", show_alert=True)
         return
         
-    game_data = games[chat_id]
+    game = games[chat_id]
+    game.touch()
 
     # Проверка, является ли пользователь игроком
-    player_symbols = [sym for sym, pid in game_data["players"].items() if pid == user_id]
-    if not player_symbols:
-        await query.answer("Только игроки могут подтвердить смену темы.", show_alert=True)
+    if not game.is_player(user_id):
+        await outbound.answer(query, "Только игроки могут подтвердить смену темы.", show_alert=True)
         return
         
     if theme_key not in THEMES:
-        await query.answer("Некорректная тема.", show_alert=True)
-        logger.warning(f"Invalid ingame theme key received: {theme_key} from user {user_id}")
+        await outbound.answer(query, "Некорректная тема.", show_alert=True)
+        logger.warning("Invalid ingame theme key received: %s from user %s", theme_key, user_id)
         return
 
-    await query.answer(f"Тема '{THEMES[theme_key]['name']}' применена!") 
+    await outbound.answer(query, f"Тема '{THEMES[theme_key]['name']}' применена!") 
 
     # 1. Обновляем тему текущей игры
-    game_data['theme_emojis'] = THEMES[theme_key]
+    game.theme_key = theme_key
+    games.mark_dirty(chat_id)
     # 2. Обновляем предпочтение пользователя
     context.user_data['chosen_theme'] = theme_key
-    logger.info(f"User {user_id} changed ingame theme to {theme_key} in chat {chat_id}. User preference also updated.")
+    logger.info("User %s changed ingame theme to %s in chat %s. User preference also updated.", user_id, theme_key, chat_id)
 
     # 3. Восстанавливаем сообщение игры с новой темой и старой клавиатурой
-    game_theme_emojis = game_data['theme_emojis'] # Уже обновлено
+    game_theme_emojis = game.theme # Уже обновлено
     # Формируем текст статуса (логика похожа на button_click при смене хода)
-    current_player_symbol = game_data['current_player']
-    current_player_id = game_data['players'].get(current_player_symbol)
-    current_player_username = game_data['usernames'].get(current_player_id, f"player_{current_player_id}")
-    escaped_current_player = escape_markdown(current_player_username, version=1)
+    current_player_symbol = game.current_player
+    escaped_current_player = escape_markdown(game.username(current_player_symbol), version=1)
     
-    p1_id = game_data["players"].get("X")
-    p2_id = game_data["players"].get("O")
-    p1_username = game_data["usernames"].get(p1_id, f"player_{p1_id}") if p1_id else "?"
-    p2_username = game_data["usernames"].get(p2_id, f"player_{p2_id}") if p2_id else "Ожидание"
+    p1_id = game.player_x
+    p2_id = game.player_o
+    p1_username = game.username("X") if p1_id else "?"
+    p2_username = game.username("O") if p2_id else "Ожидание"
     
     p1_emoji = get_symbol_emoji("X", game_theme_emojis)
     p2_emoji = get_symbol_emoji("O", game_theme_emojis)
@@ -883,19 +906,15 @@ async def select_theme_ingame_callback(update: Update, context: ContextTypes.DEF
             f"👤 {escape_markdown(p1_username, version=1)} играет за {p1_emoji}\n"
             f"⏳ Ожидаем второго игрока...\n\n"
             f"*Первым ходит*: {current_player_emoji}\n\n"
-            f"⏱️ *Время на игру*: 90 секунд"
+            f"⏱️ *Время на игру*: {GAME_TIMEOUT_SECONDS} секунд"
         )
         
-    try:
-        await query.edit_message_text(
-            message_text,
-            reply_markup=get_keyboard(chat_id), # Восстанавливаем игровую клавиатуру
-            parse_mode="Markdown"
-        )
-    except telegram.error.BadRequest as e:
-        logger.error(f"Failed to restore game message after ingame theme change in chat {chat_id}: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error restoring game message after ingame theme change in chat {chat_id}: {e}", exc_info=True)
+    outbound.edit_game_message(
+        context.bot, game, chat_id, query.message.message_id,
+        message_text,
+        reply_markup=get_keyboard(chat_id), # Восстанавливаем игровую клавиатуру
+        parse_mode="Markdown"
+    )
 
 async def cancel_theme_change_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик кнопки 'Назад к игре' при смене темы."""
@@ -904,32 +923,30 @@ async def cancel_theme_change_callback(update: Update, context: ContextTypes.DEF
     chat_id = update.effective_chat.id
 
     if chat_id not in games:
-        await query.answer("Игра не найдена.", show_alert=True)
+        await outbound.answer(query, "Игра не найдена.", show_alert=True)
         return
         
-    game_data = games[chat_id]
+    game = games[chat_id]
+    game.touch()
     
-    # Проверка, является ли пользователь игроком (хотя бы чтоб наверняка)
-    player_symbols = [sym for sym, pid in game_data["players"].items() if pid == user_id]
-    if not player_symbols and user_id not in game_data["players"].values(): # Двойная проверка
-        await query.answer("Только игроки могут отменить смену темы.", show_alert=True)
+    # Проверка, является ли пользователь игроком
+    if not game.is_player(user_id):
+        await outbound.answer(query, "Только игроки могут отменить смену темы.", show_alert=True)
         return
 
-    await query.answer("Смена темы отменена.")
-    logger.info(f"User {user_id} cancelled ingame theme change in chat {chat_id}.")
+    await outbound.answer(query, "Смена темы отменена.")
+    logger.info("User %s cancelled ingame theme change in chat %s.", user_id, chat_id)
 
     # Восстанавливаем сообщение игры с текущей темой и клавиатурой
-    game_theme_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY])
+    game_theme_emojis = game.theme
     # Формируем текст статуса (как в select_theme_ingame_callback, но без пометки "изменена")
-    current_player_symbol = game_data['current_player']
-    current_player_id = game_data['players'].get(current_player_symbol)
-    current_player_username = game_data['usernames'].get(current_player_id, f"player_{current_player_id}")
-    escaped_current_player = escape_markdown(current_player_username, version=1)
+    current_player_symbol = game.current_player
+    escaped_current_player = escape_markdown(game.username(current_player_symbol), version=1)
     
-    p1_id = game_data["players"].get("X")
-    p2_id = game_data["players"].get("O")
-    p1_username = game_data["usernames"].get(p1_id, f"player_{p1_id}") if p1_id else "?"
-    p2_username = game_data["usernames"].get(p2_id, f"player_{p2_id}") if p2_id else "Ожидание"
+    p1_id = game.player_x
+    p2_id = game.player_o
+    p1_username = game.username("X") if p1_id else "?"
+    p2_username = game.username("O") if p2_id else "Ожидание"
     
     p1_emoji = get_symbol_emoji("X", game_theme_emojis)
     p2_emoji = get_symbol_emoji("O", game_theme_emojis)
@@ -949,19 +966,15 @@ async def cancel_theme_change_callback(update: Update, context: ContextTypes.DEF
             f"👤 {escape_markdown(p1_username, version=1)} играет за {p1_emoji}\n"
             f"⏳ Ожидаем второго игрока...\n\n"
             f"*Первым ходит*: {current_player_emoji}\n\n"
-            f"⏱️ *Время на игру*: 90 секунд"
+            f"⏱️ *Время на игру*: {GAME_TIMEOUT_SECONDS} секунд"
         )
 
-    try:
-        await query.edit_message_text(
-            message_text,
-            reply_markup=get_keyboard(chat_id), # Восстанавливаем игровую клавиатуру
-            parse_mode="Markdown"
-        )
-    except telegram.error.BadRequest as e:
-        logger.error(f"Failed to restore game message after cancelling theme change in chat {chat_id}: {e}")
-    except Exception as e:
-         logger.error(f"Unexpected error restoring game message after cancelling theme change in chat {chat_id}: {e}", exc_info=True)
+    outbound.edit_game_message(
+        context.bot, game, chat_id, query.message.message_id,
+        message_text,
+        reply_markup=get_keyboard(chat_id), # Восстанавливаем игровую клавиатуру
+        parse_mode="Markdown"
+    )
 
 async def reset_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Сбросить игру в текущем чате (только для владельца)."""
@@ -970,9 +983,11 @@ async def reset_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         return
     chat_id = update.effective_chat.id
     if chat_id in games:
+        timeouts.cancel(chat_id)
+        ai_service.cancel(chat_id)
         del games[chat_id]
         await update.message.reply_text("♻️ Игра в этом чате сброшена.")
-        logger.info(f"Игра в чате {chat_id} сброшена владельцем.")
+        logger.info("Игра в чате %s сброшена владельцем.", chat_id)
     else:
         await update.message.reply_text("В этом чате нет активной игры.")
 
@@ -987,7 +1002,7 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     target = context.args[0].lstrip('@')
     banned_users.add(target)
     await update.message.reply_text(f"Пользователь {target} забанен.")
-    logger.info(f"Пользователь {target} забанен владельцем.")
+    logger.info("Пользователь %s забанен владельцем.", target)
 
 async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Разбанить пользователя по username или user_id (только для владельца)."""
@@ -1001,7 +1016,7 @@ async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if target in banned_users:
         banned_users.remove(target)
         await update.message.reply_text(f"Пользователь {target} разбанен.")
-        logger.info(f"Пользователь {target} разбанен владельцем.")
+        logger.info("Пользователь %s разбанен владельцем.", target)
     else:
         await update.message.reply_text(f"Пользователь {target} не был в бане.")
 
@@ -1024,15 +1039,32 @@ async def chat_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             msg.append(f"- {user}: {count}")
     await update.message.reply_text("\n".join(msg))
 
-async def main() -> None:
-    """Настраивает и запускает бота с вебхуком."""
+def observe_callback_route(route: str, seconds: float) -> None:
+    CALLBACK_ROUTE_SECONDS.observe(seconds, route)
 
-    if not TOKEN:
-        logger.critical("Переменная окружения TOKEN не установлена!")
-        sys.exit(1)
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Исключения обработчиков PTB: в лог и в счетчик handler_errors_total по виду обновления."""
+    HANDLER_ERRORS.inc(update_kind(update))
+    logger.error("Handler failed on update %s: %s", getattr(update, "update_id", None), context.error,
+                 exc_info=context.error)
+
+def build_application(request: BaseRequest | None = None) -> Application:
+    """Создает PTB приложение и регистрирует обработчики.
 
-    job_queue = JobQueue()
-    application = Application.builder().token(TOKEN).job_queue(job_queue).build()
+    request - свой транспорт Bot API (например, офлайн-заглушка в бенчмарках).
+    """
+    # Таймеры игр живут в общем колесе (timeouts.py), JobQueue не нужен.
+    # Обновления разных чатов обрабатываются параллельно, одного чата - по порядку (chat_locks.py)
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(BOT_API_BASE_URL)
+        .job_queue(None)
+        .concurrent_updates(PerChatUpdateProcessor())
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
 
     # --- Регистрация обработчиков PTB ---
     application.add_handler(CommandHandler("start", start))
@@ -1042,16 +1074,40 @@ async def main() -> None:
     application.add_handler(CommandHandler("ban", ban_user))
     application.add_handler(CommandHandler("unban", unban_user))
     application.add_handler(CommandHandler("chatstats", chat_stats_command))
-    application.add_handler(CallbackQueryHandler(button_click, pattern=r"^(noop|[0-8]|new_game)$"))
-    application.add_handler(CallbackQueryHandler(change_theme_prompt_callback, pattern=r"^change_theme_prompt$"))
-    application.add_handler(CallbackQueryHandler(select_theme_ingame_callback, pattern=r"^theme_select_ingame_"))
-    application.add_handler(CallbackQueryHandler(cancel_theme_change_callback, pattern=r"^cancel_theme_change$"))
-    application.add_handler(CallbackQueryHandler(select_theme_callback, pattern=r"^theme_select_"))
+    # Все инлайн-кнопки - один обработчик: callback_data разбирается один раз (callback_router.py)
+    callback_router.add(BOARD, button_click)
+    callback_router.add(CHANGE_THEME_PROMPT, change_theme_prompt_callback)
+    callback_router.add(THEME_SELECT_INGAME, select_theme_ingame_callback)
+    callback_router.add(CANCEL_THEME_CHANGE, cancel_theme_change_callback)
+    callback_router.add(THEME_SELECT, select_theme_callback)
+    application.add_handler(CallbackQueryHandler(callback_router.dispatch))
+    callback_router.add_hook(observe_callback_route)
+    application.add_error_handler(error_handler)
+    return application
+
+async def setup_application() -> Application:
+    """Создает и инициализирует PTB приложение, ставит вебхук и регистрирует маршрут FastAPI."""
+    global update_queue
+
+    application = build_application()
 
     logger.info("Инициализация PTB приложения...")
     await application.initialize()
     logger.info("PTB Приложение инициализировано.")
 
+    if KEYBOARD_CACHE_WARMUP:
+        keyboard_cache.warm_up(THEMES)
+    ai_player.build() # Таблица ходов бота считается один раз, до первого обновления
+
+    update_queue = UpdateQueue(application)
+
+    # Значения для /metrics читаются в момент запроса
+    metrics.gauge("games_live", "Games held by this process", lambda: len(games))
+    metrics.gauge("update_queue_depth", "Updates waiting in the update queue", lambda: update_queue.stats()["depth"])
+    metrics.gauge("outbound_pending", "Bot API requests waiting in outbound queues", lambda: outbound.stats()["pending"])
+    metrics.gauge("webhook_replies_waiting", "Callback queries waiting for an inline webhook reply",
+                  lambda: webhook_replies.stats()["waiting"])
+
     # --- Регистрация команд бота ---
     commands = [
         BotCommand("start", "👋 Запустить бота"),
@@ -1066,12 +1122,13 @@ async def main() -> None:
         await application.bot.set_my_commands(commands)
         logger.info("Команды бота успешно зарегистрированы.")
     except Exception as e:
-        logger.error(f"Ошибка регистрации команд: {e}")
+        logger.error("Ошибка регистрации команд: %s", e)
 
     # --- Настройка и установка вебхука (если URL задан) ---
+    # При нескольких воркерах это делает каждый из них: set_webhook с тем же URL идемпотентен
     if WEBHOOK_ENDPOINT_URL:
         try:
-            logger.info(f"Установка вебхука PTB на URL: {WEBHOOK_ENDPOINT_URL}")
+            logger.info("Установка вебхука PTB на URL: %s", WEBHOOK_ENDPOINT_URL)
             await application.bot.set_webhook(
                 url=WEBHOOK_ENDPOINT_URL,
                 allowed_updates=Update.ALL_TYPES
@@ -1079,9 +1136,9 @@ async def main() -> None:
             logger.info("Вебхук PTB успешно установлен.")
 
             # --- Регистрация маршрута вебхука FastAPI --- 
-            # Определяем функцию-обработчик внутри main, чтобы она имела доступ к 'application'
+            # Определяем функцию-обработчик здесь, чтобы она имела доступ к 'application'
             async def fastapi_webhook_endpoint(request: Request):
-                return await handle_telegram_update(request, application)
+                return await handle_telegram_update(request, application, update_queue)
             
             # Добавляем маршрут в FastAPI приложение
             fastapi_app.add_api_route(
@@ -1089,14 +1146,49 @@ async def main() -> None:
                 endpoint=fastapi_webhook_endpoint, 
                 methods=["POST"]
             )
-            logger.info(f"FastAPI эндпоинт {WEBHOOK_PATH} зарегистрирован.")
+            logger.info("FastAPI эндпоинт %s зарегистрирован.", WEBHOOK_PATH)
 
         except Exception as e:
-            logger.error(f"Ошибка установки вебхука или регистрации маршрута: {e}")
+            logger.error("Ошибка установки вебхука или регистрации маршрута: %s", e)
             # sys.exit(1) # Рассмотрите возможность остановки при ошибке вебхука
     else:
         logger.warning("WEBHOOK_ENDPOINT_URL не настроен. Вебхук не будет установлен!")
 
+    return application
+
+async def start_application(application: Application) -> None:
+    """Запускает PTB и фоновые компоненты."""
+    await application.start()
+    update_queue.start()
+    update_deduper.start()
+    traffic_recorder.start()
+    timeouts.start()
+    games.start()
+    game_sweeper.start(application.bot)
+
+async def stop_application(application: Application) -> None:
+    """Останавливает фоновые компоненты и PTB."""
+    logger.info("Остановка приложения...")
+    await update_queue.stop()
+    await update_deduper.stop() # Сохраняет максимальный update_id
+    await traffic_recorder.stop() # Дописывает буфер записи трафика
+    await timeouts.stop()
+    await game_sweeper.stop()
+    await ai_service.stop() # Отменяет поиски ходов бота и останавливает пул процессов
+    await games.stop() # Сбрасывает на диск несохраненные ходы
+    await outbound.stop()
+    await application.stop()
+    logger.info("PTB Приложение остановлено.")
+    # (Код удаления вебхука опционален)
+
+async def main() -> None:
+    """Настраивает и запускает бота с вебхуком (один процесс)."""
+    if not TOKEN:
+        logger.critical("Переменная окружения TOKEN не установлена!")
+        sys.exit(1)
+
+    application = await setup_application()
+
     # --- Настройка Uvicorn ---
     config = uvicorn.Config(
         app=fastapi_app, # Используем глобальное FastAPI приложение
@@ -1107,20 +1199,44 @@ async def main() -> None:
     server = uvicorn.Server(config)
 
     # --- Запуск PTB и Uvicorn ---
-    await application.start()
-    logger.info(f"Запуск веб-сервера на {config.host}:{config.port}...")
+    await start_application(application)
+    logger.info("Запуск веб-сервера на %s:%s...", config.host, config.port)
     await server.serve()
 
     # --- Остановка ---
-    logger.info("Остановка приложения...")
-    await application.stop()
-    logger.info("PTB Приложение остановлено.")
-    # (Код удаления вебхука опционален)
+    await stop_application(application)
+
+# --- Несколько воркеров uvicorn (WEB_WORKERS > 1) ---
+# Каждый воркер импортирует bot:fastapi_app и поднимает свое PTB приложение
+# в startup-хуке FastAPI. Игры лежат в общей памяти (shared_store.py), обновления
+# одного чата сериализуются между воркерами через games.exclusive
+worker_application: Application | None = None
+
+async def start_worker() -> None:
+    global worker_application
+    if not TOKEN:
+        logger.critical("Переменная окружения TOKEN не установлена!")
+        sys.exit(1)
+    worker_application = await setup_application()
+    await start_application(worker_application)
+    logger.info("Воркер %s запущен.", os.getpid())
+
+async def stop_worker() -> None:
+    if worker_application:
+        await stop_application(worker_application)
+
+if WEB_WORKERS > 1:
+    fastapi_app.router.add_event_handler("startup", start_worker)
+    fastapi_app.router.add_event_handler("shutdown", stop_worker)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if WEB_WORKERS > 1:
+            logger.info("Запуск %s воркеров uvicorn на 0.0.0.0:%s...", WEB_WORKERS, PORT)
+            uvicorn.run("bot:fastapi_app", host="0.0.0.0", port=PORT, workers=WEB_WORKERS)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Бот остановлен вручную.")
     except Exception as e:
-        logger.critical(f"Критическая ошибка при запуске: {e}", exc_info=True) 
\ No newline at end of file
+        logger.critical("Критическая ошибка при запуске: %s", e, exc_info=True)
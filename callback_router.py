@@ -0,0 +1,130 @@
+import logging
+import time
+from typing import Awaitable, Callable, NamedTuple
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from callback_sign import MOVE_PREFIX
+from game_engine import MAX_CELLS
+
+logger = logging.getLogger(__name__)
+
+# Маршруты. Для кнопок с параметром (темы) ключ темы уходит обработчику аргументом
+BOARD = "board"
+CHANGE_THEME_PROMPT = "change_theme_prompt"
+CANCEL_THEME_CHANGE = "cancel_theme_change"
+THEME_SELECT_INGAME = "theme_select_ingame"
+THEME_SELECT = "theme_select"
+
+THEME_SELECT_INGAME_PREFIX = "theme_select_ingame_"
+THEME_SELECT_PREFIX = "theme_select_"
+
+_EXACT = {
+    "noop": BOARD,
+    "new_game": BOARD,
+    CHANGE_THEME_PROMPT: CHANGE_THEME_PROMPT,
+    CANCEL_THEME_CHANGE: CANCEL_THEME_CHANGE,
+    **{str(cell): BOARD for cell in range(MAX_CELLS)},  # неподписанные клетки поля любого размера
+}
+
+
+class CallbackAction(NamedTuple):
+    route: str
+    arg: str | None = None
+
+
+def parse(data: str | None) -> CallbackAction | None:
+    """callback_data -> (маршрут, параметр) или None для неизвестной кнопки."""
+    if not data:
+        return None
+    route = _EXACT.get(data)
+    if route is not None:
+        return CallbackAction(route)
+    if data.startswith(MOVE_PREFIX):
+        return CallbackAction(BOARD)  # подпись проверяет button_click
+    if data.startswith(THEME_SELECT_PREFIX):
+        # Префикс "в игре" длиннее и начинается так же - проверяем его внутри
+        if data.startswith(THEME_SELECT_INGAME_PREFIX):
+            return CallbackAction(THEME_SELECT_INGAME, data[len(THEME_SELECT_INGAME_PREFIX):])
+        return CallbackAction(THEME_SELECT, data[len(THEME_SELECT_PREFIX):])
+    return None
+
+
+class _RouteStats:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class CallbackRouter:
+    """Один CallbackQueryHandler на все инлайн-кнопки.
+
+    Раньше было пять CallbackQueryHandler с regex-паттернами: PTB проверял
+    их по очереди на каждом нажатии, а обработчики тем еще раз делали
+    query.data.split(...). Роутер разбирает callback_data один раз (parse),
+    выбирает обработчик по словарю маршрутов и передает ему параметр кнопки.
+
+    Время каждого обработчика копится по маршрутам (stats) и передается
+    хукам add_hook(fn(route, seconds)) - например, для метрик.
+    """
+
+    def __init__(self):
+        self._routes: dict[str, Callable[..., Awaitable[None]]] = {}
+        self._stats: dict[str, _RouteStats] = {}
+        self._hooks: list[Callable[[str, float], None]] = []
+        self.unknown = 0
+
+    def add(self, route: str, handler: Callable[..., Awaitable[None]]) -> None:
+        self._routes[route] = handler
+        self._stats.setdefault(route, _RouteStats())
+
+    def add_hook(self, hook: Callable[[str, float], None]) -> None:
+        if hook not in self._hooks:
+            self._hooks.append(hook)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        action = parse(update.callback_query.data)
+        handler = self._routes.get(action.route) if action else None
+        if handler is None:
+            self.unknown += 1
+            logger.debug("No callback route for data %r", update.callback_query.data)
+            return
+
+        started = time.perf_counter()
+        try:
+            if action.arg is None:
+                await handler(update, context)
+            else:
+                await handler(update, context, action.arg)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats = self._stats[action.route]
+            stats.count += 1
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+            for hook in self._hooks:
+                try:
+                    hook(action.route, elapsed)
+                except Exception as e:
+                    logger.error("Callback route hook failed for %s: %s", action.route, e)
+
+    def stats(self) -> dict:
+        return {
+            "unknown": self.unknown,
+            "routes": {
+                route: {
+                    "count": stats.count,
+                    "avg_ms": round(stats.total / stats.count * 1000, 3) if stats.count else 0.0,
+                    "max_ms": round(stats.max * 1000, 3),
+                }
+                for route, stats in self._stats.items()
+            },
+        }
+
+
+callback_router = CallbackRouter()
@@ -0,0 +1,108 @@
+import base64
+import hashlib
+import hmac
+import os
+
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import CALLBACK_SECRET, TOKEN
+from game_engine import MAX_CELLS
+
+MOVE_PREFIX = "m:"
+GAME_ID_BYTES = 6  # 8 символов base64url
+MAC_BYTES = 8  # 11 символов base64url
+
+
+class CallbackSigner:
+    """Подписанные callback_data кнопок хода: `m:<клетка>:<ход>:<id игры>:<hmac>`.
+
+    Вместо голого "0".."8" кнопка несет короткий id игры, номер хода, на
+    котором построена клавиатура (board.moves), и усеченный HMAC-SHA256 от
+    chat_id и этих полей (~27 байт при лимите Telegram в 64). Поэтому:
+
+    - поддельную или испорченную кнопку видно без хранилища и без API
+      (decode вернет None);
+    - кнопку старой игры видно по id игры - без сравнения message_id и без
+      edit_message_reply_markup;
+    - повторное нажатие на тот же ход (двойной клик) видно по номеру хода
+      и просто игнорируется.
+
+    Ключ - CALLBACK_SECRET или, если он не задан, производный от токена бота:
+    одинаковый у всех воркеров и после перезапуска.
+    """
+
+    def __init__(self, secret: str = CALLBACK_SECRET, token: str | None = TOKEN):
+        if secret:
+            self._key = secret.encode()
+        else:
+            self._key = hashlib.sha256(b"callback_data:" + (token or "").encode()).digest()
+        # HMAC с уже обработанным ключом: на каждую кнопку - только copy() и update()
+        self._hmac = hmac.new(self._key, digestmod=hashlib.sha256)
+        self.signed = 0
+        self.reused = 0
+        self.verified = 0
+        self.forged = 0
+
+    @staticmethod
+    def new_game_id() -> str:
+        return base64.urlsafe_b64encode(os.urandom(GAME_ID_BYTES)).decode()
+
+    def _mac(self, chat_id: int, game_id: str, seq: int, cell: int) -> str:
+        mac = self._hmac.copy()
+        mac.update(f"{chat_id}:{game_id}:{seq}:{cell}".encode())
+        return base64.urlsafe_b64encode(mac.digest()[:MAC_BYTES]).decode().rstrip("=")
+
+    def encode(self, chat_id: int, game_id: str, seq: int, cell: int) -> str:
+        return f"{MOVE_PREFIX}{cell}:{seq}:{game_id}:{self._mac(chat_id, game_id, seq, cell)}"
+
+    def decode(self, chat_id: int, data: str) -> tuple[str, int, int] | None:
+        """(id игры, номер хода, клетка) или None, если кнопка испорчена или подделана."""
+        parts = data.split(":")
+        if len(parts) != 5 or parts[0] != MOVE_PREFIX[:-1] or not parts[1].isdigit() or not parts[2].isdigit():
+            self.forged += 1
+            return None
+        cell, seq, game_id, mac = int(parts[1]), int(parts[2]), parts[3], parts[4]
+        if cell >= MAX_CELLS or not hmac.compare_digest(mac, self._mac(chat_id, game_id, seq, cell)):
+            self.forged += 1
+            return None
+        self.verified += 1
+        return game_id, seq, cell
+
+    def sign_keyboard(self, markup: InlineKeyboardMarkup, chat_id: int, game_id: str, seq: int) -> InlineKeyboardMarkup:
+        """Копия клавиатуры из кэша (render_cache.py) с подписанными кнопками свободных клеток."""
+        self.signed += 1
+        return InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(button.text, callback_data=self.encode(chat_id, game_id, seq, int(button.callback_data)))
+                if button.callback_data.isdigit() else button
+                for button in row
+            ]
+            for row in markup.inline_keyboard
+        ])
+
+    def game_keyboard(self, markup: InlineKeyboardMarkup, chat_id: int, game) -> InlineKeyboardMarkup:
+        """Подписанная клавиатура игры `game` (GameState) для `markup` из кэша render_cache.py.
+
+        Подписанная копия запоминается в game.signed_markup и отдается снова,
+        пока не изменились ход и исходная клавиатура (тема, поле): повторная
+        отрисовка того же хода не считает HMAC для каждой свободной клетки.
+        """
+        seq = game.board.moves
+        cached = game.signed_markup
+        if cached is not None and cached[0] is markup and cached[1] == seq:
+            self.reused += 1
+            return cached[2]
+        signed = self.sign_keyboard(markup, chat_id, game.game_id, seq)
+        game.signed_markup = (markup, seq, signed)
+        return signed
+
+    def stats(self) -> dict:
+        return {
+            "signed_keyboards": self.signed,
+            "reused_keyboards": self.reused,
+            "verified": self.verified,
+            "forged": self.forged,
+        }
+
+
+callback_signer = CallbackSigner()
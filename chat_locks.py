@@ -0,0 +1,110 @@
+import asyncio
+import contextlib
+import time
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import UPDATE_WORKERS
+from game_store import games
+from metrics import CHAT_LOCK_WAIT_SECONDS, HANDLER_SECONDS, update_kind
+
+
+class _ChatLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0  # держатель + ожидающие
+
+
+class ChatLockRegistry:
+    """Реестр блокировок по chat_id.
+
+    Блокировка создается при первом обращении и удаляется, как только ее
+    никто не держит и не ждет, поэтому реестр не растет с числом чатов.
+    asyncio.Lock будит ожидающих в порядке очереди: обновления одного
+    чата обрабатываются строго в порядке захвата.
+    """
+
+    def __init__(self):
+        self._locks: dict[int, _ChatLock] = {}
+        self.acquired = 0
+        self.contended = 0
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def locked(self, chat_id: int) -> bool:
+        entry = self._locks.get(chat_id)
+        return entry is not None and entry.lock.locked()
+
+    @contextlib.asynccontextmanager
+    async def lock(self, chat_id: int):
+        entry = self._locks.get(chat_id)
+        if entry is None:
+            entry = self._locks[chat_id] = _ChatLock()
+        entry.users += 1
+        if entry.lock.locked():
+            self.contended += 1
+        try:
+            async with entry.lock:
+                self.acquired += 1
+                yield
+        finally:
+            entry.users -= 1
+            if not entry.users:
+                del self._locks[chat_id]
+
+    def stats(self) -> dict:
+        return {
+            "live_locks": len(self._locks),
+            "acquired": self.acquired,
+            "contended": self.contended,
+        }
+
+
+chat_locks = ChatLockRegistry()
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов, последовательная - одного чата.
+
+    Подключается через Application.builder().concurrent_updates(...): до
+    `max_concurrent_updates` обновлений обрабатываются одновременно, но
+    обработчики одного чата сериализуются через chat_locks, а между
+    воркерами uvicorn - через games.exclusive (общая память).
+
+    UpdateQueue сама не выдает обработчикам второе обновление чата, пока
+    идет первое, так что здесь блокировка чата ждет только фоновые задачи
+    (ход бота, таймауты), а не другие обновления того же чата.
+    """
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_WORKERS, locks: ChatLockRegistry = chat_locks):
+        super().__init__(max_concurrent_updates)
+        self.locks = locks
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await self._timed(update, coroutine)
+            return
+        waiting = time.perf_counter()
+        async with self.locks.lock(chat.id), games.exclusive(chat.id):
+            CHAT_LOCK_WAIT_SECONDS.observe(time.perf_counter() - waiting)
+            await self._timed(update, coroutine)
+
+    @staticmethod
+    async def _timed(update: object, coroutine: Awaitable[Any]) -> None:
+        started = time.perf_counter()
+        try:
+            await coroutine
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, update_kind(update))
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
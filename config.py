@@ -1,10 +1,16 @@
 import logging
 import os
 
-# Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.DEBUG
-)
+from log_pipeline import log_pipeline
+
+# Настройка логирования (см. log_pipeline.py): общий уровень, уровни отдельных
+# логгеров ("httpx=WARNING,bot=DEBUG"), прореживание DEBUG (каждая N-я запись
+# одного шаблона) и размер очереди записей
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING")
+LOG_DEBUG_SAMPLE_EVERY = int(os.getenv("LOG_DEBUG_SAMPLE_EVERY", "1"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+log_pipeline.start(LOG_LEVEL, LOG_LEVELS, LOG_DEBUG_SAMPLE_EVERY, LOG_QUEUE_SIZE)
 logger = logging.getLogger(__name__)
 
 # --- Константы и темы ---
@@ -46,6 +52,10 @@ if not TOKEN:
     logger.error("Необходимо установить переменную окружения TOKEN!")
     # В реальном приложении здесь лучше выбросить исключение или использовать значение по умолчанию для тестов
     # exit(1) # Не будем прерывать выполнение здесь, пусть это произойдет в bot.py при инициализации
+# Адрес Bot API: для нагрузочного теста - локальная заглушка (benchmarks/fake_bot_api.py)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+# Ключ HMAC для callback_data кнопок хода (см. callback_sign.py); по умолчанию выводится из TOKEN
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET", "")
 
 # URL для вебхука (Render предоставляет RENDER_EXTERNAL_URL)
 WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL")
@@ -63,4 +73,71 @@ WEBHOOK_PATH = "/webhook"
 WEBHOOK_ENDPOINT_URL = f"{WEBHOOK_URL}{WEBHOOK_PATH}" if WEBHOOK_URL else None
 
 # Таймаут ожидания второго игрока
-GAME_TIMEOUT_SECONDS = 90 
\ No newline at end of file
+GAME_TIMEOUT_SECONDS = 90 
+# Уровень компьютерного соперника для "/newgame bot" без уровня: easy, medium или hard (см. ai_player.py)
+AI_DEFAULT_LEVEL = os.getenv("AI_DEFAULT_LEVEL", "medium")
+# Поиск хода бота на полях больше 3x3 (см. ai_service.py): число процессов пула, время на ход
+# уровня hard в секундах (easy и medium получают долю), записей в таблице транспозиций
+# процесса, способ запуска процессов и период замера задержки event loop во время поиска
+AI_SEARCH_WORKERS = int(os.getenv("AI_SEARCH_WORKERS", str(max(1, min(4, (os.cpu_count() or 1) - 1)))))
+AI_SEARCH_BUDGET_SECONDS = float(os.getenv("AI_SEARCH_BUDGET_SECONDS", "1.0"))
+AI_SEARCH_TABLE_SIZE = int(os.getenv("AI_SEARCH_TABLE_SIZE", "500000"))
+AI_SEARCH_START_METHOD = os.getenv("AI_SEARCH_START_METHOD", "forkserver")
+AI_SEARCH_LAG_INTERVAL = float(os.getenv("AI_SEARCH_LAG_INTERVAL", "0.05"))
+
+# Кэш готовых клавиатур игрового поля (см. render_cache.py)
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "4096"))
+# Прогрев кэша всеми достижимыми позициями при старте ("1" - включить)
+KEYBOARD_CACHE_WARMUP = os.getenv("KEYBOARD_CACHE_WARMUP", "0") == "1"
+
+# Очередь входящих обновлений вебхука (см. update_queue.py)
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Число фоновых обработчиков очереди (обновления одного чата все равно идут по порядку, см. chat_locks.py)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+# При перегрузке нажатия кнопок старше этого возраста выбрасываются первыми
+STALE_CALLBACK_SECONDS = float(os.getenv("STALE_CALLBACK_SECONDS", "10"))
+# Быстрый ответ на пустые и устаревшие нажатия прямо в вебхуке, без PTB (см. fast_path.py)
+WEBHOOK_FAST_PATH = os.getenv("WEBHOOK_FAST_PATH", "1") == "1"
+# Сколько секунд вебхук ждет ответа обработчика на нажатие, чтобы вернуть его в теле HTTP-ответа (см. webhook_reply.py)
+WEBHOOK_REPLY_TIMEOUT = float(os.getenv("WEBHOOK_REPLY_TIMEOUT", "0.5"))
+# Отбрасывание повторно доставленных обновлений (см. update_dedupe.py): сколько последних
+# update_id помнить, куда сохранять максимальный id ("" - не сохранять) и как часто
+UPDATE_DEDUPE_SIZE = int(os.getenv("UPDATE_DEDUPE_SIZE", "4096"))
+UPDATE_DEDUPE_PATH = os.getenv("UPDATE_DEDUPE_PATH", "update_dedupe.state")
+UPDATE_DEDUPE_SAVE_INTERVAL = float(os.getenv("UPDATE_DEDUPE_SAVE_INTERVAL", "5"))
+# Запись входящих обновлений для воспроизведения (см. traffic_recorder.py): файл .jsonl.gz
+# ("" - не записывать), предельный размер сжатого файла и период сброса на диск
+WEBHOOK_RECORD_PATH = os.getenv("WEBHOOK_RECORD_PATH", "")
+WEBHOOK_RECORD_MAX_BYTES = int(os.getenv("WEBHOOK_RECORD_MAX_BYTES", str(100 * 1024 * 1024)))
+WEBHOOK_RECORD_FLUSH_INTERVAL = float(os.getenv("WEBHOOK_RECORD_FLUSH_INTERVAL", "1"))
+
+# Исходящие запросы к Bot API (см. outbound.py)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))  # сообщений в секунду на бота
+OUTBOUND_GROUP_RATE_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_RATE_PER_MINUTE", "20"))  # на одну группу
+OUTBOUND_PRIVATE_RATE = float(os.getenv("OUTBOUND_PRIVATE_RATE", "1"))  # в секунду на личный чат
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))  # повторов после RetryAfter
+
+# Колесо таймеров игр (см. timeouts.py): шаг в секундах и число ячеек
+TIMEOUT_WHEEL_TICK = float(os.getenv("TIMEOUT_WHEEL_TICK", "1"))
+TIMEOUT_WHEEL_SLOTS = int(os.getenv("TIMEOUT_WHEEL_SLOTS", "512"))
+
+# Вытеснение игр из памяти (см. game_sweeper.py)
+FINISHED_GAME_TTL_SECONDS = float(os.getenv("FINISHED_GAME_TTL_SECONDS", "900"))  # завершенные игры
+IDLE_GAME_TTL_SECONDS = float(os.getenv("IDLE_GAME_TTL_SECONDS", "1800"))  # идущие игры без ходов
+GAME_SWEEP_INTERVAL_SECONDS = float(os.getenv("GAME_SWEEP_INTERVAL_SECONDS", "60"))
+
+# Несколько воркеров uvicorn на одной машине (см. shared_store.py)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+SHARED_GAME_NAME = os.getenv("SHARED_GAME_NAME", "cracknolik_games")
+SHARED_GAME_SLOTS = int(os.getenv("SHARED_GAME_SLOTS", "65536"))
+SHARED_LOCK_STRIPES = int(os.getenv("SHARED_LOCK_STRIPES", "4096"))
+
+# Метрики в формате Prometheus на /metrics (см. metrics.py), "0" - выключить
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+# Хранилище игр (см. game_store.py): "memory", "sqlite" или "shared" (общая память воркеров)
+GAME_STORE = os.getenv("GAME_STORE", "shared" if WEB_WORKERS > 1 else "memory")
+GAME_STORE_PATH = os.getenv("GAME_STORE_PATH", "games.db")
+GAME_STORE_FLUSH_INTERVAL = float(os.getenv("GAME_STORE_FLUSH_INTERVAL", "1"))  # секунд между сбросами на диск
+GAME_STORE_FLUSH_THRESHOLD = int(os.getenv("GAME_STORE_FLUSH_THRESHOLD", "200"))  # изменений до внепланового сброса
+GAME_STORE_MISS_CACHE_SIZE = int(os.getenv("GAME_STORE_MISS_CACHE_SIZE", "65536"))  # chat_id без игры, запоминаемых без SELECT
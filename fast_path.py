@@ -0,0 +1,149 @@
+import logging
+
+import telegram
+
+from callback_sign import callback_signer, MOVE_PREFIX
+from chat_locks import chat_locks
+from game_engine import MAX_CELLS
+from game_state import GameState
+from game_store import games
+from outbound import outbound
+
+logger = logging.getLogger(__name__)
+
+STALE_KEYBOARD_TEXT = "Эта клавиатура от старой игры. Начните новую!"
+NO_GAME_TEXT = "🤔 Эта игра уже не существует или находится в процессе создания."
+FORGED_TEXT = "Недействительная кнопка."
+
+
+def decide(game: GameState | None, data: str, user_id: int, message_id: int | None, move=None):
+    """Ответ на нажатие, не меняющее игру, как его дал бы button_click.
+
+    `move` - уже проверенная подписанная кнопка хода (callback_signer.decode).
+    Возвращает (text, show_alert, strip_keyboard) или None, если нажатие
+    меняет состояние (ход, присоединение второго игрока) или не относится
+    к игровому полю - тогда обновление идет в PTB как обычно.
+    """
+    if move is None and data != "noop" and not (len(data) <= 2 and data.isdigit() and int(data) < MAX_CELLS):
+        return None
+    if game is None:
+        return NO_GAME_TEXT, True, False
+    if move is not None:
+        move_game_id, move_seq, move_cell = move
+        if move_game_id != game.game_id:
+            return STALE_KEYBOARD_TEXT, True, False  # id игры уже говорит, что клавиатура старая
+        if move_seq != game.board.moves:
+            return None, False, False  # повторное нажатие на сделанный ход
+        data = str(move_cell)
+    elif data != "noop" and game.game_id:
+        return STALE_KEYBOARD_TEXT, True, False  # голая клетка у игры с подписанными кнопками
+    if message_id and game.message_id and message_id != game.message_id:
+        return STALE_KEYBOARD_TEXT, True, True
+
+    if data == "noop":
+        # Занятая клетка во время игры - просто убираем "часики"
+        return ("🏁 Игра уже завершена. Начните новую игру!" if game.game_over else None), False, False
+
+    if game.game_over:
+        return "🏁 Игра завершена! Начните новую.", True, False
+    current_player_id = game.player(game.current_player)
+    if not game.player(game.waiting_player):
+        if user_id == current_player_id:
+            return "⏳ Дождитесь второго игрока!", False, False
+        return None  # присоединение второго игрока
+    if user_id != current_player_id:
+        return f"⏱️ Не ваш ход! Сейчас ходит {game.username(game.current_player)}", False, False
+    if int(data) >= game.board.geometry.cells:
+        return STALE_KEYBOARD_TEXT, True, False  # клетка поля другого размера
+    if not game.board.is_free(int(data)):
+        return "Эта клетка уже занята!", True, False
+    return None  # ход
+
+
+class CallbackFastPath:
+    """Ответ на пустые и устаревшие нажатия кнопок прямо из JSON вебхука.
+
+    В загруженной группе большинство нажатий - `noop` (занятая клетка,
+    законченная игра), "не ваш ход" и клавиатуры старых игр. Для них не нужны
+    Update.de_json, process_update и перебор обработчиков: из сырого JSON
+    читаются только callback_query.data, message.chat.id, message.message_id
+    и from.id, игра берется из хранилища, и answerCallbackQuery сразу
+    возвращается в теле ответа вебхука. Остальное (ходы, присоединение,
+    новая игра, темы) идет в PTB без изменений.
+
+    Быстрый путь используется, только если у чата нет обновлений в очереди
+    или в обработке и чат не держит таймаут: иначе ответ мог бы опередить
+    более раннее нажатие того же чата.
+    """
+
+    def __init__(self):
+        self.answered = 0
+        self.stale_keyboards = 0
+        self.forged = 0
+        self.passed = 0
+
+    def try_answer(self, bot: telegram.Bot, body: dict, queue, banned_users=()) -> dict | None:
+        """Тело ответа вебхука с answerCallbackQuery или None - обновление идет в PTB."""
+        query = body.get("callback_query")
+        if not query:
+            return None
+        try:
+            query_id = query["id"]
+            data = query["data"]
+            message = query["message"]
+            chat_id = message["chat"]["id"]
+            message_id = message["message_id"]
+            user = query["from"]
+            user_id = user["id"]
+        except (KeyError, TypeError):
+            self.passed += 1
+            return None
+        if (not isinstance(query_id, str) or not isinstance(data, str) or not isinstance(chat_id, int)
+                or not isinstance(user, dict)):
+            # Нестандартное обновление - на общий путь, а не 500 и повтор от Telegram
+            self.passed += 1
+            return None
+        if (str(user_id) in banned_users or user.get("username") in banned_users
+                or queue.pending(chat_id) or chat_locks.locked(chat_id)):
+            self.passed += 1
+            return None
+
+        move = None
+        if data.startswith(MOVE_PREFIX):
+            # Подпись проверяется до обращения к хранилищу
+            move = callback_signer.decode(chat_id, data)
+            if move is None:
+                self.forged += 1
+                return {"method": "answerCallbackQuery", "callback_query_id": query_id, "text": FORGED_TEXT}
+
+        game = games.get(chat_id)
+        answer = decide(game, data, user_id, message_id, move)
+        if answer is None:
+            self.passed += 1
+            return None
+        if game is not None:
+            game.touch()
+
+        text, show_alert, strip_keyboard = answer
+        self.answered += 1
+        if strip_keyboard:
+            self.stale_keyboards += 1
+            logger.debug("Fast path: old keyboard %s in chat %s, expected %s", message_id, chat_id, game.message_id)
+            outbound.edit_message_reply_markup(bot, chat_id, message_id, reply_markup=None)
+        reply = {"method": "answerCallbackQuery", "callback_query_id": query_id}
+        if text:
+            reply["text"] = text
+        if show_alert:
+            reply["show_alert"] = True
+        return reply
+
+    def stats(self) -> dict:
+        return {
+            "answered": self.answered,
+            "stale_keyboards": self.stale_keyboards,
+            "forged": self.forged,
+            "passed_to_ptb": self.passed,
+        }
+
+
+fast_path = CallbackFastPath()
@@ -0,0 +1,228 @@
+# Битовый движок игры: каждая сторона хранится битовой маской,
+# бит i соответствует клетке i (слева направо, сверху вниз).
+# Классическое поле 3x3 - CLASSIC; поля до MAX_BOARD_SIZE x MAX_BOARD_SIZE
+# с победой за K в ряд описывает BoardGeometry.
+
+DRAW = "Ничья"
+SYMBOLS = ("X", "O")
+FULL_BOARD_MASK = 0x1FF
+CELLS_COUNT = 9
+
+# В ряду инлайн-клавиатуры Telegram не больше 8 кнопок (и не больше 100 всего)
+MAX_BOARD_SIZE = 8
+MAX_CELLS = MAX_BOARD_SIZE * MAX_BOARD_SIZE
+MIN_WIN_LENGTH = 3
+
+# Выигрышные комбинации: горизонтали, вертикали и диагонали
+WIN_COMBINATIONS = (
+    (0, 1, 2), (3, 4, 5), (6, 7, 8),
+    (0, 3, 6), (1, 4, 7), (2, 5, 8),
+    (0, 4, 8), (2, 4, 6),
+)
+
+# Маска линии -> индексы клеток (для подсветки выигрыша)
+LINE_MASKS = tuple(sum(1 << i for i in combo) for combo in WIN_COMBINATIONS)
+LINE_INDICES = {mask: list(combo) for mask, combo in zip(LINE_MASKS, WIN_COMBINATIONS)}
+
+# Для каждой клетки - только линии, проходящие через неё (2-4 маски вместо 8)
+CELL_LINE_MASKS = tuple(
+    tuple(mask for mask in LINE_MASKS if mask >> cell & 1)
+    for cell in range(CELLS_COUNT)
+)
+
+
+class BoardGeometry:
+    """Поле size x size с победой за `k` в ряд: все линии и линии через каждую клетку.
+
+    Линия - любые k подряд идущих клеток по горизонтали, вертикали или
+    диагонали. Через клетку проходит не больше 4*k линий, поэтому
+    BitBoard.play на большом поле обновляет O(k) счетчиков.
+    Геометрии создаются один раз (board_geometry) и общие для всех игр.
+    """
+
+    __slots__ = ("size", "k", "cells", "full_mask", "lines", "line_masks", "line_indices", "cell_lines")
+
+    def __init__(self, size: int, k: int):
+        self.size = size
+        self.k = k
+        self.cells = size * size
+        self.full_mask = (1 << self.cells) - 1
+        lines = []
+        for row in range(size):
+            for col in range(size):
+                for d_row, d_col in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                    end_row, end_col = row + d_row * (k - 1), col + d_col * (k - 1)
+                    if end_row < size and 0 <= end_col < size:
+                        lines.append(tuple((row + d_row * i) * size + col + d_col * i for i in range(k)))
+        self.lines = tuple(lines)
+        self.line_masks = tuple(sum(1 << cell for cell in line) for line in lines)
+        self.line_indices = {mask: list(line) for mask, line in zip(self.line_masks, lines)}
+        self.cell_lines = tuple(
+            tuple(n for n, line in enumerate(lines) if cell in line) for cell in range(self.cells)
+        )
+
+    @property
+    def label(self) -> str:
+        return f"{self.size}x{self.size}" + (f", {self.k} в ряд" if self.k != self.size else "")
+
+    def __repr__(self) -> str:
+        return f"BoardGeometry({self.size}, {self.k})"
+
+
+_GEOMETRIES: dict[tuple[int, int], BoardGeometry] = {}
+
+
+def board_geometry(size: int = 3, k: int | None = None) -> BoardGeometry:
+    """Общая геометрия поля; k по умолчанию - default_win_length(size)."""
+    k = k or default_win_length(size)
+    if not 3 <= size <= MAX_BOARD_SIZE or not MIN_WIN_LENGTH <= k <= size:
+        raise ValueError(f"unsupported board {size}x{size} with {k} in a row")
+    geometry = _GEOMETRIES.get((size, k))
+    if geometry is None:
+        geometry = _GEOMETRIES[(size, k)] = BoardGeometry(size, k)
+    return geometry
+
+
+def default_win_length(size: int) -> int:
+    """3x3 и 4x4 - все поле в ряд, 5x5 - 4 в ряд, большие поля - 5 в ряд."""
+    return size if size <= 4 else min(size - 1, 5)
+
+
+CLASSIC = board_geometry(3, 3)
+
+
+class BitBoard:
+    """Состояние поля: две битовые маски (X и O), счётчик ходов и геометрия поля.
+
+    Поддерживает индексацию как старый список `board`: пустая клетка
+    возвращает свой номер (int 1..N), занятая - "X" или "O". Это позволяет
+    `get_keyboard` и прочему коду, читающему `board[i]`, работать без изменений.
+
+    На поле 3x3 ход проверяет 2-4 маски линий через клетку. На больших полях
+    для каждой линии хранятся счетчики камней X и O (`_counts`, строятся по
+    маскам при первом ходе): ход увеличивает счетчики линий через клетку, и
+    победа - счетчик, дошедший до k.
+    """
+
+    __slots__ = ("x", "o", "moves", "geometry", "_counts")
+
+    def __init__(self, x: int = 0, o: int = 0, moves: int | None = None, geometry: BoardGeometry = CLASSIC):
+        self.x = x
+        self.o = o
+        self.moves = moves if moves is not None else (x | o).bit_count()
+        self.geometry = geometry
+        self._counts: list[bytearray] | None = None
+
+    @classmethod
+    def from_list(cls, board) -> "BitBoard":
+        """Строит BitBoard из старого списочного представления."""
+        x = o = 0
+        for i, cell in enumerate(board):
+            if cell == "X":
+                x |= 1 << i
+            elif cell == "O":
+                o |= 1 << i
+        return cls(x, o)
+
+    @classmethod
+    def from_packed(cls, packed: int, geometry: BoardGeometry = CLASSIC) -> "BitBoard":
+        """Обратная операция к `packed`."""
+        return cls(packed & geometry.full_mask, packed >> geometry.cells & geometry.full_mask, geometry=geometry)
+
+    @property
+    def packed(self) -> int:
+        """Поле одним числом: X в младших N битах, O - в старших (для 3x3 - 18 бит)."""
+        return self.x | self.o << self.geometry.cells
+
+    def is_free(self, cell: int) -> bool:
+        return not ((self.x | self.o) >> cell & 1)
+
+    def play(self, cell: int, symbol: str):
+        """Ставит `symbol` в клетку `cell` и проверяет только линии через неё.
+
+        Возвращает: (winner_symbol, winning_indices) или (DRAW, None) или (None, None)
+        """
+        geometry = self.geometry
+        if geometry is not CLASSIC:
+            return self._play_counted(cell, symbol)
+        bit = 1 << cell
+        if symbol == "X":
+            self.x |= bit
+            side = self.x
+        else:
+            self.o |= bit
+            side = self.o
+        self.moves += 1
+
+        for mask in CELL_LINE_MASKS[cell]:
+            if side & mask == mask:
+                return symbol, LINE_INDICES[mask]
+        if self.moves == CELLS_COUNT:
+            return DRAW, None
+        return None, None
+
+    def _play_counted(self, cell: int, symbol: str):
+        geometry = self.geometry
+        counts = self._counts if self._counts is not None else self._build_counts()
+        side = counts[0] if symbol == "X" else counts[1]
+        if symbol == "X":
+            self.x |= 1 << cell
+        else:
+            self.o |= 1 << cell
+        self.moves += 1
+
+        winning_line = None
+        for line in geometry.cell_lines[cell]:
+            side[line] += 1
+            if side[line] == geometry.k and winning_line is None:
+                winning_line = line  # остальные счетчики все равно обновляются
+        if winning_line is not None:
+            return symbol, geometry.line_indices[geometry.line_masks[winning_line]]
+        if self.moves == geometry.cells:
+            return DRAW, None
+        return None, None
+
+    def _build_counts(self) -> list[bytearray]:
+        """Счетчики камней X и O по линиям для текущих масок."""
+        geometry = self.geometry
+        self._counts = [
+            bytearray((side & mask).bit_count() for mask in geometry.line_masks)
+            for side in (self.x, self.o)
+        ]
+        return self._counts
+
+    def result(self):
+        """Полная проверка поля (когда последний ход неизвестен)."""
+        geometry = self.geometry
+        for side, symbol in ((self.x, "X"), (self.o, "O")):
+            for mask in geometry.line_masks:
+                if side & mask == mask:
+                    return symbol, geometry.line_indices[mask]
+        if self.moves == geometry.cells:
+            return DRAW, None
+        return None, None
+
+    def to_list(self) -> list:
+        return [self[i] for i in range(self.geometry.cells)]
+
+    def __getitem__(self, cell: int):
+        if self.x >> cell & 1:
+            return "X"
+        if self.o >> cell & 1:
+            return "O"
+        return cell + 1
+
+    def __setitem__(self, cell: int, symbol: str):
+        # Совместимость со старым `board[i] = symbol`; предпочтительно `play()`
+        self.play(cell, symbol)
+
+    def __len__(self) -> int:
+        return self.geometry.cells
+
+    def __iter__(self):
+        return (self[i] for i in range(self.geometry.cells))
+
+    def __repr__(self) -> str:
+        if self.geometry is CLASSIC:
+            return f"BitBoard({self.to_list()})"
+        return f"BitBoard({self.to_list()}, {self.geometry!r})"
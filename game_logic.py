@@ -1,9 +1,14 @@
 import logging
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 
 # Импортируем необходимые элементы из других модулей
-from config import THEMES, DEFAULT_THEME_KEY, EMPTY_CELL_SYMBOL, logger
-from game_state import games
+from config import EMPTY_CELL_SYMBOL, AI_DEFAULT_LEVEL
+from game_store import games
+from game_engine import BitBoard, BoardGeometry, CLASSIC, MAX_BOARD_SIZE, board_geometry
+from ai_player import AI_LEVELS
+from render_cache import keyboard_cache
+from callback_sign import callback_signer
+
+logger = logging.getLogger(__name__)
 
 def get_symbol_emoji(symbol, game_theme_emojis: dict):
     """Возвращает символ с эмодзи для отображения, используя тему текущей игры."""
@@ -20,72 +25,65 @@ def get_symbol_emoji(symbol, game_theme_emojis: dict):
          return game_theme_emojis.get("O_win", "⭐⭕⭐")
     return str(symbol)
 
+def parse_new_game_args(args: list[str]) -> tuple[BoardGeometry, str | None]:
+    """Разбирает аргументы /newgame: "[bot [уровень]] [N|NxN] [K]".
+
+    Возвращает (геометрия поля, уровень бота или None).
+    При ошибке выбрасывает ValueError с текстом для пользователя.
+    """
+    args = [arg.lower() for arg in args]
+    ai_level = None
+    if args and args[0] == "bot":
+        ai_level = AI_DEFAULT_LEVEL
+        if len(args) > 1 and not args[1][0].isdigit():
+            ai_level = args[1]
+            args = args[2:]
+        else:
+            args = args[1:]
+        if ai_level not in AI_LEVELS:
+            raise ValueError(f"Неизвестный уровень бота. Доступны: {', '.join(AI_LEVELS)}")
+
+    geometry = CLASSIC
+    if args:
+        size_text, _, size_again = args[0].replace("х", "x").partition("x")  # русская "х" тоже
+        try:
+            size = int(size_text)
+            k = int(args[1]) if len(args) > 1 else None
+            if size_again and int(size_again) != size:
+                raise ValueError
+            geometry = board_geometry(size, k)
+        except ValueError:
+            raise ValueError(
+                f"Поле задается как /newgame 5x5 4: размер от 3 до {MAX_BOARD_SIZE}, "
+                f"в ряд от 3 до размера поля"
+            ) from None
+    return geometry, ai_level
+
 def get_keyboard(chat_id, winning_indices: list | None = None):
-    """Создаёт клавиатуру с игровым полем.
+    """Возвращает клавиатуру с игровым полем из кэша (см. render_cache.py).
        Неактивные кнопки (занятые клетки или конец игры) имеют callback_data='noop'.
        Подсвечивает выигрышную комбинацию, если переданы winning_indices.
     """
     if chat_id not in games:
-        logger.warning(f"get_keyboard called for non-existent game in chat {chat_id}")
+        logger.warning("get_keyboard called for non-existent game in chat %s", chat_id)
         return None
 
-    game_data = games[chat_id]
-    board = game_data["board"]
-    is_game_over = game_data["game_over"]
-    theme_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY])
-    keyboard = []
-    logger.debug(f"[get_keyboard chat={chat_id}] Board: {board}, Theme: {theme_emojis.get('name', 'Unknown')}, Winning: {winning_indices}")
-
-    for i in range(0, 9, 3):
-        row = []
-        for j in range(3):
-            cell_index = i + j
-            cell = board[cell_index]
-            cell_text = ""
-            callback_data = "noop"
-
-            if isinstance(cell, int):
-                cell_text = get_symbol_emoji(cell, theme_emojis)
-                if not is_game_over:
-                    callback_data = str(cell_index)
-            else:
-                if is_game_over and winning_indices and cell_index in winning_indices:
-                    win_symbol_key = f"{cell}_win"
-                    # Используем get_symbol_emoji для получения символа выигрыша с фоллбэком
-                    cell_text = get_symbol_emoji(win_symbol_key, theme_emojis)
-                else:
-                    cell_text = get_symbol_emoji(cell, theme_emojis)
-
-            logger.debug(f"[get_keyboard chat={chat_id}] Cell[{cell_index}]: {repr(cell)} -> Emoji: {repr(cell_text)}, Callback: {callback_data}")
-            row.append(InlineKeyboardButton(cell_text, callback_data=callback_data))
-        keyboard.append(row)
-
-    control_row = []
-    if is_game_over:
-        control_row.append(InlineKeyboardButton("🔄 Новая игра", callback_data="new_game"))
-    else:
-        control_row.append(InlineKeyboardButton("🎨 Сменить тему", callback_data="change_theme_prompt"))
-
-    if control_row:
-        keyboard.append(control_row)
-
-    return InlineKeyboardMarkup(keyboard)
+    game = games[chat_id]
+    markup = keyboard_cache.get_keyboard(
+        game.board, game.theme_key, game.theme, game.game_over, winning_indices
+    )
+    if game.game_id and not game.game_over:
+        # Кнопки свободных клеток подписываются для этой игры и хода (callback_sign.py)
+        markup = callback_signer.game_keyboard(markup, chat_id, game)
+    return markup
 
 def check_winner(board):
     """Проверяет, есть ли победитель или ничья.
+    Принимает BitBoard или старый список из 9 клеток.
     Возвращает: (winner_symbol, winning_indices) или ("Ничья", None) или (None, None)
-    """
-    win_combinations = [
-        [0, 1, 2], [3, 4, 5], [6, 7, 8],  # горизонтали
-        [0, 3, 6], [1, 4, 7], [2, 5, 8],  # вертикали
-        [0, 4, 8], [2, 4, 6]              # диагонали
-    ]
 
-    for combo in win_combinations:
-        if board[combo[0]] == board[combo[1]] == board[combo[2]] and not isinstance(board[combo[0]], int):
-            return board[combo[0]], combo
-
-    if not any(isinstance(cell, int) for cell in board):
-        return "Ничья", None
-
-    return None, None 
\ No newline at end of file
+    Устаревший путь: обработчики получают результат хода напрямую из `BitBoard.play()`.
+    """
+    if not isinstance(board, BitBoard):
+        board = BitBoard.from_list(board)
+    return board.result()
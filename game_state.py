@@ -1,2 +1,89 @@
-# Словарь для хранения состояния игр {chat_id: game_data}
-games: dict[int, dict] = {} 
\ No newline at end of file
+import sys
+import time
+
+from config import THEMES, DEFAULT_THEME_KEY
+from game_engine import BitBoard, BoardGeometry, CLASSIC
+from callback_sign import CallbackSigner
+
+
+class GameState:
+    """Состояние одной игры.
+
+    Компактная запись вместо словаря со вложенными словарями `players`,
+    `user_symbols`, `usernames`: доска - BitBoard (две битовые маски и геометрия поля),
+    игроки - два int, имена интернируются, тема хранится ключом, а не словарем эмодзи.
+    `game_id` - короткий случайный id для подписанных кнопок хода (callback_sign.py);
+    у игр, сохраненных до его появления, он None.
+    `ai_level` - уровень компьютерного соперника (ai_player.py) в игре `/newgame bot`,
+    в игре двух людей - None.
+    """
+
+    __slots__ = (
+        "board", "current_player", "game_over",
+        "player_x", "player_o", "username_x", "username_o",
+        "theme_key", "message_id", "last_activity", "game_id", "ai_level",
+        "sent_text", "sent_markup", "signed_markup",
+    )
+
+    def __init__(self, first_player: str, user_id: int, username: str, theme_key: str = DEFAULT_THEME_KEY,
+                 geometry: BoardGeometry = CLASSIC):
+        self.board = BitBoard(geometry=geometry)
+        self.current_player = first_player
+        self.game_over = False
+        self.player_x: int | None = None
+        self.player_o: int | None = None
+        self.username_x: str | None = None
+        self.username_o: str | None = None
+        self.theme_key = theme_key if theme_key in THEMES else DEFAULT_THEME_KEY
+        self.message_id: int | None = None
+        self.last_activity = time.monotonic()
+        self.game_id: str | None = CallbackSigner.new_game_id()
+        self.ai_level: str | None = None
+        # Последние отправленные текст и клавиатура (см. outbound.edit_game_message)
+        self.sent_text: str | None = None
+        self.sent_markup = None
+        # (клавиатура из кэша, ход, подписанная копия) - см. callback_signer.game_keyboard
+        self.signed_markup = None
+        self.join(first_player, user_id, username)
+
+    @property
+    def theme(self) -> dict:
+        return THEMES.get(self.theme_key, THEMES[DEFAULT_THEME_KEY])
+
+    @property
+    def waiting_player(self) -> str:
+        """Символ игрока, который сейчас не ходит."""
+        return "O" if self.current_player == "X" else "X"
+
+    def player(self, symbol: str) -> int | None:
+        return self.player_x if symbol == "X" else self.player_o
+
+    def username(self, symbol: str) -> str:
+        username = self.username_x if symbol == "X" else self.username_o
+        return username or f"player_{self.player(symbol)}"
+
+    def join(self, symbol: str, user_id: int, username: str) -> None:
+        username = sys.intern(username)
+        if symbol == "X":
+            self.player_x, self.username_x = user_id, username
+        else:
+            self.player_o, self.username_o = user_id, username
+
+    def symbol_of(self, user_id: int) -> str | None:
+        if user_id == self.player_x:
+            return "X"
+        if user_id == self.player_o:
+            return "O"
+        return None
+
+    def is_player(self, user_id: int) -> bool:
+        return user_id == self.player_x or user_id == self.player_o
+
+    def touch(self) -> None:
+        """Отмечает активность в игре (по ней sweeper вытесняет заброшенные игры)."""
+        self.last_activity = time.monotonic()
+
+    def __repr__(self) -> str:
+        return (f"GameState(board={self.board!r}, current={self.current_player}, over={self.game_over}, "
+                f"X={self.player_x}, O={self.player_o}, message_id={self.message_id})")
+
@@ -0,0 +1,351 @@
+import asyncio
+import contextlib
+import logging
+import sqlite3
+import sys
+import time
+
+from config import (
+    GAME_STORE,
+    GAME_STORE_PATH,
+    GAME_STORE_FLUSH_INTERVAL,
+    GAME_STORE_FLUSH_THRESHOLD,
+    GAME_STORE_MISS_CACHE_SIZE,
+)
+from game_engine import BitBoard, board_geometry
+from game_state import GameState
+
+logger = logging.getLogger(__name__)
+
+
+class GameStore:
+    """Хранилище игр {chat_id: GameState} с интерфейсом словаря.
+
+    Обработчики меняют GameState на месте и после изменения вызывают
+    `mark_dirty(chat_id)`; бэкенд сам решает, когда и как это сохранить.
+    Итерация (`items`, `values`, `len`) идет только по играм в памяти.
+    """
+
+    def __init__(self):
+        self._games: dict[int, GameState] = {}
+
+    def __contains__(self, chat_id: int) -> bool:
+        return self.get(chat_id) is not None
+
+    def __getitem__(self, chat_id: int) -> GameState:
+        game = self.get(chat_id)
+        if game is None:
+            raise KeyError(chat_id)
+        return game
+
+    def __setitem__(self, chat_id: int, game: GameState) -> None:
+        self._games[chat_id] = game
+        self.mark_dirty(chat_id)
+
+    def __delitem__(self, chat_id: int) -> None:
+        if self.pop(chat_id) is None:
+            raise KeyError(chat_id)
+
+    def __len__(self) -> int:
+        return len(self._games)
+
+    def get(self, chat_id: int) -> GameState | None:
+        return self._games.get(chat_id)
+
+    def pop(self, chat_id: int) -> GameState | None:
+        return self._games.pop(chat_id, None)
+
+    def items(self):
+        return self._games.items()
+
+    def values(self):
+        return self._games.values()
+
+    def mark_dirty(self, chat_id: int) -> None:
+        """Игра изменилась и должна быть сохранена."""
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self, chat_id: int):
+        """Исключительный доступ к игре чата между процессами (внутри процесса - chat_locks)."""
+        yield
+
+    def purge_expired(self, finished_before: float, idle_before: float) -> list[tuple[int, GameState]]:
+        """Удаляет сохраненные, но не загруженные игры старше порогов (время - time.time()).
+
+        Возвращает удаленные незавершенные игры, чтобы вызывающий мог убрать их клавиатуры.
+        """
+        return []
+
+    def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "loaded": len(self._games)}
+
+
+class MemoryGameStore(GameStore):
+    """Игры только в памяти процесса: теряются при перезапуске."""
+
+
+class SQLiteGameStore(GameStore):
+    """Игры в памяти с отложенной записью в SQLite (WAL).
+
+    Ходы применяются к GameState в памяти, измененные chat_id копятся в
+    `_dirty` и сбрасываются одной транзакцией раз в `flush_interval` секунд
+    или сразу, когда их набралось `flush_threshold`. Удаления тоже идут
+    пачкой. После перезапуска игра поднимается из базы при первом
+    обращении по chat_id.
+
+    Между сбросами на диске может не хватать последних ходов (не дольше
+    flush_interval) - это цена за одну транзакцию на пачку вместо fsync на ход.
+
+    Чаты без игры (промах SELECT) запоминаются в `_missing` - до
+    `miss_cache_size` последних: обновления таких чатов (fast_path, `in games`)
+    не ходят в базу на каждом обращении. Пишет в базу только этот процесс,
+    поэтому запись снимается при создании игры в __setitem__.
+    """
+
+    def __init__(self, path: str = GAME_STORE_PATH, flush_interval: float = GAME_STORE_FLUSH_INTERVAL,
+                 flush_threshold: int = GAME_STORE_FLUSH_THRESHOLD,
+                 miss_cache_size: int = GAME_STORE_MISS_CACHE_SIZE):
+        super().__init__()
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_threshold = max(1, flush_threshold)
+        self.miss_cache_size = miss_cache_size
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS games ("
+            " chat_id INTEGER PRIMARY KEY,"
+            " board INTEGER NOT NULL,"
+            " current_player TEXT NOT NULL,"
+            " game_over INTEGER NOT NULL,"
+            " player_x INTEGER, player_o INTEGER,"
+            " username_x TEXT, username_o TEXT,"
+            " theme_key TEXT NOT NULL,"
+            " message_id INTEGER,"
+            " updated_at REAL NOT NULL,"
+            " game_id TEXT,"
+            " ai_level TEXT,"
+            " board_size INTEGER,"
+            " win_length INTEGER)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(games)")}
+        if "game_id" not in columns:
+            # База от предыдущей версии: старые игры доигрываются с неподписанными кнопками
+            self._db.execute("ALTER TABLE games ADD COLUMN game_id TEXT")
+        if "ai_level" not in columns:
+            self._db.execute("ALTER TABLE games ADD COLUMN ai_level TEXT")
+        if "board_size" not in columns:
+            # NULL у старых строк - поле 3x3
+            self._db.execute("ALTER TABLE games ADD COLUMN board_size INTEGER")
+            self._db.execute("ALTER TABLE games ADD COLUMN win_length INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS games_updated_at ON games (updated_at)")
+        self._dirty: set[int] = set()
+        self._deleted: set[int] = set()
+        # chat_id, которых нет в базе; dict - порядок вставки для вытеснения самых старых
+        self._missing: dict[int, None] = {}
+        self._task: asyncio.Task | None = None
+
+        self.loaded = 0
+        self.miss_hits = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_deleted = 0
+        self.last_flush_ms = 0.0
+
+    def get(self, chat_id: int) -> GameState | None:
+        game = self._games.get(chat_id)
+        if game is not None or chat_id in self._deleted:
+            return game
+        if chat_id in self._missing:
+            self.miss_hits += 1
+            return None
+        row = self._db.execute(
+            "SELECT chat_id, board, current_player, game_over, player_x, player_o,"
+            " username_x, username_o, theme_key, message_id, game_id, ai_level, board_size, win_length FROM games WHERE chat_id = ?",
+            (chat_id,),
+        ).fetchone()
+        if row is None:
+            self._remember_missing(chat_id)
+            return None
+        game = _from_row(row)
+        self._games[chat_id] = game
+        self.loaded += 1
+        logger.info("Rehydrated game for chat %s from %s", chat_id, self.path)
+        return game
+
+    def _remember_missing(self, chat_id: int) -> None:
+        if self.miss_cache_size <= 0:
+            return
+        self._missing[chat_id] = None
+        if len(self._missing) > self.miss_cache_size:
+            del self._missing[next(iter(self._missing))]
+
+    def __setitem__(self, chat_id: int, game: GameState) -> None:
+        self._deleted.discard(chat_id)
+        self._missing.pop(chat_id, None)
+        super().__setitem__(chat_id, game)
+
+    def pop(self, chat_id: int) -> GameState | None:
+        game = self.get(chat_id)
+        if game is not None:
+            del self._games[chat_id]
+            self._dirty.discard(chat_id)
+            self._deleted.add(chat_id)
+            self._maybe_flush()
+        return game
+
+    def mark_dirty(self, chat_id: int) -> None:
+        if chat_id in self._games:
+            self._dirty.add(chat_id)
+            self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if len(self._dirty) + len(self._deleted) >= self.flush_threshold:
+            self.flush()
+
+    def flush(self) -> int:
+        """Записывает накопленные изменения одной транзакцией. Возвращает число строк."""
+        if not self._dirty and not self._deleted:
+            return 0
+        started = time.perf_counter()
+        now = time.time()
+        rows = [_to_row(chat_id, self._games[chat_id], now) for chat_id in self._dirty if chat_id in self._games]
+        deleted = [(chat_id,) for chat_id in self._deleted]
+        try:
+            self._db.execute("BEGIN")
+            if rows:
+                self._db.executemany("INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if deleted:
+                self._db.executemany("DELETE FROM games WHERE chat_id = ?", deleted)
+            self._db.execute("COMMIT")
+        except sqlite3.Error as e:
+            self._db.execute("ROLLBACK")
+            logger.error("Game store flush failed (%s rows, %s deletes): %s", len(rows), len(deleted), e, exc_info=True)
+            return 0
+        self._dirty.clear()
+        self._deleted.clear()
+        self.flushes += 1
+        self.rows_written += len(rows)
+        self.rows_deleted += len(deleted)
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+        return len(rows) + len(deleted)
+
+    def purge_expired(self, finished_before: float, idle_before: float) -> list[tuple[int, GameState]]:
+        rows = self._db.execute(
+            "SELECT chat_id, board, current_player, game_over, player_x, player_o,"
+            " username_x, username_o, theme_key, message_id, game_id, ai_level, board_size, win_length FROM games"
+            " WHERE (game_over = 1 AND updated_at < ?) OR (game_over = 0 AND updated_at < ?)",
+            (finished_before, idle_before),
+        ).fetchall()
+        # Загруженные игры вытесняет sweeper по last_activity, их не трогаем
+        expired = [row for row in rows if row[0] not in self._games and row[0] not in self._deleted]
+        if not expired:
+            return []
+        self._db.execute("BEGIN")
+        self._db.executemany("DELETE FROM games WHERE chat_id = ?", [(row[0],) for row in expired])
+        self._db.execute("COMMIT")
+        self.rows_deleted += len(expired)
+        abandoned = []
+        for row in expired:
+            game = _from_row(row)
+            if not game.game_over:
+                abandoned.append((row[0], game))
+        return abandoned
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="game_store_flush")
+            logger.info("SQLite game store started: %s, flush every %ss or %s changes",
+                        self.path, self.flush_interval, self.flush_threshold)
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.flush()
+        self._db.close()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Game store flush task failed: %s", e, exc_info=True)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "loaded": len(self._games),
+            "rehydrated": self.loaded,
+            "known_missing": len(self._missing),
+            "miss_hits": self.miss_hits,
+            "dirty": len(self._dirty),
+            "pending_deletes": len(self._deleted),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rows_deleted": self.rows_deleted,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+        }
+
+
+def _to_row(chat_id: int, game: GameState, updated_at: float) -> tuple:
+    geometry = game.board.geometry
+    board = game.board.packed
+    if board.bit_length() > 63:
+        # Поле больше 5x5 не помещается в INTEGER SQLite - хранится BLOB
+        board = board.to_bytes((board.bit_length() + 7) // 8, "little")
+    return (
+        chat_id, board, game.current_player, int(game.game_over),
+        game.player_x, game.player_o, game.username_x, game.username_o,
+        game.theme_key, game.message_id, updated_at, game.game_id, game.ai_level,
+        geometry.size, geometry.k,
+    )
+
+
+def _from_row(row) -> GameState:
+    (_, board, current_player, game_over, player_x, player_o,
+     username_x, username_o, theme_key, message_id, game_id, ai_level, board_size, win_length) = row
+    # Поднятая из базы игра: активность отсчитывается заново, отправленный текст неизвестен
+    game = GameState.__new__(GameState)
+    if isinstance(board, bytes):
+        board = int.from_bytes(board, "little")
+    game.board = BitBoard.from_packed(board, board_geometry(board_size or 3, win_length or 3))
+    game.current_player = current_player
+    game.game_over = bool(game_over)
+    game.player_x = player_x
+    game.player_o = player_o
+    game.username_x = sys.intern(username_x) if username_x else None
+    game.username_o = sys.intern(username_o) if username_o else None
+    game.theme_key = theme_key
+    game.message_id = message_id
+    game.game_id = game_id
+    game.ai_level = ai_level
+    game.last_activity = time.monotonic()
+    game.sent_text = None
+    game.sent_markup = None
+    game.signed_markup = None
+    return game
+
+
+def create_game_store(backend: str = GAME_STORE) -> GameStore:
+    if backend == "sqlite":
+        return SQLiteGameStore()
+    if backend == "shared":
+        from shared_store import SharedMemoryGameStore  # fcntl: только POSIX
+        return SharedMemoryGameStore()
+    if backend != "memory":
+        logger.warning("Unknown GAME_STORE backend '%s', using memory", backend)
+    return MemoryGameStore()
+
+
+# Хранилище игр {chat_id: GameState}
+games: GameStore = create_game_store()
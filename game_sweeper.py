@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+
+import telegram
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import (
+    FINISHED_GAME_TTL_SECONDS,
+    IDLE_GAME_TTL_SECONDS,
+    GAME_SWEEP_INTERVAL_SECONDS,
+)
+from game_state import GameState
+from game_store import games
+from outbound import outbound
+from timeouts import timeouts
+from ai_service import ai_service
+
+logger = logging.getLogger(__name__)
+
+
+class GameSweeper:
+    """Фоновая очистка словаря игр.
+
+    - завершенные игры удаляются через `finished_ttl` секунд после последней активности;
+    - идущие игры без действий дольше `idle_ttl` отменяются: с их сообщения
+      убирается игровое поле (остается кнопка "Новая игра"), игра удаляется.
+    Активность отмечается GameState.touch.
+
+    stats() не обходит игры (с общей памятью это разбор всех слотов на каждый
+    запрос /health и /metrics): число завершенных игр берется из последнего прохода.
+    """
+
+    def __init__(self, games_dict: dict, finished_ttl: float = FINISHED_GAME_TTL_SECONDS,
+                 idle_ttl: float = IDLE_GAME_TTL_SECONDS, interval: float = GAME_SWEEP_INTERVAL_SECONDS):
+        self.games = games_dict
+        self.finished_ttl = finished_ttl
+        self.idle_ttl = idle_ttl
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+        self.evicted_finished = 0
+        self.evicted_idle = 0
+        self.live_finished = 0
+        self.last_sweep_ms = 0.0
+
+    def start(self, bot: telegram.Bot) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(bot), name="game_sweeper")
+            logger.info("Game sweeper started: finished TTL=%ss, idle TTL=%ss", self.finished_ttl, self.idle_ttl)
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, bot: telegram.Bot) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.sweep(bot)
+            except Exception as e:
+                logger.error("Game sweep failed: %s", e, exc_info=True)
+
+    def sweep(self, bot: telegram.Bot | None, now: float | None = None) -> list[int]:
+        """Один проход по играм. Возвращает chat_id вытесненных игр."""
+        started = time.perf_counter()
+        now = time.monotonic() if now is None else now
+        finished_before = now - self.finished_ttl
+        idle_before = now - self.idle_ttl
+        evicted = []
+        live_finished = 0
+
+        for chat_id, game in list(self.games.items()):
+            # pop, а не del: игру мог удалить другой воркер (общая память)
+            if game.game_over:
+                if game.last_activity < finished_before and self.games.pop(chat_id) is not None:
+                    self.evicted_finished += 1
+                    evicted.append(chat_id)
+                else:
+                    live_finished += 1
+            elif game.last_activity < idle_before and self.games.pop(chat_id) is not None:
+                timeouts.cancel(chat_id)
+                ai_service.cancel(chat_id)
+                self.evicted_idle += 1
+                evicted.append(chat_id)
+                if bot is not None:
+                    self._close_abandoned(bot, chat_id, game)
+
+        # Игры, сохраненные до перезапуска и с тех пор ни разу не поднятые в память
+        wall_now = time.time()
+        for chat_id, game in self.games.purge_expired(wall_now - self.finished_ttl, wall_now - self.idle_ttl):
+            self.evicted_idle += 1
+            evicted.append(chat_id)
+            if bot is not None:
+                self._close_abandoned(bot, chat_id, game)
+
+        self.live_finished = live_finished
+        self.last_sweep_ms = (time.perf_counter() - started) * 1000
+        if evicted:
+            logger.info("Game sweep evicted %s game(s), %s live, took %.1f ms", len(evicted), len(self.games), self.last_sweep_ms)
+        return evicted
+
+    @staticmethod
+    def _close_abandoned(bot: telegram.Bot, chat_id: int, game: GameState) -> None:
+        """Убирает игровое поле с сообщения заброшенной игры (через общий планировщик)."""
+        if not game.message_id:
+            return
+        theme = game.theme
+        outbound.edit_game_message(
+            bot, game, chat_id, game.message_id,
+            f"💤 *Игра отменена из-за неактивности.* 💤\n\nТемы: *{theme['name']} {theme['X']}/{theme['O']}*",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")]]),
+            parse_mode="Markdown"
+        )
+
+    def stats(self) -> dict:
+        live = len(self.games)
+        return {
+            "live": live,
+            "live_in_progress": max(0, live - self.live_finished),
+            "live_finished": self.live_finished,
+            "evicted_finished": self.evicted_finished,
+            "evicted_idle": self.evicted_idle,
+            "last_sweep_ms": round(self.last_sweep_ms, 2),
+        }
+
+
+game_sweeper = GameSweeper(games)
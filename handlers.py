@@ -1,20 +1,33 @@
+import functools
+import logging
 import random
-import asyncio
-from datetime import timedelta
 import telegram
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
 from telegram.helpers import escape_markdown
 
 # Импортируем необходимые элементы из других модулей
-from config import logger, THEMES, DEFAULT_THEME_KEY, GAME_TIMEOUT_SECONDS
-from game_state import games
-from game_logic import get_symbol_emoji, get_keyboard, check_winner
+from config import THEMES, DEFAULT_THEME_KEY, GAME_TIMEOUT_SECONDS
+from game_state import GameState
+from game_store import games
+from game_logic import get_symbol_emoji, get_keyboard, parse_new_game_args
+from callback_sign import callback_signer, MOVE_PREFIX
+from callback_router import THEME_SELECT_PREFIX, THEME_SELECT_INGAME_PREFIX
+from game_engine import DRAW, CLASSIC, MAX_BOARD_SIZE
+from ai_player import ai_player
+from ai_service import ai_service
+from outbound import outbound
+from timeouts import timeouts
+from chat_locks import chat_locks
+
+logger = logging.getLogger(__name__)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
     await update.message.reply_text(
         "Али чемпион! 🎲 Для начала игры используйте команду /newgame\n"
+        "🤖 Игра с ботом: /newgame bot [easy|medium|hard] [размер поля]\n"
+        f"🔢 Большое поле: /newgame 5x5 4 (до {MAX_BOARD_SIZE}x{MAX_BOARD_SIZE}, второе число - сколько в ряд)\n"
         "🎨 Сменить символы игры: /themes"
     )
 
@@ -25,96 +38,101 @@ async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Имитируем получение сообщения, даже если его нет (например, при старте из button_click)
     message = update.effective_message
     if not message:
-        logger.error(f"Cannot start new game in chat {chat_id} without a message object.")
+        logger.error("Cannot start new game in chat %s without a message object.", chat_id)
         # Попытка отправить сообщение об ошибке, если есть чат
         if update.effective_chat:
              try:
                  await context.bot.send_message(chat_id, "Не удалось начать игру: отсутствует информация о сообщении.")
              except Exception as send_err:
-                 logger.error(f"Failed to send error message to chat {chat_id}: {send_err}")
+                 logger.error("Failed to send error message to chat %s: %s", chat_id, send_err)
         return
 
     username = update.effective_user.username or f"player_{user_id}"
     escaped_username = escape_markdown(username, version=1)
 
+    # --- Параметры игры: /newgame [bot [уровень]] [NxN [K]] ---
+    try:
+        geometry, ai_level = parse_new_game_args(context.args or [])
+    except ValueError as e:
+        await message.reply_text(str(e))
+        return
+
     # --- Проверка на активную игру ---
-    if chat_id in games and not games[chat_id].get('game_over', True):
+    if chat_id in games and not games[chat_id].game_over:
          await message.reply_text(
              "⏳ В этом чате уже идет игра! Дождитесь ее завершения или отмены.",
-             reply_to_message_id=games[chat_id].get('message_id')
+             reply_to_message_id=games[chat_id].message_id
          )
-         logger.warning(f"User {username} ({user_id}) tried to start a new game in chat {chat_id} while another is active.")
+         logger.warning("User %s (%s) tried to start a new game in chat %s while another is active.", username, user_id, chat_id)
          return
 
     # --- Отмена старого таймера и удаление старой игры --- (делается всегда перед стартом новой)
     if chat_id in games:
-        old_job = games[chat_id].get('timeout_job')
-        if old_job:
-            old_job.schedule_removal()
-            logger.info(f"Removed previous timeout job for chat {chat_id} before starting new game.")
+        if timeouts.cancel(chat_id):
+            logger.info("Removed previous timeout for chat %s before starting new game.", chat_id)
+        ai_service.cancel(chat_id) # Ход бота в старой игре больше не нужен
         del games[chat_id]
-        logger.info(f"Removed old game data for chat {chat_id} before starting new game.")
+        logger.info("Removed old game data for chat %s before starting new game.", chat_id)
 
     initiator_theme_key = context.user_data.get('chosen_theme', DEFAULT_THEME_KEY)
     game_theme_emojis = THEMES.get(initiator_theme_key, THEMES[DEFAULT_THEME_KEY])
 
     first_player = random.choice(["X", "O"])
-    second_player = "O" if first_player == "X" else "X"
-
-    game_data = {
-        "board": list(range(1, 10)),
-        "current_player": first_player,
-        "game_over": False,
-        "players": {first_player: user_id, second_player: None},
-        "user_symbols": {user_id: first_player},
-        "usernames": {user_id: username},
-        "message_id": None,
-        "timeout_job": None,
-        "theme_emojis": game_theme_emojis
-    }
-    games[chat_id] = game_data
+    game = GameState(first_player, user_id, username, initiator_theme_key, geometry)
+    if ai_level:
+        # Бот сразу занимает место второго игрока; первым всегда ходит человек
+        game.join(game.waiting_player, context.bot.id, context.bot.username or "bot")
+        game.ai_level = ai_level
+    games[chat_id] = game
 
     try:
         first_player_emoji = get_symbol_emoji(first_player, game_theme_emojis)
-        sent_message = await message.reply_text(
-            f"🎲 *Новая игра началась!* 🎲\n\n"
-            f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
-            f"👤 {escaped_username} играет за {first_player_emoji}\n"
-            f"⏳ Ожидаем второго игрока...\n\n"
-            f"*Первым ходит*: {first_player_emoji}\n\n"
-            f"⏱️ *Время на игру*: {GAME_TIMEOUT_SECONDS} секунд",
-            reply_markup=get_keyboard(chat_id),
-            parse_mode="Markdown"
-        )
-        game_data['message_id'] = sent_message.message_id
-        logger.info(f"New game started by {username} ({user_id}) in chat {chat_id}. Message ID: {sent_message.message_id}")
-
-        job_context = {'chat_id': chat_id, 'message_id': sent_message.message_id}
-        timeout_job = context.job_queue.run_once(
-            game_timeout,
-            when=timedelta(seconds=GAME_TIMEOUT_SECONDS),
-            data=job_context,
-            name=f"game_timeout_{chat_id}"
+        if ai_level:
+            new_game_text = (
+                f"🤖 *Игра с ботом!* 🤖\n\n"
+                f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
+                f"👤 {escaped_username} играет за {first_player_emoji}\n"
+                f"🤖 Бот ({ai_level}) играет за {get_symbol_emoji(game.waiting_player, game_theme_emojis)}\n\n"
+                + (f"🔢 Поле: *{geometry.label}*\n\n" if geometry is not CLASSIC else "")
+                + f"*Первым ходит*: {first_player_emoji}"
+            )
+        else:
+            new_game_text = (
+                f"🎲 *Новая игра началась!* 🎲\n\n"
+                f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
+                f"👤 {escaped_username} играет за {first_player_emoji}\n"
+                f"⏳ Ожидаем второго игрока...\n\n"
+                + (f"🔢 Поле: *{geometry.label}*\n\n" if geometry is not CLASSIC else "")
+                + f"*Первым ходит*: {first_player_emoji}\n\n"
+                f"⏱️ *Время на игру*: {GAME_TIMEOUT_SECONDS} секунд"
+            )
+        keyboard = get_keyboard(chat_id)
+        sent_message = await outbound.call(
+            chat_id,
+            lambda: message.reply_text(new_game_text, reply_markup=keyboard, parse_mode="Markdown"),
+            f"new_game message ({chat_id})"
         )
-        game_data['timeout_job'] = timeout_job
-        logger.info(f"Scheduled timeout job ({GAME_TIMEOUT_SECONDS}s) for game in chat {chat_id}")
+        game.message_id = sent_message.message_id
+        games.mark_dirty(chat_id)
+        outbound.remember_sent(game, new_game_text, keyboard)
+        logger.info("New game started by %s (%s) in chat %s. Message ID: %s", username, user_id, chat_id, sent_message.message_id)
+
+        if not ai_level: # В игре с ботом второй игрок уже есть, ждать некого
+            timeouts.schedule(chat_id, GAME_TIMEOUT_SECONDS, game_timeout, context.bot, chat_id, sent_message.message_id)
+            logger.info("Scheduled timeout (%ss) for game in chat %s", GAME_TIMEOUT_SECONDS, chat_id)
 
     except telegram.error.BadRequest as e:
-         logger.error(f"Failed to send new game message in chat {chat_id}: {e}")
+         logger.error("Failed to send new game message in chat %s: %s", chat_id, e)
          if chat_id in games: del games[chat_id]
     except Exception as e:
-        logger.error(f"Unexpected error starting game in chat {chat_id}: {e}", exc_info=True)
+        logger.error("Unexpected error starting game in chat %s: %s", chat_id, e, exc_info=True)
         if chat_id in games: del games[chat_id]
 
 async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик нажатия на кнопки игрового поля или управления игрой."""
     query = update.callback_query
-    try:
-        # Пытаемся ответить на callback query как можно раньше
-        await query.answer()
-    except telegram.error.BadRequest as e:
-        # Игнорируем ошибку, если query слишком старый
-        logger.warning(f"Failed to answer callback query (likely too old or already answered): {e}")
+    # Отвечаем на callback query как можно раньше (ошибку устаревшего query outbound логирует сам)
+    await outbound.answer(query)
 
     data = query.data
     chat_id = update.effective_chat.id
@@ -122,9 +140,22 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     message = query.message # Сообщение, к которому прикреплена кнопка
     message_id = message.message_id if message else None
 
+    # Подписанная кнопка хода (callback_sign.py): подделку отклоняем до обращения к хранилищу
+    move = None
+    if data.startswith(MOVE_PREFIX):
+        move = callback_signer.decode(chat_id, data)
+        if move is None:
+            logger.warning("Rejected forged move button from user %s in chat %s: %r", user_id, chat_id, data)
+            return
+
     # --- Проверка 1: Игра для этого чата вообще существует? ---
     if chat_id not in games:
-        logger.warning(f"Button click received for potentially non-existent or starting game in chat {chat_id}. Data: {data}. Message ID: {message_id}")
+        if data == "new_game" and message:
+            # Завершенная игра уже вытеснена sweeper'ом - кнопка "Новая игра" должна работать
+            logger.info("User %s initiating new game via button in chat %s (previous game evicted).", user_id, chat_id)
+            await new_game(Update(update_id=update.update_id, message=message), context)
+            return
+        logger.warning("Button click received for potentially non-existent or starting game in chat %s. Data: %s. Message ID: %s", chat_id, data, message_id)
         # НЕ удаляем клавиатуру здесь, так как игра может быть в процессе создания.
         # Просто выходим, если игры точно нет в данный момент.
         # Если клик был по кнопке реально старого сообщения, клавиатура
@@ -132,19 +163,28 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return # Выходим, не трогая разметку
 
     # --- Если игра существует (chat_id in games) ---
-    game_data = games[chat_id]
-    game_message_id = game_data.get('message_id')
-    game_theme_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY])
+    game = games[chat_id]
+    game.touch()
+    game_message_id = game.message_id
+    game_theme_emojis = game.theme
+
+    # --- Проверка подписанной кнопки: та же игра и тот же ход? ---
+    if move is not None:
+        move_game_id, move_seq, move_cell = move
+        if move_game_id != game.game_id or move_seq != game.board.moves:
+            # Кнопка старой игры или повторное нажатие на уже сделанный ход
+            return
+        data = str(move_cell)
+    elif data.isdigit() and game.game_id:
+        return # Голая клетка у игры с подписанными кнопками - старая клавиатура или подделка
+    if data.isdigit() and int(data) >= game.board.geometry.cells:
+        return # Клетка за пределами поля этой игры - кнопка игры другого размера
 
     # --- Проверка 2: Клик был по актуальному сообщению игры? ---
     if message_id and game_message_id and message_id != game_message_id:
-        logger.warning(f"Button click on OLD message ({message_id}, current game msg is {game_message_id}) in chat {chat_id}. Data: {data}. User: {user_id}")
+        logger.warning("Button click on OLD message (%s, current game msg is %s) in chat %s. Data: %s. User: %s", message_id, game_message_id, chat_id, data, user_id)
         # Это точно клик по старому сообщению, удаляем его клавиатуру
-        try:
-            await context.bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
-            logger.info(f"Removed keyboard from old game message {message_id} in chat {chat_id}.")
-        except Exception as e:
-            logger.warning(f"Could not remove keyboard from old message {message_id} in chat {chat_id}: {e}")
+        outbound.edit_message_reply_markup(context.bot, chat_id, message_id, reply_markup=None)
         return # Выходим
 
     # --- Обработка разных callback_data --- 
@@ -152,17 +192,17 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     # 1. Неактивная кнопка (занятая клетка / конец игры)
     if data == "noop":
         # Можно добавить кастомный ответ через query.answer, если нужно
-        # await query.answer("Клетка занята или игра завершена", show_alert=False)
+        # await outbound.answer(query, "Клетка занята или игра завершена", show_alert=False)
         return
 
     # 2. Кнопка "Новая игра"
     elif data == "new_game":
-        if not game_data.get('game_over', True):
-             # await query.answer("Эта игра еще не завершена!", show_alert=True) # Не спамим, если игра активна
-             logger.warning(f"User {user_id} clicked 'new_game' on an active game in chat {chat_id}.")
+        if not game.game_over:
+             # await outbound.answer(query, "Эта игра еще не завершена!", show_alert=True) # Не спамим, если игра активна
+             logger.warning("User %s clicked 'new_game' on an active game in chat %s.", user_id, chat_id)
              return
         # Вызываем new_game, передавая текущий update (или его часть)
-        logger.info(f"User {user_id} initiating new game via button in chat {chat_id}.")
+        logger.info("User %s initiating new game via button in chat %s.", user_id, chat_id)
         # Создаем "фиктивный" update, чтобы передать message и user
         # Важно: Используем оригинальный query.message, чтобы сохранить контекст чата
         fake_update = Update(
@@ -177,187 +217,191 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         cell_index = int(data)
         username = update.effective_user.username or f"player_{user_id}"
 
-        if game_data["game_over"]:
-            # await query.answer("Игра завершена!", show_alert=False)
+        if game.game_over:
+            # await outbound.answer(query, "Игра завершена!", show_alert=False)
             return
 
-        current_player_symbol = game_data["current_player"]
-        current_player_id = game_data["players"].get(current_player_symbol)
-        second_player_symbol = "O" if current_player_symbol == "X" else "X"
-        second_player_id = game_data["players"].get(second_player_symbol)
+        current_player_symbol = game.current_player
+        current_player_id = game.player(current_player_symbol)
+        second_player_symbol = game.waiting_player
+        second_player_id = game.player(second_player_symbol)
 
         # Присоединение второго игрока
         if not second_player_id:
             if user_id != current_player_id:
-                game_data["players"][second_player_symbol] = user_id
-                game_data["user_symbols"][user_id] = second_player_symbol
-                game_data["usernames"][user_id] = username
+                game.join(second_player_symbol, user_id, username)
+                games.mark_dirty(chat_id)
                 second_player_id = user_id
-                logger.info(f"Player 2 ({username}, {user_id}) joined game in chat {chat_id} as {second_player_symbol}.")
+                logger.info("Player 2 (%s, %s) joined game in chat %s as %s.", username, user_id, chat_id, second_player_symbol)
 
                 # Отмена таймера
-                timeout_job = game_data.get('timeout_job')
-                if timeout_job:
-                    timeout_job.schedule_removal()
-                    game_data['timeout_job'] = None
-                    logger.info(f"Removed timeout job for chat {chat_id} as second player joined.")
+                if timeouts.cancel(chat_id):
+                    logger.info("Removed timeout for chat %s as second player joined.", chat_id)
 
                 # Обновление сообщения игры
-                p1_id = game_data["players"][current_player_symbol]
-                p1_username = game_data["usernames"].get(p1_id, f"player_{p1_id}")
+                p1_username = game.username(current_player_symbol)
                 p1_emoji = get_symbol_emoji(current_player_symbol, game_theme_emojis)
                 p2_emoji = get_symbol_emoji(second_player_symbol, game_theme_emojis)
-                current_player_emoji = get_symbol_emoji(game_data["current_player"], game_theme_emojis)
+                current_player_emoji = get_symbol_emoji(game.current_player, game_theme_emojis)
                 message_text = (
                     f"🎲 *Игра началась!* 🎲\n\n"
                     f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
                     f"👤 {escape_markdown(p1_username, version=1)} ({p1_emoji}) vs {escape_markdown(username, version=1)} ({p2_emoji})\n\n"
                     f"*Ходит*: {current_player_emoji}"
                 )
-                try:
-                    await query.edit_message_text(
-                        message_text,
-                        reply_markup=get_keyboard(chat_id),
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.error(f"Error updating message after P2 join in chat {chat_id}: {e}", exc_info=True)
+                outbound.edit_game_message(
+                    context.bot, game, chat_id, message_id, message_text,
+                    reply_markup=get_keyboard(chat_id),
+                    parse_mode="Markdown"
+                )
                 return # Ход будет следующим нажатием
             else:
-                # await query.answer("Ожидайте второго игрока!", show_alert=False)
+                # await outbound.answer(query, "Ожидайте второго игрока!", show_alert=False)
                 return
 
         # Проверка очередности хода
         if user_id != current_player_id:
-            # await query.answer("Не ваш ход!", show_alert=False)
+            # await outbound.answer(query, "Не ваш ход!", show_alert=False)
             return
 
         # Проверка, занята ли клетка
-        board = game_data["board"]
-        if not isinstance(board[cell_index], int):
-            # await query.answer("Клетка занята!", show_alert=True)
+        board = game.board
+        if not board.is_free(cell_index):
+            # await outbound.answer(query, "Клетка занята!", show_alert=True)
             return
 
-        # Выполнение хода
-        board[cell_index] = current_player_symbol
-        logger.info(f"Player {username} ({user_id}) marked cell {cell_index} with {current_player_symbol} in chat {chat_id}.")
-
-        # Проверка победителя/ничьей
-        winner, winning_indices = check_winner(board)
-        if winner:
-            game_data["game_over"] = True
-            keyboard_to_show = None
-            if winner == "Ничья":
-                message_text = f"🏁 *Ничья!* 🏁\n\nИгра завершена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*"
-                logger.info(f"Game in chat {chat_id} ended in a draw.")
-                keyboard_to_show = get_keyboard(chat_id)
-            else: # Есть победитель
-                 winner_id = game_data["players"][winner]
-                 winner_username = game_data["usernames"].get(winner_id, f"player_{winner_id}")
-                 winner_emoji = get_symbol_emoji(winner, game_theme_emojis)
-                 message_text = f"🏆 *Победитель - {escape_markdown(winner_username, version=1)} ({winner_emoji})!* 🏆\n\nИгра завершена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*"
-                 logger.info(f"Game in chat {chat_id} won by {winner_username} ({winner_id}).")
-                 keyboard_to_show = get_keyboard(chat_id, winning_indices=winning_indices)
-
-            try:
-                await query.edit_message_text(
-                    message_text,
-                    reply_markup=keyboard_to_show,
-                    parse_mode="Markdown"
-                )
-            except Exception as e:
-                logger.error(f"Error updating message on game end in chat {chat_id}: {e}", exc_info=True)
-        else:
-            # Передача хода
-            game_data["current_player"] = second_player_symbol
-            next_player_id = game_data["players"][second_player_symbol]
-            next_player_username = game_data["usernames"].get(next_player_id, f"player_{next_player_id}")
-            p1_id = game_data["players"]["X"]
-            p2_id = game_data["players"]["O"]
-            p1_username = game_data["usernames"].get(p1_id, f"player_{p1_id}")
-            p2_username = game_data["usernames"].get(p2_id, f"player_{p2_id}")
-            p1_emoji = get_symbol_emoji("X", game_theme_emojis)
-            p2_emoji = get_symbol_emoji("O", game_theme_emojis)
-            next_player_emoji = get_symbol_emoji(game_data["current_player"], game_theme_emojis)
-
-            message_text = (
-                 f"🎲 *Игра идет!* 🎲\n\n"
-                 f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
-                 f"👤 {escape_markdown(p1_username, version=1)} ({p1_emoji}) vs {escape_markdown(p2_username, version=1)} ({p2_emoji})\n\n"
-                 f"*Ходит*: {escape_markdown(next_player_username, version=1)} ({next_player_emoji})"
+        # Выполнение хода и проверка победителя/ничьей (только линии через эту клетку)
+        winner, winning_indices = board.play(cell_index, current_player_symbol)
+        logger.info("Player %s (%s) marked cell %s with %s in chat %s.", username, user_id, cell_index, current_player_symbol, chat_id)
+        if not winner and not game.ai_level:
+            game.current_player = second_player_symbol # Передача хода
+        elif not winner and board.geometry is CLASSIC:
+            # Бот отвечает в том же обновлении: одна правка сообщения на оба хода
+            bot_cell = ai_player.choose_move(board.x, board.o, second_player_symbol, game.ai_level)
+            winner, winning_indices = board.play(bot_cell, second_player_symbol)
+            logger.info("Bot (%s) marked cell %s with %s in chat %s.", game.ai_level, bot_cell, second_player_symbol, chat_id)
+        elif not winner:
+            # На большом поле ход бота ищется в пуле процессов (ai_service.py), event loop
+            # не ждет: сейчас показываем ход игрока, ответ бота придет отдельной правкой
+            game.current_player = second_player_symbol
+            ai_service.request(
+                chat_id, board, second_player_symbol, game.ai_level,
+                functools.partial(play_bot_move, context.bot, chat_id, message_id, game.game_id, board.moves),
             )
-            try:
-                await query.edit_message_text(
-                    message_text,
-                    reply_markup=get_keyboard(chat_id),
-                    parse_mode="Markdown"
-                )
-            except telegram.error.BadRequest as e:
-                 if "Message is not modified" not in str(e):
-                      logger.error(f"Error updating message on turn change in chat {chat_id}: {e}")
-            except Exception as e:
-                 logger.error(f"Unexpected error updating message on turn change in chat {chat_id}: {e}", exc_info=True)
+        show_move_result(context.bot, chat_id, message_id, game, winner, winning_indices)
         return
 
-async def game_timeout(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик тайм-аута ожидания второго игрока."""
-    job_context = context.job.data
-    chat_id = job_context['chat_id']
-    message_id = job_context.get('message_id')
+def show_move_result(bot: telegram.Bot, chat_id: int, message_id: int | None, game: GameState,
+                     winner: str | None, winning_indices: list | None) -> None:
+    """Сохраняет игру после хода и правит игровое сообщение."""
+    game_theme_emojis = game.theme
+    if winner:
+        game.game_over = True
+        games.mark_dirty(chat_id)
+        keyboard_to_show = None
+        if winner == DRAW:
+            message_text = f"🏁 *Ничья!* 🏁\n\nИгра завершена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*"
+            logger.info("Game in chat %s ended in a draw.", chat_id)
+            keyboard_to_show = get_keyboard(chat_id)
+        else: # Есть победитель
+             winner_id = game.player(winner)
+             winner_username = game.username(winner)
+             winner_emoji = get_symbol_emoji(winner, game_theme_emojis)
+             message_text = f"🏆 *Победитель - {escape_markdown(winner_username, version=1)} ({winner_emoji})!* 🏆\n\nИгра завершена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*"
+             logger.info("Game in chat %s won by %s (%s).", chat_id, winner_username, winner_id)
+             keyboard_to_show = get_keyboard(chat_id, winning_indices=winning_indices)
+
+        outbound.edit_game_message(
+            bot, game, chat_id, message_id, message_text,
+            reply_markup=keyboard_to_show,
+            parse_mode="Markdown"
+        )
+    else:
+        games.mark_dirty(chat_id)
+        next_player_username = game.username(game.current_player)
+        p1_username = game.username("X")
+        p2_username = game.username("O")
+        p1_emoji = get_symbol_emoji("X", game_theme_emojis)
+        p2_emoji = get_symbol_emoji("O", game_theme_emojis)
+        next_player_emoji = get_symbol_emoji(game.current_player, game_theme_emojis)
 
-    if chat_id in games:
-        game_data = games[chat_id]
-        # Проверяем, что игра всё еще ждет второго игрока и не завершена
-        current_player = game_data.get('current_player')
-        second_player_symbol = "O" if current_player == "X" else "X"
-        if not game_data.get('game_over') and not game_data['players'].get(second_player_symbol):
-            game_data['game_over'] = True
-            game_theme_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY])
-            logger.info(f"Game in chat {chat_id} timed out waiting for P2.")
+        message_text = (
+             f"🎲 *Игра идет!* 🎲\n\n"
+             f"🎨 Темы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*\n\n"
+             f"👤 {escape_markdown(p1_username, version=1)} ({p1_emoji}) vs {escape_markdown(p2_username, version=1)} ({p2_emoji})\n\n"
+             f"*Ходит*: {escape_markdown(next_player_username, version=1)} ({next_player_emoji})"
+        )
+        outbound.edit_game_message(
+            bot, game, chat_id, message_id, message_text,
+            reply_markup=get_keyboard(chat_id),
+            parse_mode="Markdown"
+        )
 
+async def play_bot_move(bot: telegram.Bot, chat_id: int, message_id: int | None, game_id: str, moves: int, cell: int) -> None:
+    """Ход бота из пула процессов (ai_service.py), если игра за время поиска не изменилась."""
+    async with chat_locks.lock(chat_id), games.exclusive(chat_id):
+        game = games.get(chat_id)
+        if game is None or game.game_over or game.game_id != game_id or game.board.moves != moves:
+            logger.info("Dropped bot move in chat %s: the game changed during the search.", chat_id)
+            return
+        game.touch()
+        symbol = game.current_player
+        winner, winning_indices = game.board.play(cell, symbol)
+        logger.info("Bot (%s) marked cell %s with %s in chat %s.", game.ai_level, cell, symbol, chat_id)
+        if not winner:
+            game.current_player = game.waiting_player
+        show_move_result(bot, chat_id, message_id, game, winner, winning_indices)
+
+async def game_timeout(bot: telegram.Bot, chat_id: int, message_id: int | None) -> None:
+    """Обработчик тайм-аута ожидания второго игрока (вызывается колесом таймеров)."""
+
+    # Проверка и game_over = True - под блокировкой чата, в этом процессе и между воркерами
+    # (обработчик мог как раз присоединить второго игрока)
+    async with chat_locks.lock(chat_id), games.exclusive(chat_id):
+        game = games.get(chat_id)
+        timed_out = game is not None and not game.game_over and not game.player(game.waiting_player)
+        if timed_out:
+            game.game_over = True
+            games.mark_dirty(chat_id)
+
+    if game is not None:
+        # Игра всё еще ждала второго игрока - сообщаем об отмене
+        if timed_out:
+            game_theme_emojis = game.theme
+            logger.info("Game in chat %s timed out waiting for P2.", chat_id)
+
+            timeout_text = f"⌛ *Время вышло!* ⌛\n\nВторой игрок не присоединился ({GAME_TIMEOUT_SECONDS} сек). Игра отменена."
+            new_game_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")]])
+            edited = False
             if message_id:
                 try:
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text=f"⌛ *Время вышло!* ⌛\n\nВторой игрок не присоединился ({GAME_TIMEOUT_SECONDS} сек). Игра отменена.\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")]]),
+                    await outbound.edit_game_message(
+                        bot, game, chat_id, message_id,
+                        f"{timeout_text}\n\nТемы: *{game_theme_emojis['name']} {game_theme_emojis['X']}/{game_theme_emojis['O']}*",
+                        reply_markup=new_game_markup,
                         parse_mode="Markdown"
                     )
-                    logger.info(f"Edited message {message_id} in chat {chat_id} to show timeout.")
+                    edited = True
+                    logger.info("Edited message %s in chat %s to show timeout.", message_id, chat_id)
                 except Exception as e:
-                    logger.error(f"Failed to edit message {message_id} on timeout: {e}")
-                    # Попытка отправить новое сообщение, если редактирование не удалось
-                    try:
-                        await context.bot.send_message(
-                             chat_id=chat_id,
-                             text=f"⌛ *Время вышло!* ⌛\n\nВторой игрок не присоединился ({GAME_TIMEOUT_SECONDS} сек). Игра отменена.",
-                             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")]]),
-                             parse_mode="Markdown"
-                        )
-                    except Exception as send_e:
-                         logger.error(f"Failed to send timeout message in chat {chat_id}: {send_e}")
+                    logger.error("Failed to edit message %s on timeout: %s", message_id, e)
             else:
-                logger.warning(f"Message ID not found for timed out game in chat {chat_id}, sending new message.")
+                logger.warning("Message ID not found for timed out game in chat %s, sending new message.", chat_id)
+
+            # Отправляем новое сообщение, если редактирование невозможно или не удалось
+            if not edited:
                 try:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                         text=f"⌛ *Время вышло!* ⌛\n\nВторой игрок не присоединился ({GAME_TIMEOUT_SECONDS} сек). Игра отменена.",
-                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")]]),
-                         parse_mode="Markdown"
+                    await outbound.send_message(
+                        bot, chat_id, timeout_text,
+                        reply_markup=new_game_markup,
+                        parse_mode="Markdown"
                     )
                 except Exception as send_e:
-                     logger.error(f"Failed to send timeout message in chat {chat_id}: {send_e}")
-
-            # Убираем задачу из game_data, если она там была
-            if 'timeout_job' in game_data: 
-                game_data['timeout_job'] = None
-
-        elif game_data.get('timeout_job'):
-             logger.info(f"Timeout job executed for chat {chat_id}, but game already started/finished. Removing job reference.")
-             game_data['timeout_job'] = None
+                     logger.error("Failed to send timeout message in chat %s: %s", chat_id, send_e)
+        else:
+             logger.info("Timeout fired for chat %s, but game already started/finished.", chat_id)
     else:
-        logger.warning(f"Timeout job executed for chat {chat_id}, but no game data found.")
+        logger.warning("Timeout fired for chat %s, but no game data found.", chat_id)
 
 # --- Обработчики тем --- 
 
@@ -382,18 +426,19 @@ async def themes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         parse_mode="Markdown"
     )
 
-async def select_theme_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик выбора темы из меню /themes."""
+async def select_theme_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, theme_key: str | None = None) -> None:
+    """Обработчик выбора темы из меню /themes. theme_key уже разобран callback_router."""
     query = update.callback_query
-    await query.answer()
+    await outbound.answer(query)
 
-    theme_key = query.data.split("theme_select_")[-1]
+    if theme_key is None:
+        theme_key = query.data.removeprefix(THEME_SELECT_PREFIX)
     user_id = update.effective_user.id
 
     if theme_key in THEMES:
         context.user_data['chosen_theme'] = theme_key
         chosen_theme = THEMES[theme_key]
-        logger.info(f"User {user_id} selected theme: {theme_key}")
+        logger.info("User %s selected theme: %s", user_id, theme_key)
 
         buttons = []
         for key, theme in THEMES.items():
@@ -402,8 +447,10 @@ async def select_theme_callback(update: Update, context: ContextTypes.DEFAULT_TY
                  button_text = f"✅ {button_text}"
             buttons.append([InlineKeyboardButton(button_text, callback_data=f"theme_select_{key}")])
 
+        chat_id = update.effective_chat.id
         try:
-            await query.edit_message_text(
+            await outbound.edit_message_text(
+                context.bot, chat_id, query.message.message_id,
                 f"🎨 *Выбор темы игры* 🎨\n\n"
                 f"✅ Тема выбрана: *{chosen_theme['name']} {chosen_theme['X']}/{chosen_theme['O']}*\n\n"
                 f"Выберите другую тему или начните игру:",
@@ -411,18 +458,15 @@ async def select_theme_callback(update: Update, context: ContextTypes.DEFAULT_TY
                 parse_mode="Markdown"
             )
         except telegram.error.BadRequest as e:
-             logger.warning(f"Failed to edit themes message: {e}")
-             if update.effective_chat:
-                 try:
-                     await update.effective_chat.send_message(
-                         f"✅ Тема изменена на: *{chosen_theme['name']} {chosen_theme['X']}/{chosen_theme['O']}*",
-                         parse_mode="Markdown"
-                     )
-                 except Exception as send_err:
-                      logger.error(f"Failed to send theme confirmation message: {send_err}")
+             logger.warning("Failed to edit themes message: %s", e)
+             outbound.send_message(
+                 context.bot, chat_id,
+                 f"✅ Тема изменена на: *{chosen_theme['name']} {chosen_theme['X']}/{chosen_theme['O']}*",
+                 parse_mode="Markdown"
+             )
     else:
-        logger.warning(f"Invalid theme key received: {theme_key}")
-        # await query.answer("Некорректная тема!", show_alert=True)
+        logger.warning("Invalid theme key received: %s", theme_key)
+        # await outbound.answer(query, "Некорректная тема!", show_alert=True)
 
 async def change_theme_prompt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик кнопки 'Сменить тему' во время игры."""
@@ -431,30 +475,24 @@ async def change_theme_prompt_callback(update: Update, context: ContextTypes.DEF
     chat_id = update.effective_chat.id
 
     if chat_id not in games:
-        await query.answer("Игра не найдена.", show_alert=True)
+        await outbound.answer(query, "Игра не найдена.", show_alert=True)
         return
 
-    game_data = games[chat_id]
+    game = games[chat_id]
+    game.touch()
 
-    if game_data.get('game_over', True):
-        await query.answer("Игра уже завершена.", show_alert=True)
+    if game.game_over:
+        await outbound.answer(query, "Игра уже завершена.", show_alert=True)
         return
 
-    player_symbols = [sym for sym, pid in game_data["players"].items() if pid == user_id]
-    if not player_symbols:
-        await query.answer("Только игроки могут менять тему.", show_alert=True)
+    if not game.is_player(user_id):
+        await outbound.answer(query, "Только игроки могут менять тему.", show_alert=True)
         return
         
-    await query.answer()
+    await outbound.answer(query)
 
     buttons = []
-    current_game_theme_key = None
-    current_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY])
-    for key, theme in THEMES.items():
-        if theme == current_emojis:
-            current_game_theme_key = key
-            break
-            
+    current_game_theme_key = game.theme_key
     for key, theme in THEMES.items():
         button_text = f"{theme['name']} {theme['X']}/{theme['O']}"
         if key == current_game_theme_key:
@@ -464,45 +502,48 @@ async def change_theme_prompt_callback(update: Update, context: ContextTypes.DEF
     buttons.append([InlineKeyboardButton("Назад к игре", callback_data="cancel_theme_change")])
     
     try:
-        await query.edit_message_text(
+        await outbound.edit_game_message(
+            context.bot, game, chat_id, query.message.message_id,
             f"🎨 *Смена темы во время игры* 🎨\n\n"
             f"Выберите новую тему для текущей игры. Это также обновит вашу тему по умолчанию для будущих игр.",
             reply_markup=InlineKeyboardMarkup(buttons),
             parse_mode="Markdown"
         )
-        logger.info(f"User {user_id} initiated theme change prompt in game chat {chat_id}")
+        logger.info("User %s initiated theme change prompt in game chat %s", user_id, chat_id)
     except Exception as e:
-        logger.error(f"Failed to show theme selection prompt in chat {chat_id}: {e}")
-        # await query.answer("Не удалось отобразить выбор темы.", show_alert=True)
+        logger.error("Failed to show theme selection prompt in chat %s: %s", chat_id, e)
+        # await outbound.answer(query, "Не удалось отобразить выбор темы.", show_alert=True)
 
-async def select_theme_ingame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик выбора темы во время игры."""
+async def select_theme_ingame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, theme_key: str | None = None) -> None:
+    """Обработчик выбора темы во время игры. theme_key уже разобран callback_router."""
     query = update.callback_query
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    theme_key = query.data.split("theme_select_ingame_")[-1]
+    if theme_key is None:
+        theme_key = query.data.removeprefix(THEME_SELECT_INGAME_PREFIX)
 
     if chat_id not in games:
-        await query.answer("Игра не найдена.", show_alert=True)
+        await outbound.answer(query, "Игра не найдена.", show_alert=True)
         return
         
-    game_data = games[chat_id]
+    game = games[chat_id]
+    game.touch()
 
-    player_symbols = [sym for sym, pid in game_data["players"].items() if pid == user_id]
-    if not player_symbols:
-        await query.answer("Только игроки могут подтвердить смену темы.", show_alert=True)
+    if not game.is_player(user_id):
+        await outbound.answer(query, "Только игроки могут подтвердить смену темы.", show_alert=True)
         return
         
     if theme_key not in THEMES:
-        await query.answer("Некорректная тема.", show_alert=True)
-        logger.warning(f"Invalid ingame theme key received: {theme_key} from user {user_id}")
+        await outbound.answer(query, "Некорректная тема.", show_alert=True)
+        logger.warning("Invalid ingame theme key received: %s from user %s", theme_key, user_id)
         return
 
-    await query.answer(f"Тема '{THEMES[theme_key]['name']}' применена!") 
+    await outbound.answer(query, f"Тема '{THEMES[theme_key]['name']}' применена!") 
 
-    game_data['theme_emojis'] = THEMES[theme_key]
+    game.theme_key = theme_key
+    games.mark_dirty(chat_id)
     context.user_data['chosen_theme'] = theme_key
-    logger.info(f"User {user_id} changed ingame theme to {theme_key} in chat {chat_id}. User preference updated.")
+    logger.info("User %s changed ingame theme to %s in chat %s. User preference updated.", user_id, theme_key, chat_id)
 
     # Восстанавливаем сообщение игры
     await _restore_game_message(query, context, chat_id, theme_changed=True)
@@ -514,18 +555,18 @@ async def cancel_theme_change_callback(update: Update, context: ContextTypes.DEF
     chat_id = update.effective_chat.id
 
     if chat_id not in games:
-        await query.answer("Игра не найдена.", show_alert=True)
+        await outbound.answer(query, "Игра не найдена.", show_alert=True)
         return
         
-    game_data = games[chat_id]
+    game = games[chat_id]
+    game.touch()
     
-    player_exists = any(pid == user_id for pid in game_data["players"].values())
-    if not player_exists:
-        await query.answer("Только игроки могут отменить смену темы.", show_alert=True)
+    if not game.is_player(user_id):
+        await outbound.answer(query, "Только игроки могут отменить смену темы.", show_alert=True)
         return
 
-    await query.answer("Смена темы отменена.")
-    logger.info(f"User {user_id} cancelled ingame theme change in chat {chat_id}.")
+    await outbound.answer(query, "Смена темы отменена.")
+    logger.info("User %s cancelled ingame theme change in chat %s.", user_id, chat_id)
 
     # Восстанавливаем сообщение игры
     await _restore_game_message(query, context, chat_id, theme_changed=False)
@@ -535,16 +576,15 @@ async def _restore_game_message(query: telegram.CallbackQuery, context: ContextT
     if chat_id not in games:
         return # Игра могла закончиться пока выбирали тему
         
-    game_data = games[chat_id]
-    game_theme_emojis = game_data.get("theme_emojis", THEMES[DEFAULT_THEME_KEY])
-    current_player_symbol = game_data['current_player']
-    current_player_id = game_data['players'].get(current_player_symbol)
-    current_player_username = game_data['usernames'].get(current_player_id, f"player_{current_player_id}")
+    game = games[chat_id]
+    game_theme_emojis = game.theme
+    current_player_symbol = game.current_player
+    current_player_username = game.username(current_player_symbol)
     
-    p1_id = game_data["players"].get("X")
-    p2_id = game_data["players"].get("O")
-    p1_username = game_data["usernames"].get(p1_id, "?") if p1_id else "?"
-    p2_username = game_data["usernames"].get(p2_id, "Ожидание") if p2_id else "Ожидание"
+    p1_id = game.player_x
+    p2_id = game.player_o
+    p1_username = game.username("X") if p1_id else "?"
+    p2_username = game.username("O") if p2_id else "Ожидание"
     
     p1_emoji = get_symbol_emoji("X", game_theme_emojis)
     p2_emoji = get_symbol_emoji("O", game_theme_emojis)
@@ -568,14 +608,8 @@ async def _restore_game_message(query: telegram.CallbackQuery, context: ContextT
             f"⏱️ *Время на игру*: {GAME_TIMEOUT_SECONDS} секунд"
         )
         
-    try:
-        await query.edit_message_text(
-            message_text,
-            reply_markup=get_keyboard(chat_id),
-            parse_mode="Markdown"
-        )
-    except telegram.error.BadRequest as e:
-         if "Message is not modified" not in str(e):
-              logger.error(f"Failed to restore game message in chat {chat_id}: {e}")
-    except Exception as e:
-         logger.error(f"Unexpected error restoring game message in chat {chat_id}: {e}", exc_info=True) 
\ No newline at end of file
+    outbound.edit_game_message(
+        context.bot, game, chat_id, query.message.message_id, message_text,
+        reply_markup=get_keyboard(chat_id),
+        parse_mode="Markdown"
+    ) 
\ No newline at end of file
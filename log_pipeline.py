@@ -0,0 +1,123 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполненной очереди выбрасывает запись, а не пишет трейсбек."""
+
+    def __init__(self, log_queue: queue.Queue, pipeline: "LogPipeline"):
+        super().__init__(log_queue)
+        self.pipeline = pipeline
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.pipeline.dropped += 1
+
+
+class _DebugSampler(logging.Filter):
+    """Пропускает каждую `every`-ю DEBUG-запись одного шаблона сообщения.
+
+    Сообщения пишутся в %-стиле, поэтому record.msg - это шаблон без
+    подставленных значений, и частые события ("получено обновление",
+    "старая клавиатура") считаются по отдельности, а редкие не теряются.
+    """
+
+    def __init__(self, every: int, pipeline: "LogPipeline"):
+        super().__init__()
+        self.every = every
+        self.pipeline = pipeline
+        self._counts: dict[tuple[str, str], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.name, str(record.msg))
+        count = self._counts.get(key, 0)
+        if not count and len(self._counts) >= 10000:
+            self._counts.clear()  # f-строки вместо шаблонов: каждый текст уникален
+        self._counts[key] = count + 1
+        if count % self.every:
+            self.pipeline.sampled_out += 1
+            return False
+        return True
+
+
+def parse_levels(spec: str) -> dict[str, int]:
+    """"httpx=WARNING,bot=DEBUG" -> {"httpx": 30, "bot": 10}; некорректные пары пропускаются."""
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        name, level = name.strip(), level.strip().upper()
+        if name and isinstance(logging.getLevelName(level), int):
+            levels[name] = logging.getLevelName(level)
+    return levels
+
+
+class LogPipeline:
+    """Логирование без записи в поток на event loop.
+
+    Раньше config.py и bot.py вызывали logging.basicConfig(level=DEBUG): каждая
+    запись форматировалась и писалась в stderr прямо в обработчике обновления.
+    Теперь корневой логгер пишет в ограниченную очередь (QueueHandler), а
+    форматирование вывода и запись делает отдельный поток QueueListener.
+    Если очередь переполнена, запись выбрасывается и считается в stats().
+
+    Уровень задается LOG_LEVEL, уровни отдельных логгеров - LOG_LEVELS
+    ("httpx=WARNING,outbound=DEBUG,update_queue=WARNING"): у каждого модуля
+    свой логгер logging.getLogger(__name__), имя логгера - имя модуля. Сообщения пишутся лениво в %-стиле
+    (logger.debug("...: %s", value)): ниже уровня логгера строка не собирается
+    вообще. DEBUG-записи можно прореживать: LOG_DEBUG_SAMPLE_EVERY=N оставляет
+    каждую N-ю запись одного шаблона.
+    """
+
+    def __init__(self):
+        self._listener: logging.handlers.QueueListener | None = None
+        self._queue: queue.Queue | None = None
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def start(self, level: str = "INFO", levels: str = "", sample_every: int = 1, queue_size: int = 10000) -> None:
+        if self._listener is not None:
+            return
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        queue_handler = _DroppingQueueHandler(self._queue, self)
+        if sample_every > 1:
+            queue_handler.addFilter(_DebugSampler(sample_every, self))
+
+        output = logging.StreamHandler()
+        output.setFormatter(logging.Formatter(LOG_FORMAT))
+        self._listener = logging.handlers.QueueListener(self._queue, output, respect_handler_level=True)
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(level.upper() if isinstance(logging.getLevelName(level.upper()), int) else logging.INFO)
+        for name, name_level in parse_levels(levels).items():
+            logging.getLogger(name).setLevel(name_level)
+
+        self._listener.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """Дописывает очередь и останавливает поток записи."""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def stats(self) -> dict:
+        return {
+            "level": logging.getLevelName(logging.getLogger().level),
+            "queued": self._queue.qsize() if self._queue else 0,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+        }
+
+
+log_pipeline = LogPipeline()
@@ -0,0 +1,202 @@
+import time
+from bisect import bisect_left
+from typing import Callable
+
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: observe - bisect и три сложения."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по корзинам (последняя - +Inf), сумма, количество]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == "+Inf" else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """Значение читается функцией в момент запроса /metrics, а не обновляется на горячем пути.
+
+    Функция возвращает число или словарь {значения меток: число}.
+    """
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float | dict], labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = documentation
+        self.read = read
+        self.labelnames = labelnames
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.read()
+        if isinstance(value, dict):
+            for labels, item in value.items():
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(item)}")
+        else:
+            lines.append(f"{self.name} {_number(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Метрики процесса в текстовом формате Prometheus (/metrics).
+
+    Счетчики и гистограммы - обычные словари в памяти процесса без
+    блокировок (все пишется из event loop), gauge считаются только при
+    выгрузке. При WEB_WORKERS > 1 у каждого воркера свои значения, и
+    /metrics отдает метрики того воркера, который принял запрос.
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+
+    def _add(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, read: Callable[[], float | dict], labelnames: tuple[str, ...] = ()) -> Gauge:
+        # Повторная регистрация (новое приложение в том же процессе) заменяет функцию чтения
+        self._metrics[name] = Gauge(name, documentation, read, labelnames)
+        return self._metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# --- Метрики горячего пути ---
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request handling time", ("path", "status"))
+WEBHOOK_UPDATES = metrics.counter(
+    "webhook_updates_total", "Webhook updates by outcome", ("outcome",))
+UPDATE_QUEUE_WAIT_SECONDS = metrics.histogram(
+    "update_queue_wait_seconds", "Time an update waited in the update queue")
+UPDATE_LATENCY_SECONDS = metrics.histogram(
+    "update_latency_seconds", "Time from webhook enqueue to the end of processing", ("kind",))
+CHAT_LOCK_WAIT_SECONDS = metrics.histogram(
+    "chat_lock_wait_seconds", "Time an update waited for its chat lock")
+HANDLER_SECONDS = metrics.histogram(
+    "handler_duration_seconds", "PTB handler time by update kind", ("kind",))
+HANDLER_ERRORS = metrics.counter(
+    "handler_errors_total", "Exceptions raised by PTB handlers by update kind", ("kind",))
+CALLBACK_ROUTE_SECONDS = metrics.histogram(
+    "callback_route_duration_seconds", "Inline button handler time by route", ("route",))
+OUTBOUND_REQUEST_SECONDS = metrics.histogram(
+    "outbound_request_duration_seconds", "Bot API request latency by method", ("method",))
+OUTBOUND_FAILURES = metrics.counter(
+    "outbound_failures_total", "Failed Bot API requests by method", ("method",))
+OUTBOUND_RETRY_AFTER = metrics.counter(
+    "outbound_retry_after_total", "RetryAfter (flood control) responses from the Bot API")
+AI_SEARCH_SECONDS = metrics.histogram(
+    "ai_search_duration_seconds", "Bot move search time in the process pool by outcome", ("outcome",))
+EVENT_LOOP_LAG_SECONDS = metrics.histogram(
+    "event_loop_lag_seconds", "Event loop scheduling lag sampled while bot move searches run")
+
+
+def update_kind(update) -> str:
+    """Метка вида обновления: callback_query, command, message или other."""
+    if getattr(update, "callback_query", None) is not None:
+        return "callback_query"
+    message = getattr(update, "message", None)
+    if message is not None:
+        return "command" if message.text and message.text.startswith("/") else "message"
+    return "other"
+
+
+class MetricsMiddleware:
+    """ASGI middleware: время обработки HTTP-запроса по пути и статусу.
+
+    Чистый ASGI без BaseHTTPMiddleware - ни лишней задачи, ни копирования
+    тела. Неизвестные пути сводятся к метке "other", чтобы число рядов не росло.
+    """
+
+    def __init__(self, app, paths=()):
+        self.app = app
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            path = scope["path"] if scope["path"] in self.paths else "other"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, path, status)
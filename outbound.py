@@ -0,0 +1,477 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+import telegram
+
+from config import (
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_GROUP_RATE_PER_MINUTE,
+    OUTBOUND_PRIVATE_RATE,
+    OUTBOUND_MAX_RETRIES,
+    WEB_WORKERS,
+)
+from game_state import GameState
+from metrics import OUTBOUND_REQUEST_SECONDS, OUTBOUND_FAILURES, OUTBOUND_RETRY_AFTER
+from webhook_reply import webhook_replies
+
+logger = logging.getLogger(__name__)
+
+# После скольких bucket'ов начинать чистку простаивающих чатов
+BUCKETS_PRUNE_THRESHOLD = 10000
+
+
+def retry_after_seconds(error: telegram.error.RetryAfter) -> float:
+    """RetryAfter.retry_after в PTB бывает int или timedelta."""
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+class TokenBucket:
+    """Классический token bucket: `rate` токенов в секунду, не больше `capacity`."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 - доступен сейчас)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+
+class _OutboundRequest:
+    __slots__ = ("factory", "future", "description", "attempts", "edit_key")
+
+    def __init__(self, factory, future: asyncio.Future, description: str, edit_key: tuple | None = None):
+        self.factory = factory
+        self.future = future
+        self.description = description
+        self.attempts = 0
+        self.edit_key = edit_key
+
+    @property
+    def method(self) -> str:
+        """Метка для метрик: "send_message(123)" -> "send_message"."""
+        return self.description.partition("(")[0]
+
+
+class _EditCall:
+    """Правка сообщения, которую можно "догнать" более новой правкой.
+
+    text=None - правка только клавиатуры (edit_message_reply_markup).
+    """
+
+    __slots__ = ("bot", "chat_id", "message_id", "text", "kwargs")
+
+    def __init__(self, bot: telegram.Bot, chat_id: int, message_id: int, text: str | None, kwargs: dict):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.kwargs = kwargs
+
+    def __call__(self):
+        if self.text is None:
+            return self.bot.edit_message_reply_markup(chat_id=self.chat_id, message_id=self.message_id, **self.kwargs)
+        return self.bot.edit_message_text(self.text, chat_id=self.chat_id, message_id=self.message_id, **self.kwargs)
+
+    def apply(self, newer: "_EditCall") -> None:
+        """Накладывает более новую правку: итог - последнее состояние сообщения."""
+        if newer.text is None and self.text is not None:
+            # Новая правка меняет только клавиатуру - текст из старой сохраняем
+            self.kwargs = {**self.kwargs, "reply_markup": newer.kwargs.get("reply_markup")}
+        else:
+            self.text = newer.text
+            self.kwargs = newer.kwargs
+        self.bot = newer.bot
+
+
+def _is_not_modified(error: BaseException | None) -> bool:
+    return isinstance(error, telegram.error.BadRequest) and "Message is not modified" in str(error)
+
+
+def _forget_sent_on_failure(future: asyncio.Future, game: GameState) -> None:
+    """Правка не дошла: сбрасываем запомненное состояние, следующая уйдет целиком."""
+    if future.cancelled() or (future.exception() is not None and not _is_not_modified(future.exception())):
+        game.sent_text = None
+        game.sent_markup = None
+
+
+def _copy_outcome(source: asyncio.Future, target: asyncio.Future) -> None:
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class OutboundScheduler:
+    """Общий планировщик исходящих запросов к Bot API.
+
+    - глобальный token bucket (лимит Telegram ~30 сообщений в секунду);
+    - token bucket на каждый чат (группы: 20 сообщений в минуту);
+    - у каждого чата своя очередь и не больше одного запроса "в полете",
+      поэтому порядок правок одного сообщения сохраняется, а загруженная
+      группа ждет только свой bucket и не задерживает остальные чаты;
+    - RetryAfter ставит на паузу все отправки на указанное время, после чего
+      запрос повторяется (до OUTBOUND_MAX_RETRIES раз);
+    - правки одного сообщения (chat_id, message_id), ждущие в очереди,
+      схлопываются: более новая заменяет ожидающую, и отправляется только
+      последнее состояние поля.
+    """
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE,
+                 group_rate_per_minute: float = OUTBOUND_GROUP_RATE_PER_MINUTE,
+                 private_rate: float = OUTBOUND_PRIVATE_RATE,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.group_rate = group_rate_per_minute / 60
+        self.group_capacity = max(1.0, group_rate_per_minute)
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._queues: dict[int, deque[_OutboundRequest]] = {}
+        self._ready: deque[int] = deque()
+        self._in_flight: set[int] = set()
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+        # Запросы, отправляемые сейчас: ссылки на задачи держатся до завершения
+        self._executing: set[asyncio.Task] = set()
+        self._paused_until = 0.0
+        # (chat_id, message_id) -> правка, еще не отправленная в API
+        self._pending_edits: dict[tuple, _OutboundRequest] = {}
+
+        self.sent = 0
+        self.failed = 0
+        self.not_modified = 0
+        self.retry_after_count = 0
+        self.edits_coalesced = 0
+        self.edits_skipped = 0
+        self.edits_downgraded = 0
+
+    # --- Публичный API ---
+
+    def submit(self, chat_id: int, factory, description: str = "request") -> asyncio.Future:
+        """Ставит запрос в очередь чата. `factory` - функция без аргументов,
+        возвращающая корутину вызова Bot API. Результат - future с ответом API.
+        """
+        return self._enqueue(chat_id, _OutboundRequest(factory, self._new_future(), description))
+
+    def _submit_edit(self, edit: _EditCall, description: str) -> asyncio.Future:
+        """Ставит правку в очередь или вливает ее в ожидающую правку того же сообщения.
+
+        Future схлопнутой правки завершается результатом итоговой отправки.
+        """
+        key = (edit.chat_id, edit.message_id)
+        pending = self._pending_edits.get(key)
+        if pending is not None:
+            pending.factory.apply(edit)
+            pending.description = description
+            self.edits_coalesced += 1
+            return pending.future
+        request = _OutboundRequest(edit, self._new_future(), description, edit_key=key)
+        self._pending_edits[key] = request
+        return self._enqueue(edit.chat_id, request)
+
+    def _new_future(self) -> asyncio.Future:
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        # Ошибка залогирована в _execute; не даем asyncio ругаться на "never retrieved"
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    def _enqueue(self, chat_id: int, request: _OutboundRequest) -> asyncio.Future:
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+        queue.append(request)
+        if len(queue) == 1 and chat_id not in self._in_flight:
+            self._ready.append(chat_id)
+            self._wakeup.set()
+        return request.future
+
+    async def call(self, chat_id: int, factory, description: str = "request"):
+        """Как submit, но дожидается ответа API (или исключения)."""
+        return await self.submit(chat_id, factory, description)
+
+    def edit_message_text(self, bot: telegram.Bot, chat_id: int, message_id: int, text: str, **kwargs) -> asyncio.Future:
+        return self._submit_edit(
+            _EditCall(bot, chat_id, message_id, text, kwargs),
+            f"edit_message_text({chat_id}, {message_id})",
+        )
+
+    def edit_message_reply_markup(self, bot: telegram.Bot, chat_id: int, message_id: int, reply_markup=None) -> asyncio.Future:
+        return self._submit_edit(
+            _EditCall(bot, chat_id, message_id, None, {"reply_markup": reply_markup}),
+            f"edit_message_reply_markup({chat_id}, {message_id})",
+        )
+
+    def edit_game_message(self, bot: telegram.Bot, game: GameState, chat_id: int, message_id: int,
+                          text: str, reply_markup=None, **kwargs) -> asyncio.Future:
+        """Правка игрового сообщения с учетом того, что уже было отправлено.
+
+        В GameState хранятся последние отправленные текст и клавиатура
+        (sent_text, sent_markup). Если ничего не изменилось - запрос не
+        отправляется; если изменилась только клавиатура - используется более
+        дешевый edit_message_reply_markup.
+        """
+        text_changed = text != game.sent_text
+        if not text_changed and reply_markup == game.sent_markup:
+            self.edits_skipped += 1
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(None)
+            return future
+
+        game.sent_text = text
+        game.sent_markup = reply_markup
+        if text_changed:
+            future = self.edit_message_text(bot, chat_id, message_id, text, reply_markup=reply_markup, **kwargs)
+        else:
+            self.edits_downgraded += 1
+            future = self.edit_message_reply_markup(bot, chat_id, message_id, reply_markup)
+        future.add_done_callback(lambda f: _forget_sent_on_failure(f, game))
+        return future
+
+    @staticmethod
+    def remember_sent(game: GameState, text: str, reply_markup=None) -> None:
+        """Запоминает содержимое только что отправленного игрового сообщения."""
+        game.sent_text = text
+        game.sent_markup = reply_markup
+
+    def send_message(self, bot: telegram.Bot, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        return self.submit(
+            chat_id,
+            lambda: bot.send_message(chat_id, text, **kwargs),
+            f"send_message({chat_id})",
+        )
+
+    async def answer(self, query: telegram.CallbackQuery, text: str | None = None, show_alert: bool = False) -> bool:
+        """Ответ на callback query. Не занимает лимит сообщений чата, но ждет
+        глобальной паузы после RetryAfter. Ошибки не пробрасываются: устаревший
+        query не должен прерывать обработку нажатия.
+
+        Если вебхук еще ждет ответа на этот запрос, ответ уходит в теле
+        HTTP-ответа (webhook_reply.py), без отдельного запроса к API.
+        """
+        params = {"callback_query_id": query.id}
+        if text:
+            params["text"] = text
+        if show_alert:
+            params["show_alert"] = True
+        if webhook_replies.offer(query.id, "answerCallbackQuery", **params):
+            return True
+        return await self.answer_callback(query.get_bot(), query.id, text, show_alert)
+
+    async def answer_callback(self, bot: telegram.Bot, callback_query_id: str, text: str | None = None,
+                              show_alert: bool = False) -> bool:
+        """То же, что answer, но по id запроса: без объекта CallbackQuery (см. fast_path.py)."""
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        started = time.perf_counter()
+        try:
+            return await bot.answer_callback_query(callback_query_id, text, show_alert=show_alert)
+        except telegram.error.RetryAfter as e:
+            self._pause(retry_after_seconds(e))
+        except telegram.error.TelegramError as e:
+            OUTBOUND_FAILURES.inc("answer_callback_query")
+            logger.warning("Failed to answer callback query (likely too old): %s", e)
+        finally:
+            OUTBOUND_REQUEST_SECONDS.observe(time.perf_counter() - started, "answer_callback_query")
+        return False
+
+    def backlog(self) -> dict[int, int]:
+        """Число ожидающих запросов по чатам (только непустые очереди)."""
+        return {chat_id: len(queue) for chat_id, queue in self._queues.items() if queue}
+
+    def stats(self) -> dict:
+        backlog = self.backlog()
+        busiest = sorted(backlog.items(), key=lambda item: -item[1])[:5]
+        return {
+            "pending": sum(backlog.values()),
+            "chats_waiting": len(backlog),
+            "busiest_chats": dict(busiest),
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "failed": self.failed,
+            "not_modified": self.not_modified,
+            "retry_after": self.retry_after_count,
+            "edits_coalesced": self.edits_coalesced,
+            "edits_skipped": self.edits_skipped,
+            "edits_downgraded": self.edits_downgraded,
+            "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 2),
+        }
+
+    async def stop(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        await asyncio.gather(*self._executing, return_exceptions=True)
+
+    # --- Внутреннее ---
+
+    def _ensure_started(self) -> None:
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            if self._ready:
+                self._wakeup.set()
+            self._dispatcher = asyncio.create_task(self._dispatch(), name="outbound_dispatcher")
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:  # группы и каналы
+                bucket = TokenBucket(self.group_rate, self.group_capacity)
+            else:
+                bucket = TokenBucket(self.private_rate, 1.0)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _pause(self, seconds: float) -> None:
+        self.retry_after_count += 1
+        OUTBOUND_RETRY_AFTER.inc()
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logger.warning("Flood control: pausing all outbound requests for %.1fs", seconds)
+
+    async def _dispatch(self) -> None:
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            # Round-robin: первый чат, у которого есть токен
+            chat_id = None
+            min_delay = None
+            for _ in range(len(self._ready)):
+                candidate = self._ready.popleft()
+                delay = self._bucket(candidate).delay(now)
+                if delay <= 0:
+                    chat_id = candidate
+                    break
+                self._ready.append(candidate)
+                min_delay = delay if min_delay is None else min(min_delay, delay)
+
+            if chat_id is None:
+                # Все ждут своих bucket'ов; новый чат в очереди разбудит раньше
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min_delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._global.consume()
+            self._bucket(chat_id).consume()
+            request = self._queues[chat_id].popleft()
+            if request.edit_key and self._pending_edits.get(request.edit_key) is request:
+                # Правка ушла в API: следующие правки сообщения встанут в очередь заново
+                del self._pending_edits[request.edit_key]
+            self._in_flight.add(chat_id)
+            task = asyncio.create_task(self._execute(chat_id, request), name=f"outbound_{chat_id}")
+            self._executing.add(task)
+            task.add_done_callback(self._executing.discard)
+
+    async def _execute(self, chat_id: int, request: _OutboundRequest) -> None:
+        requeue = False
+        started = time.perf_counter()
+        try:
+            request.attempts += 1
+            result = await request.factory()
+            self.sent += 1
+            if not request.future.done():
+                request.future.set_result(result)
+        except telegram.error.RetryAfter as e:
+            self._pause(retry_after_seconds(e))
+            if request.attempts <= self.max_retries:
+                requeue = True
+            else:
+                self._fail(request, e)
+        except Exception as e:
+            self._fail(request, e)
+        finally:
+            OUTBOUND_REQUEST_SECONDS.observe(time.perf_counter() - started, request.method)
+            self._in_flight.discard(chat_id)
+            queue = self._queues.get(chat_id)
+            if requeue:
+                self._requeue(queue, request)
+            if queue:
+                self._ready.append(chat_id)
+                self._wakeup.set()
+            elif queue is not None:
+                del self._queues[chat_id]
+                if len(self._chat_buckets) > BUCKETS_PRUNE_THRESHOLD:
+                    self._prune_buckets()
+
+    def _requeue(self, queue: deque, request: _OutboundRequest) -> None:
+        """Возвращает запрос в начало очереди после RetryAfter.
+
+        Если за время ожидания пришла более новая правка того же сообщения,
+        повтор не нужен: старая правка вливается в новую.
+        """
+        newer = self._pending_edits.get(request.edit_key) if request.edit_key else None
+        if newer is None:
+            queue.appendleft(request)
+            if request.edit_key:
+                self._pending_edits[request.edit_key] = request
+            return
+        request.factory.apply(newer.factory)
+        newer.factory = request.factory
+        newer.future.add_done_callback(lambda f: _copy_outcome(f, request.future))
+        self.edits_coalesced += 1
+
+    def _prune_buckets(self) -> None:
+        """Удаляет bucket'ы простаивающих чатов, уже восстановившиеся до полного."""
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id in self._queues or chat_id in self._in_flight:
+                continue
+            bucket._refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._chat_buckets[chat_id]
+
+    def _fail(self, request: _OutboundRequest, error: Exception) -> None:
+        if _is_not_modified(error):
+            self.not_modified += 1
+            logger.debug("%s: message not modified", request.description)
+        else:
+            self.failed += 1
+            OUTBOUND_FAILURES.inc(request.method)
+            logger.error("Outbound %s failed after %s attempt(s): %s", request.description, request.attempts, error)
+        if not request.future.done():
+            request.future.set_exception(error)
+
+
+# Лимит Bot API общий на бота: каждый воркер uvicorn получает свою долю
+outbound = OutboundScheduler(global_rate=OUTBOUND_GLOBAL_RATE / WEB_WORKERS)
@@ -0,0 +1,157 @@
+import logging
+from collections import OrderedDict, deque
+
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import EMPTY_CELL_SYMBOL, KEYBOARD_CACHE_SIZE
+from game_engine import BitBoard, CELLS_COUNT, SYMBOLS
+
+logger = logging.getLogger(__name__)
+
+
+def build_keyboard(board: BitBoard, theme_emojis: dict, is_game_over: bool, winning_indices=None) -> InlineKeyboardMarkup:
+    """Строит клавиатуру с игровым полем (без кэша).
+       Неактивные кнопки (занятые клетки или конец игры) имеют callback_data='noop'.
+       Подсвечивает выигрышную комбинацию, если переданы winning_indices.
+    """
+    emojis = {
+        "X": theme_emojis.get("X", "❌"),
+        "O": theme_emojis.get("O", "⭕"),
+        "X_win": theme_emojis.get("X_win", "⭐❌⭐"),
+        "O_win": theme_emojis.get("O_win", "⭐⭕⭐"),
+    }
+    empty_emoji = theme_emojis.get(EMPTY_CELL_SYMBOL, "⬜")
+
+    keyboard = []
+    size = board.geometry.size
+    for i in range(0, board.geometry.cells, size):
+        row = []
+        for cell_index in range(i, i + size):
+            cell = board[cell_index]
+            callback_data = "noop"
+            if isinstance(cell, int):
+                cell_text = empty_emoji
+                if not is_game_over:
+                    callback_data = str(cell_index)
+            elif is_game_over and winning_indices and cell_index in winning_indices:
+                cell_text = emojis[f"{cell}_win"]
+            else:
+                cell_text = emojis[cell]
+            row.append(InlineKeyboardButton(cell_text, callback_data=callback_data))
+        keyboard.append(row)
+
+    if is_game_over:
+        keyboard.append([InlineKeyboardButton("🔄 Новая игра", callback_data="new_game")])
+    else:
+        keyboard.append([InlineKeyboardButton("🎨 Сменить тему", callback_data="change_theme_prompt")])
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+class KeyboardCache:
+    """LRU-кэш готовых InlineKeyboardMarkup.
+
+    Ключ: (размер поля, упакованное поле, ключ темы, game_over, выигрышные индексы).
+    InlineKeyboardMarkup в PTB неизменяем, поэтому один объект можно
+    безопасно отдавать во все игры с одинаковым состоянием.
+    """
+
+    def __init__(self, maxsize: int = KEYBOARD_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[tuple, InlineKeyboardMarkup] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(board: BitBoard, theme_key: str, is_game_over: bool, winning_indices=None) -> tuple:
+        # Подсветка возможна только в завершенной игре
+        winning = tuple(winning_indices) if is_game_over and winning_indices else None
+        return board.geometry.size, board.packed, theme_key, is_game_over, winning
+
+    def get_keyboard(self, board: BitBoard, theme_key: str, theme_emojis: dict,
+                     is_game_over: bool, winning_indices=None) -> InlineKeyboardMarkup:
+        """Возвращает клавиатуру из кэша или строит и кэширует новую."""
+        key = self.make_key(board, theme_key, is_game_over, winning_indices)
+        markup = self._entries.get(key)
+        if markup is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return markup
+
+        self.misses += 1
+        markup = build_keyboard(board, theme_emojis, is_game_over, key[4])
+        self._store(key, markup)
+        return markup
+
+    def _store(self, key: tuple, markup: InlineKeyboardMarkup) -> None:
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = markup
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def warm_up(self, themes: dict) -> int:
+        """Заранее строит клавиатуры для всех достижимых позиций каждой темы.
+
+        Останавливается, когда кэш заполнен. Возвращает число добавленных записей.
+        """
+        added = 0
+        for theme_key, theme_emojis in themes.items():
+            for board, is_game_over, winning_indices in _reachable_positions():
+                if len(self._entries) >= self.maxsize:
+                    logger.info("Keyboard cache warm-up stopped at maxsize=%s (%s entries added)", self.maxsize, added)
+                    return added
+                key = self.make_key(board, theme_key, is_game_over, winning_indices)
+                if key not in self._entries:
+                    self._entries[key] = build_keyboard(board, theme_emojis, is_game_over, key[4])
+                    added += 1
+        logger.info("Keyboard cache warmed up with %s entries", added)
+        return added
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+def _reachable_positions():
+    """Все позиции поля 3x3, достижимые из пустого поля при любом первом игроке.
+
+    Обход в ширину: при ограниченном кэше первыми прогреваются ранние
+    (самые частые) позиции. Отдает (BitBoard, game_over, winning_indices);
+    завершенные позиции не продолжаются.
+    """
+    seen = set()
+    queue = deque((0, 0, first) for first in SYMBOLS)
+    while queue:
+        x, o, to_move = queue.popleft()
+        if (x, o, to_move) in seen:
+            continue
+        seen.add((x, o, to_move))
+        board = BitBoard(x, o)
+        winner, winning_indices = board.result()
+        yield board, bool(winner), winning_indices
+        if winner:
+            continue
+        occupied = x | o
+        next_symbol = "O" if to_move == "X" else "X"
+        for cell in range(CELLS_COUNT):
+            if not occupied >> cell & 1:
+                if to_move == "X":
+                    queue.append((x | 1 << cell, o, next_symbol))
+                else:
+                    queue.append((x, o | 1 << cell, next_symbol))
+
+
+keyboard_cache = KeyboardCache()
@@ -0,0 +1,397 @@
+import asyncio
+import contextlib
+import fcntl
+import logging
+import os
+import struct
+import sys
+import tempfile
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+from config import THEMES, DEFAULT_THEME_KEY, SHARED_GAME_NAME, SHARED_GAME_SLOTS, SHARED_LOCK_STRIPES
+from ai_player import AI_LEVELS
+from game_engine import BitBoard, board_geometry
+from game_state import GameState
+from game_store import GameStore
+
+logger = logging.getLogger(__name__)
+
+# Запись слота: chat_id, состояние слота, флаги, тема, уровень бота (0 - игра людей),
+# размер поля и K в ряд (0 - классическое 3x3), версия (seqlock, смещение 16),
+# маски X и O, игроки, message_id, время последнего изменения (time.time()),
+# имена игроков, id игры
+RECORD = struct.Struct("<qBBBBBBxxIQQqqqd32s32s8s")
+# После записей (меняется под блокировкой карты слотов): число занятых слотов,
+# число удаленных (SLOT_DELETED) и наибольшая длина пробы при вставке
+HEADER = struct.Struct("<qqq")
+SLOT_EMPTY, SLOT_USED, SLOT_DELETED = 0, 1, 2
+SLOT_USED_BYTE = bytes([SLOT_USED])
+FLAG_O_TURN, FLAG_GAME_OVER = 1, 2
+THEME_KEYS = list(THEMES)
+AI_LEVEL_KEYS = [None, *AI_LEVELS]
+USERNAME_BYTES = 32
+# Сколько читатель ждет нечетную версию, прежде чем проверить, жив ли писатель
+SEQLOCK_TIMEOUT = 0.05
+
+
+class SharedMemoryGameStore(GameStore):
+    """Игры в общей памяти (multiprocessing.shared_memory) для нескольких воркеров uvicorn.
+
+    Таблица фиксированного размера: `slots` записей RECORD, chat_id ищется
+    открытой адресацией (линейное пробирование от hash(chat_id)). Доска,
+    очередь хода, игроки и message_id лежат в общей памяти; у процесса есть
+    только кэш GameState, который перечитывается, когда меняется версия записи.
+
+    Блокировки - байтовые fcntl-блокировки файла `<name>.lock`:
+    `lock_stripes` полос по hash(chat_id) плюс отдельный байт для карты слотов.
+    exclusive(chat_id) держит полосу чата на время обработки обновления, поэтому
+    чтение-изменение-запись игры не пересекается с другими процессами.
+    Запись идет по схеме seqlock (нечетная версия - запись в процессе), так что
+    читатели (sweeper, таймауты) обходятся без блокировок.
+    Число занятых слотов хранится за таблицей (HEADER), len() не обходит слоты.
+
+    Удаление оставляет метку SLOT_DELETED (через нее продолжается поиск);
+    вставка занимает первую такую метку на своем пути, а метки в конце
+    цепочки (перед пустым слотом) сразу становятся пустыми. Поиск идет не
+    дальше наибольшей длины пробы, с которой когда-либо вставлялась запись,
+    поэтому промах не обходит всю таблицу даже при множестве меток.
+    """
+
+    def __init__(self, name: str = SHARED_GAME_NAME, slots: int = SHARED_GAME_SLOTS,
+                 lock_stripes: int = SHARED_LOCK_STRIPES):
+        super().__init__()
+        self.slots = slots
+        self.lock_stripes = lock_stripes
+        self._used_offset = RECORD.size * slots
+        size = self._used_offset + HEADER.size
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            logger.info("Created shared game table '%s': %s slots, %.1f MiB", name, slots, size / 2**20)
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+        # Таблицу переживает любой отдельный воркер: не даем resource_tracker удалить ее при выходе
+        resource_tracker.unregister(self._shm._name, "shared_memory")
+        if self._shm.size < size:
+            raise RuntimeError(f"Shared game table '{name}' is smaller than {slots} slots; remove /dev/shm/{name}")
+        self._buf = self._shm.buf
+        self._lock_fd = os.open(os.path.join(tempfile.gettempdir(), f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        self._map_lock = lock_stripes
+        self._held: dict[int, int] = {}
+        # Кэш процесса: {chat_id: (слот, версия, GameState)}
+        self._cache: dict[int, tuple[int, int, GameState]] = {}
+
+        self.reloads = 0
+        self.lock_waits = 0
+
+    # --- блокировки ---
+
+    def _stripe(self, chat_id: int) -> int:
+        return hash(chat_id) % self.lock_stripes
+
+    def _acquire(self, offset: int, blocking: bool = True) -> bool:
+        if self._held.get(offset):
+            self._held[offset] += 1
+            return True
+        try:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+        except BlockingIOError:
+            return False
+        self._held[offset] = 1
+        return True
+
+    def _release(self, offset: int) -> None:
+        self._held[offset] -= 1
+        if not self._held[offset]:
+            del self._held[offset]
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, offset)
+
+    @contextlib.contextmanager
+    def _locked(self, offset: int):
+        # Обработчики пишут, уже держа полосу через exclusive(), здесь только вложенный захват
+        self._acquire(offset)
+        try:
+            yield
+        finally:
+            self._release(offset)
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self, chat_id: int):
+        offset = self._stripe(chat_id)
+        delay = 0.001
+        while not self._acquire(offset, blocking=False):
+            # Полосу держит другой воркер: не блокируем цикл событий, ждем с backoff
+            self.lock_waits += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.02)
+        try:
+            yield
+        finally:
+            self._release(offset)
+
+    # --- карта слотов ---
+
+    def _find(self, chat_id: int) -> int | None:
+        start = hash(chat_id) % self.slots
+        max_probe = HEADER.unpack_from(self._buf, self._used_offset)[2]
+        for n in range(min(max_probe + 1, self.slots)):
+            slot = (start + n) % self.slots
+            offset = slot * RECORD.size
+            state = self._buf[offset + 8]
+            if state == SLOT_EMPTY:
+                return None
+            if state == SLOT_USED and struct.unpack_from("<q", self._buf, offset)[0] == chat_id:
+                return slot
+        return None
+
+    def _insert(self, chat_id: int) -> int:
+        with self._locked(self._map_lock):
+            slot = self._find(chat_id)
+            if slot is not None:
+                return slot
+            start = hash(chat_id) % self.slots
+            for n in range(self.slots):
+                slot = (start + n) % self.slots
+                offset = slot * RECORD.size
+                state = self._buf[offset + 8]
+                if state != SLOT_USED:
+                    used, deleted, max_probe = HEADER.unpack_from(self._buf, self._used_offset)
+                    # Длина пробы публикуется до записи: поиск из другого процесса
+                    # не остановится раньше этого слота
+                    HEADER.pack_into(self._buf, self._used_offset, used + 1,
+                                     deleted - (state == SLOT_DELETED), max(max_probe, n))
+                    # Сначала нечетная версия: читатель, нашедший здесь новый chat_id,
+                    # ждет в _read, пока _write не допишет запись, и не видит
+                    # поля прежнего владельца слота
+                    version = self._version(slot) | 1
+                    struct.pack_into("<I", self._buf, offset + 16, version)
+                    struct.pack_into("<q", self._buf, offset, chat_id)
+                    self._buf[offset + 8] = SLOT_USED
+                    return slot
+        raise RuntimeError(f"Shared game table is full ({self.slots} slots), raise SHARED_GAME_SLOTS")
+
+    def _delete(self, slot: int) -> None:
+        """Освобождает слот (под блокировкой карты слотов)."""
+        used, deleted, max_probe = HEADER.unpack_from(self._buf, self._used_offset)
+        self._buf[slot * RECORD.size + 8] = SLOT_DELETED
+        deleted += 1
+        # Если дальше пустой слот, через метки перед ним ни одна цепочка не идет
+        if self._buf[(slot + 1) % self.slots * RECORD.size + 8] == SLOT_EMPTY:
+            while self._buf[slot * RECORD.size + 8] == SLOT_DELETED:
+                self._buf[slot * RECORD.size + 8] = SLOT_EMPTY
+                deleted -= 1
+                slot = (slot - 1) % self.slots
+        HEADER.pack_into(self._buf, self._used_offset, used - 1, deleted, max_probe)
+
+    def _used_slots(self) -> list[int]:
+        """Занятые слоты: байты состояния всех записей читаются одним срезом с шагом."""
+        states = self._buf[8:self._used_offset:RECORD.size].tobytes()
+        slots = []
+        slot = states.find(SLOT_USED_BYTE)
+        while slot != -1:
+            slots.append(slot)
+            slot = states.find(SLOT_USED_BYTE, slot + 1)
+        return slots
+
+    # --- записи ---
+
+    def _version(self, slot: int) -> int:
+        return struct.unpack_from("<I", self._buf, slot * RECORD.size + 16)[0]
+
+    def _read(self, slot: int) -> tuple | None:
+        """Согласованная запись слота. None - слот бросил упавший писатель, он освобожден."""
+        offset = slot * RECORD.size
+        deadline = None
+        while True:
+            before = self._version(slot)
+            if before % 2 == 0:
+                record = RECORD.unpack_from(self._buf, offset)
+                if self._version(slot) == before:
+                    return record
+            elif deadline is None:
+                deadline = time.monotonic() + SEQLOCK_TIMEOUT
+            elif time.monotonic() > deadline:
+                return self._recover(slot)
+            time.sleep(0)
+
+    def _recover(self, slot: int) -> tuple | None:
+        """Версия слота нечетная дольше SEQLOCK_TIMEOUT.
+
+        Писатель держит полосу чата все время записи, а fcntl-блокировка
+        снимается со смертью процесса. Если полосу удалось взять, а версия
+        все еще нечетная, писатель упал посреди записи: запись испорчена, слот
+        освобождается. Если полосу держит живой писатель - ошибка, а не
+        бесконечное ожидание в цикле событий.
+        """
+        offset = slot * RECORD.size
+        chat_id = struct.unpack_from("<q", self._buf, offset)[0]
+        stripe = self._stripe(chat_id)
+        if not self._acquire(stripe, blocking=False):
+            raise RuntimeError(f"Shared game slot {slot} (chat {chat_id}) is stuck mid-write by a live worker")
+        try:
+            version = self._version(slot)
+            dead = version % 2 == 1
+            if dead:
+                logger.error("Shared game slot %s (chat %s) was left mid-write by a dead worker, dropping the game",
+                             slot, chat_id)
+                with self._locked(self._map_lock):
+                    struct.pack_into("<I", self._buf, offset + 16, version + 1)
+                    if self._buf[offset + 8] == SLOT_USED:
+                        self._delete(slot)
+        finally:
+            self._release(stripe)
+        # Писатель дописал, пока мы брали полосу - запись уже согласована
+        return None if dead else self._read(slot)
+
+    def _write(self, slot: int, chat_id: int, game: GameState) -> int:
+        offset = slot * RECORD.size
+        version = self._version(slot) | 1  # нечетная - запись идет
+        struct.pack_into("<I", self._buf, offset + 16, version)
+        flags = (FLAG_O_TURN if game.current_player == "O" else 0) | (FLAG_GAME_OVER if game.game_over else 0)
+        theme = THEME_KEYS.index(game.theme_key) if game.theme_key in THEMES else 0
+        ai_level = AI_LEVEL_KEYS.index(game.ai_level) if game.ai_level in AI_LEVELS else 0
+        board = game.board
+        RECORD.pack_into(
+            self._buf, offset, chat_id, SLOT_USED, flags, theme, ai_level,
+            board.geometry.size, board.geometry.k, version, board.x, board.o,
+            game.player_x or 0, game.player_o or 0, game.message_id or 0,
+            time.time() - (time.monotonic() - game.last_activity),
+            _encode_name(game.username_x), _encode_name(game.username_o),
+            game.game_id.encode() if game.game_id else b"",
+        )
+        version += 1
+        struct.pack_into("<I", self._buf, offset + 16, version)
+        return version
+
+    def _load(self, chat_id: int, slot: int) -> GameState | None:
+        cached = self._cache.get(chat_id)
+        version = self._version(slot)
+        if cached is not None and cached[0] == slot and cached[1] == version:
+            return cached[2]
+        record = self._read(slot)
+        if record is None:
+            self._cache.pop(chat_id, None)
+            return None
+        (record_chat_id, state, flags, theme, ai_level, size, k, version, x, o, player_x, player_o,
+         message_id, updated_at, username_x, username_o, game_id) = record
+        if state != SLOT_USED or record_chat_id != chat_id:
+            return None
+        game = GameState.__new__(GameState)
+        game.board = BitBoard(x, o, geometry=board_geometry(size or 3, k or 3))
+        game.current_player = "O" if flags & FLAG_O_TURN else "X"
+        game.game_over = bool(flags & FLAG_GAME_OVER)
+        game.player_x = player_x or None
+        game.player_o = player_o or None
+        game.username_x = _decode_name(username_x)
+        game.username_o = _decode_name(username_o)
+        game.theme_key = THEME_KEYS[theme] if theme < len(THEME_KEYS) else DEFAULT_THEME_KEY
+        game.message_id = message_id or None
+        game.game_id = game_id.rstrip(b"\0").decode() or None
+        game.ai_level = AI_LEVEL_KEYS[ai_level] if ai_level < len(AI_LEVEL_KEYS) else None
+        game.last_activity = time.monotonic() - max(0.0, time.time() - updated_at)
+        # Сообщение могли править из другого воркера: отправленное содержимое неизвестно
+        game.sent_text = None
+        game.sent_markup = None
+        game.signed_markup = None
+        self._cache[chat_id] = (slot, version, game)
+        self.reloads += 1
+        return game
+
+    # --- интерфейс GameStore ---
+
+    def get(self, chat_id: int) -> GameState | None:
+        slot = self._find(chat_id)
+        if slot is None:
+            self._cache.pop(chat_id, None)
+            return None
+        return self._load(chat_id, slot)
+
+    def __setitem__(self, chat_id: int, game: GameState) -> None:
+        with self._locked(self._stripe(chat_id)):
+            slot = self._insert(chat_id)
+            version = self._write(slot, chat_id, game)
+        self._cache[chat_id] = (slot, version, game)
+
+    def pop(self, chat_id: int) -> GameState | None:
+        """Удаляет игру. Если чат сейчас обрабатывает другой воркер, игра не трогается (None):
+        так sweeper не блокирует цикл событий и не вытесняет активную игру."""
+        stripe = self._stripe(chat_id)
+        if not self._acquire(stripe, blocking=False):
+            return None
+        try:
+            slot = self._find(chat_id)
+            if slot is None:
+                return None
+            game = self._load(chat_id, slot)
+            with self._locked(self._map_lock):
+                self._delete(slot)
+        finally:
+            self._release(stripe)
+        self._cache.pop(chat_id, None)
+        return game
+
+    def mark_dirty(self, chat_id: int) -> None:
+        cached = self._cache.get(chat_id)
+        if cached is None:
+            return
+        with self._locked(self._stripe(chat_id)):
+            slot = self._find(chat_id)
+            if slot is None:
+                return
+            version = self._write(slot, chat_id, cached[2])
+        self._cache[chat_id] = (slot, version, cached[2])
+
+    def __len__(self) -> int:
+        return HEADER.unpack_from(self._buf, self._used_offset)[0]
+
+    def items(self):
+        games = []
+        for slot in self._used_slots():
+            chat_id = struct.unpack_from("<q", self._buf, slot * RECORD.size)[0]
+            game = self._load(chat_id, slot)
+            if game is not None:
+                games.append((chat_id, game))
+        # Заодно забываем кэш игр, удаленных другими воркерами
+        live = {chat_id for chat_id, _ in games}
+        self._cache = {chat_id: entry for chat_id, entry in self._cache.items() if chat_id in live}
+        return games
+
+    def values(self):
+        return [game for _, game in self.items()]
+
+    async def stop(self) -> None:
+        os.close(self._lock_fd)
+        self._buf = None
+        self._shm.close()
+
+    def unlink(self) -> None:
+        """Удаляет таблицу из системы (когда все воркеры остановлены)."""
+        resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+
+    def stats(self) -> dict:
+        used, deleted, max_probe = HEADER.unpack_from(self._buf, self._used_offset)
+        return {
+            "backend": "shared",
+            "pid": os.getpid(),
+            "slots": self.slots,
+            "used": used,
+            "deleted": deleted,
+            "max_probe": max_probe,
+            "cached": len(self._cache),
+            "reloads": self.reloads,
+            "lock_waits": self.lock_waits,
+        }
+
+
+def _encode_name(username: str | None) -> bytes:
+    if not username:
+        return b""
+    data = username.encode()[:USERNAME_BYTES]
+    # Не режем многобайтовый символ пополам
+    return data.decode(errors="ignore").encode()
+
+
+def _decode_name(data: bytes) -> str | None:
+    name = data.rstrip(b"\0").decode(errors="ignore")
+    return sys.intern(name) if name else None
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import math
+import time
+
+from config import TIMEOUT_WHEEL_TICK, TIMEOUT_WHEEL_SLOTS
+
+logger = logging.getLogger(__name__)
+
+
+class _WheelEntry:
+    __slots__ = ("key", "callback", "args", "rounds", "slot")
+
+    def __init__(self, key, callback, args: tuple, rounds: int, slot: int):
+        self.key = key
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.slot = slot
+
+
+class TimeoutWheel:
+    """Таймеры игр на одном колесе времени вместо отдельной задачи JobQueue на игру.
+
+    Колесо - кольцо из `slots` ячеек, каждая ячейка - словарь {key: запись}.
+    Одна фоновая задача раз в `tick` секунд сдвигает курсор и запускает
+    все истекшие в ячейке записи одной пачкой. Таймауты длиннее оборота
+    колеса хранят число оставшихся оборотов (`rounds`).
+
+    schedule и cancel - O(1): запись кладется в словарь ячейки и удаляется
+    оттуда по ключу. Ключ (обычно chat_id) уникален: повторный schedule
+    с тем же ключом заменяет прежний таймер.
+    """
+
+    def __init__(self, tick: float = TIMEOUT_WHEEL_TICK, slots: int = TIMEOUT_WHEEL_SLOTS):
+        self.tick = tick
+        self._slots: list[dict] = [{} for _ in range(slots)]
+        self._entries: dict = {}
+        self._cursor = 0
+        self._task: asyncio.Task | None = None
+        # Пачки сработавших таймеров в работе: ссылки держатся до завершения
+        self._firing: set[asyncio.Task] = set()
+
+        self.scheduled = 0
+        self.cancelled = 0
+        self.fired = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def schedule(self, key, delay: float, callback, *args) -> None:
+        """Через `delay` секунд (с точностью до тика) будет вызван `await callback(*args)`."""
+        self.cancel(key, count=False)
+        ticks = max(1, math.ceil(delay / self.tick))
+        size = len(self._slots)
+        slot = (self._cursor + ticks) % size
+        entry = _WheelEntry(key, callback, args, (ticks - 1) // size, slot)
+        self._slots[slot][key] = entry
+        self._entries[key] = entry
+        self.scheduled += 1
+
+    def cancel(self, key, count: bool = True) -> bool:
+        """Отменяет таймер по ключу. False - таймера не было (уже сработал или отменен)."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        del self._slots[entry.slot][key]
+        if count:
+            self.cancelled += 1
+        return True
+
+    def advance(self) -> list[_WheelEntry]:
+        """Сдвигает колесо на один тик и возвращает истекшие записи (уже удаленные)."""
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        bucket = self._slots[self._cursor]
+        if not bucket:
+            return []
+        expired = []
+        for key, entry in list(bucket.items()):
+            if entry.rounds:
+                entry.rounds -= 1
+                continue
+            del bucket[key]
+            del self._entries[key]
+            expired.append(entry)
+        return expired
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="timeout_wheel")
+            logger.info("Timeout wheel started: tick=%ss, slots=%s", self.tick, len(self._slots))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.gather(*self._firing, return_exceptions=True)
+
+    async def _run(self) -> None:
+        next_tick = time.monotonic() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            # Если цикл событий был занят дольше тика - догоняем пропущенные тики
+            expired = []
+            now = time.monotonic()
+            while next_tick <= now:
+                expired.extend(self.advance())
+                next_tick += self.tick
+            if expired:
+                self.fired += len(expired)
+                task = asyncio.create_task(self._fire(expired), name="timeout_wheel_fire")
+                self._firing.add(task)
+                task.add_done_callback(self._firing.discard)
+
+    @staticmethod
+    async def _fire(expired: list[_WheelEntry]) -> None:
+        results = await asyncio.gather(
+            *(entry.callback(*entry.args) for entry in expired), return_exceptions=True
+        )
+        for entry, result in zip(expired, results):
+            if isinstance(result, Exception):
+                logger.error("Timeout callback for %s failed: %s", entry.key, result, exc_info=result)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._entries),
+            "scheduled": self.scheduled,
+            "cancelled": self.cancelled,
+            "fired": self.fired,
+        }
+
+
+timeouts = TimeoutWheel()
@@ -0,0 +1,126 @@
+import asyncio
+import gzip
+import logging
+import os
+import time
+
+from config import WEBHOOK_RECORD_PATH, WEBHOOK_RECORD_MAX_BYTES, WEBHOOK_RECORD_FLUSH_INTERVAL, WEB_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class TrafficRecorder:
+    """Запись входящих обновлений вебхука для воспроизведения (benchmarks/replay.py).
+
+    Каждое обновление - строка JSONL {"t": время прихода (unix), "update": тело
+    как есть} в gzip-файле. Вебхук только кладет сырые байты в буфер; сжатие и
+    запись идут в отдельном потоке раз в `flush_interval` секунд и при
+    остановке. Если процесс упал, у файла нет конца gzip-потока, но все
+    сброшенное до падения читается (gzip sync flush; replay.py берет
+    записи до обрыва). Каждый запуск пишет новый файл: если `path` уже
+    есть, к нему добавляется номер (.1, .2, ...), а не дописывается
+    gzip-член за оборванным.
+
+    Когда сжатый файл дорастает до `max_bytes`, запись прекращается, а
+    последующие обновления только считаются в dropped. При нескольких
+    воркерах каждый пишет свой файл: к пути добавляется pid.
+    """
+
+    def __init__(self, path: str = WEBHOOK_RECORD_PATH, max_bytes: int = WEBHOOK_RECORD_MAX_BYTES,
+                 flush_interval: float = WEBHOOK_RECORD_FLUSH_INTERVAL):
+        self.path = f"{path}.{os.getpid()}" if path and WEB_WORKERS > 1 else path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._buffer: list[bytes] = []
+        self._file: gzip.GzipFile | None = None
+        self._task: asyncio.Task | None = None
+        self._writing: asyncio.Future | None = None
+        self._full = False
+
+        self.recorded = 0
+        self.dropped = 0
+        self.bytes_written = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and not self._full
+
+    def record(self, body: bytes) -> None:
+        """Запоминает сырое тело обновления (уже проверенное как JSON)."""
+        if not self.enabled:
+            if self.path:
+                self.dropped += 1
+            return
+        self._buffer.append(b'{"t":%.6f,"update":%s}\n' % (time.time(), body))
+
+    def _write(self, lines: list[bytes]) -> None:
+        """Сжимает и дописывает строки в файл (выполняется в отдельном потоке)."""
+        if self._file is None:
+            self._file = self._open_new()
+        self._file.write(b"".join(lines))
+        self._file.flush()
+        self.bytes_written = self._file.fileobj.tell()
+
+    def _open_new(self) -> gzip.GzipFile:
+        base, n = self.path, 0
+        while True:
+            try:
+                file = gzip.open(self.path, "xb")
+            except FileExistsError:
+                n += 1
+                self.path = f"{base}.{n}"
+                continue
+            if n:
+                logger.info("%s already exists, recording webhook traffic to %s", base, self.path)
+            return file
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        # Отмена фоновой задачи не должна прерывать запись: stop дождется ее
+        self._writing = asyncio.ensure_future(asyncio.to_thread(self._write, lines))
+        try:
+            await asyncio.shield(self._writing)
+        except OSError as e:
+            self.dropped += len(lines)
+            logger.error("Could not write recorded webhook traffic to %s: %s", self.path, e)
+            return
+        self.recorded += len(lines)
+        if self.bytes_written >= self.max_bytes and not self._full:
+            self._full = True
+            logger.warning("Webhook traffic recording stopped: %s reached %s bytes", self.path, self.bytes_written)
+
+    def start(self) -> None:
+        if self.path and (self._task is None or self._task.done()):
+            logger.info("Recording webhook traffic to %s (up to %s bytes)", self.path, self.max_bytes)
+            self._task = asyncio.create_task(self._run(), name="traffic_recorder_flush")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._writing is not None:
+            await asyncio.gather(self._writing, return_exceptions=True)
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "recorded": self.recorded,
+            "buffered": len(self._buffer),
+            "dropped": self.dropped,
+            "bytes_written": self.bytes_written,
+        }
+
+
+traffic_recorder = TrafficRecorder()
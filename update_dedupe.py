@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+
+from config import UPDATE_DEDUPE_SIZE, UPDATE_DEDUPE_PATH, UPDATE_DEDUPE_SAVE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduper:
+    """Отбрасывает повторно доставленные обновления по update_id.
+
+    Если вебхук ответил 500 или слишком долго, Telegram присылает то же
+    обновление еще раз, и без проверки button_click повторил бы ход или
+    присоединение, а chat_stats посчитал бы результат дважды.
+
+    Последние `size` id хранятся в кольцевом буфере фиксированного размера
+    и в словаре id -> позиция в кольце для проверки за O(1); самый старый id
+    вытесняется новым. forget освобождает и позицию в кольце.
+    Проверка идет по сырому JSON до Update.de_json.
+
+    Максимальный принятый id (high-water mark) раз в `save_interval` секунд
+    и при остановке пишется в файл `path`. После перезапуска повторами
+    считаются id из окна (high_water - size, high_water]: Telegram выдает id
+    по возрастанию, но после недели простоя может начать со случайного
+    значения, поэтому все, что ниже окна, пропускается как новое. Забытые
+    (forget) id из этого окна запоминаются отдельно и снова принимаются.
+    """
+
+    def __init__(self, size: int = UPDATE_DEDUPE_SIZE, path: str = UPDATE_DEDUPE_PATH,
+                 save_interval: float = UPDATE_DEDUPE_SAVE_INTERVAL):
+        self.size = max(1, size)
+        self.path = path
+        self.save_interval = save_interval
+        self._ring: list[int | None] = [None] * self.size
+        self._pos = 0
+        self._seen: dict[int, int] = {}
+        self.high_water = 0
+        self._restored_high_water = 0
+        # id из восстановленного окна, повтор которых нужно принять (см. forget)
+        self._forgotten: set[int] = set()
+        self._saved_high_water = 0
+        self._task: asyncio.Task | None = None
+
+        self.duplicates = 0
+        self.load()
+
+    def seen(self, update_id: int) -> bool:
+        """True - обновление уже было, его нужно отбросить. Иначе запоминает id."""
+        restored = self._restored_high_water
+        if update_id in self._seen or (
+            restored - self.size < update_id <= restored and update_id not in self._forgotten
+        ):
+            self.duplicates += 1
+            return True
+        evicted = self._ring[self._pos]
+        if evicted is not None:
+            del self._seen[evicted]
+        self._ring[self._pos] = update_id
+        self._seen[update_id] = self._pos
+        self._pos = (self._pos + 1) % self.size
+        if update_id > self.high_water:
+            self.high_water = update_id
+        return False
+
+    def forget(self, update_id: int) -> None:
+        """Обновление не обработано (вебхук ответил ошибкой): его повтор нужно принять."""
+        pos = self._seen.pop(update_id, None)
+        if pos is not None:
+            # Пустая позиция: вытеснение не удалит тот же id, принятый повторно
+            self._ring[pos] = None
+        restored = self._restored_high_water
+        if restored - self.size < update_id <= restored:
+            self._forgotten.add(update_id)
+
+    def load(self) -> None:
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                self._restored_high_water = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read update dedupe state from %s: %s", self.path, e)
+            return
+        self.high_water = self._saved_high_water = self._restored_high_water
+        logger.info("Update dedupe restored high-water mark %s", self._restored_high_water)
+
+    def save(self) -> None:
+        if not self.path or self.high_water == self._saved_high_water:
+            return
+        high_water = self.high_water
+        try:
+            # Несколько воркеров пишут один файл: не откатываем отметку соседа назад
+            with open(self.path) as f:
+                high_water = max(high_water, int(f.read().strip() or 0))
+        except (OSError, ValueError):
+            pass
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(str(high_water))
+            os.replace(tmp_path, self.path)
+            self._saved_high_water = self.high_water
+        except OSError as e:
+            logger.error("Could not save update dedupe state to %s: %s", self.path, e)
+
+    def start(self) -> None:
+        if self.path and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run(), name="update_dedupe_save")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.save()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.save_interval)
+            self.save()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "tracked": len(self._seen),
+            "high_water": self.high_water,
+            "duplicates": self.duplicates,
+        }
+
+
+update_deduper = UpdateDeduper()
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram import CallbackQuery, Update
+from telegram.ext import Application
+
+from config import UPDATE_QUEUE_SIZE, UPDATE_WORKERS, STALE_CALLBACK_SECONDS
+from metrics import UPDATE_QUEUE_WAIT_SECONDS, UPDATE_LATENCY_SECONDS, update_kind
+from outbound import outbound
+from webhook_reply import webhook_replies
+
+logger = logging.getLogger(__name__)
+
+
+class _QueuedUpdate:
+    __slots__ = ("update", "enqueued_at", "is_callback", "chat_id", "key")
+
+    def __init__(self, update: Update, enqueued_at: float):
+        self.update = update
+        self.enqueued_at = enqueued_at
+        self.is_callback = update.callback_query is not None
+        chat = update.effective_chat
+        self.chat_id = chat.id if chat else None
+        # Ящик очереди: чат или, для обновлений без чата, само обновление
+        self.key = self.chat_id if chat else self
+
+
+class UpdateQueue:
+    """Ограниченная очередь входящих обновлений и пул обработчиков.
+
+    Вебхук только кладет обновление в очередь и сразу отвечает Telegram 200,
+    а `workers` фоновых задач обрабатывают его через `application.update_processor`
+    (PerChatUpdateProcessor: разные чаты параллельно, один чат - по порядку).
+
+    У каждого чата свой ящик (deque), а в `_ready` стоят чаты, у которых
+    есть обновления и ни одно сейчас не обрабатывается. Обработчик берет
+    чат из `_ready`, и следующее обновление этого чата станет доступно
+    только после завершения текущего. Поэтому медленный или заваленный
+    нажатиями чат занимает одного обработчика, а не всех, и остальные чаты
+    не ждут за ним.
+
+    Политика перегрузки (очередь заполнена):
+      1. выбрасываются нажатия кнопок, ждущие дольше `stale_after` секунд;
+      2. затем самое старое нажатие кнопки в очереди;
+      3. если в очереди одни команды - новое нажатие кнопки отбрасывается.
+    Команды и сообщения не отбрасываются никогда: при переполнении они
+    принимаются сверх лимита.
+    """
+
+    def __init__(self, application: Application, maxsize: int = UPDATE_QUEUE_SIZE,
+                 workers: int = UPDATE_WORKERS, stale_after: float = STALE_CALLBACK_SECONDS):
+        self._application = application
+        self.maxsize = maxsize
+        self.workers = max(1, workers)
+        self.stale_after = stale_after
+        # Ящики чатов: {ключ: обновления по порядку}; ящик обрабатываемого
+        # чата остается в словаре, даже если пуст
+        self._mailboxes: dict[object, deque[_QueuedUpdate]] = {}
+        self._ready: deque = deque()
+        self._active: set = set()
+        self._depth = 0
+        self._not_empty = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        # Ответы на выброшенные нажатия, которые уже не успели в ответ вебхука
+        self._answers: set[asyncio.Task] = set()
+        self._busy = 0
+        # Обновления чата в очереди и в обработке: {chat_id: число}
+        self._pending: dict[int, int] = {}
+
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.shed_callbacks = 0
+        self.max_depth = 0
+        self.last_wait = 0.0
+        self.avg_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self) -> None:
+        for n in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(n), name=f"update_worker_{n}"))
+        logger.info("Update queue started: %s worker(s), maxsize=%s", self.workers, self.maxsize)
+
+    async def stop(self, drain_timeout: float = 5.0) -> None:
+        """Дает очереди опустеть (не дольше drain_timeout) и останавливает обработчики."""
+        deadline = time.monotonic() + drain_timeout
+        while (self._depth or self._busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._depth:
+            logger.warning("Update queue stopped with %s unprocessed update(s)", self._depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        await asyncio.gather(*self._answers, return_exceptions=True)
+
+    def submit(self, update: Update) -> bool:
+        """Кладет обновление в очередь без ожидания. False - обновление отброшено."""
+        now = time.monotonic()
+        entry = _QueuedUpdate(update, now)
+        if self._depth >= self.maxsize and not self._make_room(now, entry):
+            self.shed_callbacks += 1
+            logger.warning("Update queue full (%s), dropping callback update %s", self._depth, update.update_id)
+            self._answer_shed(update.callback_query)
+            return False
+
+        mailbox = self._mailboxes.get(entry.key)
+        if mailbox is None:
+            mailbox = self._mailboxes[entry.key] = deque()
+        mailbox.append(entry)
+        if len(mailbox) == 1 and entry.key not in self._active:
+            self._ready.append(entry.key)
+            self._not_empty.set()
+        self._depth += 1
+        self._track(entry, 1)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        return True
+
+    def _make_room(self, now: float, incoming: _QueuedUpdate) -> bool:
+        """Освобождает место по политике перегрузки. False - входящее нужно отбросить."""
+        stale_before = now - self.stale_after
+        dropped = 0
+        for key, mailbox in list(self._mailboxes.items()):
+            stale = [entry for entry in mailbox if entry.is_callback and entry.enqueued_at < stale_before]
+            if stale:
+                for entry in stale:
+                    mailbox.remove(entry)
+                    self._discard(entry)
+                dropped += len(stale)
+                self._drop_if_empty(key, mailbox)
+
+        if self._depth >= self.maxsize:
+            # Самое старое нажатие: первое нажатие в каждом ящике, из них самое раннее
+            oldest = None
+            for mailbox in self._mailboxes.values():
+                for entry in mailbox:
+                    if entry.is_callback:
+                        if oldest is None or entry.enqueued_at < oldest.enqueued_at:
+                            oldest = entry
+                        break
+            if oldest is not None:
+                mailbox = self._mailboxes[oldest.key]
+                mailbox.remove(oldest)
+                self._discard(oldest)
+                dropped += 1
+                self._drop_if_empty(oldest.key, mailbox)
+
+        if dropped:
+            self.shed_callbacks += dropped
+            logger.warning("Update queue overloaded: shed %s queued callback update(s)", dropped)
+
+        if self._depth < self.maxsize:
+            return True
+        # Места нет, в очереди только команды: их не трогаем, нажатие отбрасываем
+        return not incoming.is_callback
+
+    def _drop_if_empty(self, key, mailbox: deque) -> None:
+        """Ящик опустел после сброса нажатий: убираем его, если чат не обрабатывается."""
+        if not mailbox and key not in self._active:
+            del self._mailboxes[key]
+            self._ready.remove(key)
+
+    async def _get(self) -> _QueuedUpdate:
+        while not self._ready:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        key = self._ready.popleft()
+        self._active.add(key)
+        self._depth -= 1
+        return self._mailboxes[key].popleft()
+
+    def _done(self, key) -> None:
+        """Обновление чата обработано: следующее из его ящика снова доступно обработчикам."""
+        self._active.discard(key)
+        if self._mailboxes[key]:
+            self._ready.append(key)
+            self._not_empty.set()
+        else:
+            del self._mailboxes[key]
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            entry = await self._get()
+            self._busy += 1
+            wait = time.monotonic() - entry.enqueued_at
+            self.last_wait = wait
+            self.avg_wait = wait if not self.processed else self.avg_wait * 0.9 + wait * 0.1
+            self.max_wait = max(self.max_wait, wait)
+            UPDATE_QUEUE_WAIT_SECONDS.observe(wait)
+            try:
+                await self._application.update_processor.process_update(
+                    entry.update, self._application.process_update(entry.update)
+                )
+            except Exception as e:
+                self.failed += 1
+                logger.error("Worker %s failed to process update %s: %s", n, entry.update.update_id, e, exc_info=True)
+            finally:
+                self.processed += 1
+                self._busy -= 1
+                self._track(entry, -1)
+                self._done(entry.key)
+                UPDATE_LATENCY_SECONDS.observe(time.monotonic() - entry.enqueued_at, update_kind(entry.update))
+            if entry.is_callback and webhook_replies.finish(entry.update.callback_query.id):
+                # Обработчик не ответил на нажатие, а ответ вебхука уже ушел
+                await outbound.answer(entry.update.callback_query)
+
+    def _discard(self, entry: _QueuedUpdate) -> None:
+        self._depth -= 1
+        self._track(entry, -1)
+        self._answer_shed(entry.update.callback_query)
+
+    def _answer_shed(self, query: CallbackQuery) -> None:
+        """Выброшенное нажатие: если вебхук еще ждет, он ответит пустым answerCallbackQuery,
+        иначе пустой ответ уходит через бота - без него у клиента крутится индикатор."""
+        if webhook_replies.finish(query.id):
+            task = asyncio.create_task(outbound.answer(query), name=f"answer_shed_{query.id}")
+            self._answers.add(task)
+            task.add_done_callback(self._answers.discard)
+
+    def _track(self, entry: _QueuedUpdate, delta: int) -> None:
+        if entry.chat_id is None:
+            return
+        count = self._pending.get(entry.chat_id, 0) + delta
+        if count:
+            self._pending[entry.chat_id] = count
+        else:
+            del self._pending[entry.chat_id]
+
+    def pending(self, chat_id: int) -> int:
+        """Сколько обновлений чата еще ждет в очереди или обрабатывается."""
+        return self._pending.get(chat_id, 0)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._depth,
+            "ready_chats": len(self._ready),
+            "max_depth": self.max_depth,
+            "maxsize": self.maxsize,
+            "workers": self.workers,
+            "busy_workers": self._busy,
+            "pending_chats": len(self._pending),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "shed_callbacks": self.shed_callbacks,
+            "wait_last_ms": round(self.last_wait * 1000, 2),
+            "wait_avg_ms": round(self.avg_wait * 1000, 2),
+            "wait_max_ms": round(self.max_wait * 1000, 2),
+        }
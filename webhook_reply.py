@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+from config import WEBHOOK_REPLY_TIMEOUT
+
+
+class _PendingReply:
+    __slots__ = ("future", "answered", "created")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.answered = False
+        self.created = time.monotonic()
+
+
+class WebhookReplies:
+    """Вызов Bot API в теле HTTP-ответа вебхука вместо отдельного запроса.
+
+    Telegram выполняет один метод, переданный в ответе на вебхук. Эндпоинт
+    регистрирует callback query (expect) и до `timeout` секунд ждет, пока
+    обработчик на него ответит: outbound.answer сначала предлагает ответ сюда
+    (offer), и если HTTP-ответ еще не ушел, answerCallbackQuery отправляется
+    в нем - без исходящего запроса. Опоздавшие ответы и все остальные вызовы
+    идут обычным путем через бота.
+
+    finish() вызывается, когда обновление обработано (или выброшено из
+    очереди): если на запрос так никто и не ответил, эндпоинт получает пустой
+    answerCallbackQuery, чтобы у пользователя пропали "часики".
+    """
+
+    PRUNE_AFTER = 60.0
+
+    def __init__(self, timeout: float = WEBHOOK_REPLY_TIMEOUT):
+        self.timeout = timeout
+        self._pending: dict[str, _PendingReply] = {}
+        self.inline = 0
+        self.timed_out = 0
+
+    def expect(self, query_id: str) -> None:
+        if len(self._pending) >= 1024:
+            self._prune()
+        self._pending[query_id] = _PendingReply(asyncio.get_running_loop().create_future())
+
+    async def wait(self, query_id: str) -> dict | None:
+        """Тело HTTP-ответа с вызовом метода или None, если обработчик не успел."""
+        entry = self._pending.get(query_id)
+        if entry is None:
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry.future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            entry.future.cancel()  # дальше ответы идут через бота
+            return None
+
+    def offer(self, query_id: str, method: str, **params) -> bool:
+        """True - вызов уйдет в ответе вебхука, отправлять его не нужно."""
+        entry = self._pending.get(query_id)
+        if entry is None:
+            return False
+        entry.answered = True
+        if entry.future.done():
+            return False
+        entry.future.set_result({"method": method, **params})
+        self.inline += 1
+        return True
+
+    def finish(self, query_id: str) -> bool:
+        """Обновление обработано. True - на запрос никто не ответил и ответить
+        нужно через бота (HTTP-ответ уже ушел)."""
+        entry = self._pending.pop(query_id, None)
+        if entry is None or entry.answered:
+            return False
+        if not entry.future.done():
+            entry.future.set_result({"method": "answerCallbackQuery", "callback_query_id": query_id})
+            self.inline += 1
+            return False
+        return True
+
+    def _prune(self) -> None:
+        # Записи обновлений, которые так и не дошли до finish (например, при остановке)
+        expired = time.monotonic() - self.PRUNE_AFTER
+        for query_id in [query_id for query_id, entry in self._pending.items() if entry.created < expired]:
+            del self._pending[query_id]
+
+    def stats(self) -> dict:
+        return {
+            "waiting": len(self._pending),
+            "inline": self.inline,
+            "timed_out": self.timed_out,
+        }
+
+
+webhook_replies = WebhookReplies()